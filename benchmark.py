@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Benchmarks of track list management on synthetic removable media.
+
+    Creates media tree with given count of folders, tracks per folder and share of tracks with
+    not allowed characters in filenames, times scanning, sanitizing, saving and loading of track list,
+    toggling of delete marks, deleting of marked files and generating of MainScreen widgets,
+    and writes results as JSON.
+
+    Usage:
+        python benchmark.py --folders 200 --tracks-per-folder 100 --dirty-share 0.2 --output bench.json
+"""
+
+import os, sys, json, time, random, shutil, tempfile, argparse, timeit
+
+#kivy shouldn't parse arguments of benchmark
+os.environ['KIVY_NO_ARGS'] = '1'
+
+import managers
+
+#characters which MediaScanner.clear_file_names removes from filenames
+DIRTY_CHARS = u'!#$%&()[]{}+=,;@~_'
+
+def generate_media_tree(path_to_removable_media, folders, tracks_per_folder, dirty_share, track_size=1024, seed=0):
+    """
+        Creates synthetic removable media:
+            folders: int              #count of top level folders
+            tracks_per_folder: int    #count of musical files in every folder
+            dirty_share: float        #share of tracks with not allowed characters in filenames
+            track_size: int           #size of every track in bytes
+        Every folder also contains one not musical file.
+    """
+
+    rnd = random.Random(seed)
+    content = b'\0' * track_size
+
+    for folder_index in range(folders):
+
+        path_to_folder = os.path.join(path_to_removable_media, u'Album %04d' % folder_index)
+        os.makedirs(path_to_folder)
+
+        for track_index in range(tracks_per_folder):
+
+            track_name = u'%02d - Artist %d - Track %d' % (track_index + 1, folder_index, track_index)
+            if rnd.random() < dirty_share:
+                track_name += u' ' + u''.join(rnd.choice(DIRTY_CHARS) for i in range(3))
+
+            f = open(os.path.join(path_to_folder, track_name + rnd.choice(managers.MediaScanner.track_extensions)), 'wb')
+            f.write(content)
+            f.close()
+
+        f = open(os.path.join(path_to_folder, u'cover.jpg'), 'wb')
+        f.write(content)
+        f.close()
+
+class Benchmark():
+    """
+        Runs benchmarks in temporary work directory, profiles are saved to its .profiles folder.
+        self.results contains {name of benchmark: {'runs': [seconds], 'best': seconds, ...}}
+    """
+
+    def __init__(self, args):
+
+        self.args = args
+        self.results = {}
+        self.work_dir = tempfile.mkdtemp(prefix='carstereoenumerator-bench-')
+        self.path_to_removable_media = os.path.join(self.work_dir, u'media')
+
+    def new_media(self):
+        """
+            Creates fresh media tree (not timed)
+        """
+
+        if os.path.exists(self.path_to_removable_media):
+            shutil.rmtree(self.path_to_removable_media)
+        generate_media_tree(self.path_to_removable_media, self.args.folders, self.args.tracks_per_folder,
+                            self.args.dirty_share, self.args.track_size, self.args.seed)
+
+    def record(self, name, seconds, **extra):
+
+        result = self.results.setdefault(name, {'runs': []})
+        result['runs'].append(seconds)
+        result['best'] = min(result['runs'])
+        result.update(extra)
+
+    def timed(self, name, function, *args, **kwargs):
+        """
+            Calls function once and records its time
+        """
+
+        start = timeit.default_timer()
+        result = function(*args, **kwargs)
+        self.record(name, timeit.default_timer() - start)
+        return result
+
+    def bench_clear_file_names(self):
+
+        self.new_media()
+        scanner = managers.MediaScanner()
+
+        #listing isn't timed, only sanitizing of filenames
+        listings = []
+        for folder in scanner.list_folders(self.path_to_removable_media):
+            path_to_folder = os.path.join(self.path_to_removable_media, folder)
+            entries, file_entries = scanner.list_folder(path_to_folder)
+            listings.append((path_to_folder, [entry.name for entry in file_entries
+                                              if entry.name.endswith(scanner.track_extensions)],
+                             [entry.name for entry in entries]))
+
+        start = timeit.default_timer()
+        for path_to_folder, track_names, entry_names in listings:
+            scanner.clear_file_names(path_to_folder, track_names, entry_names)
+        self.record('clear_file_names', timeit.default_timer() - start)
+
+    def bench_create_new_track_list(self, track_list_filename):
+
+        for scan_threads in sorted(set([1, self.args.scan_threads])):
+
+            self.new_media()
+            manager = managers.TrackListManager()
+            self.timed('create_new_track_list[threads=%d]' % scan_threads, manager.create_new_track_list,
+                       self.path_to_removable_media, track_list_filename, scan_threads=scan_threads)
+
+            self.results['create_new_track_list[threads=%d]' % scan_threads].update(
+                {'stat_calls': manager.scanner.stat_calls, 'stat_calls_saved': manager.scanner.stat_calls_saved})
+
+            #nothing was changed, every folder is taken from track list
+            self.timed('rescan_track_list[unchanged,threads=%d]' % scan_threads, manager.rescan_track_list,
+                       self.path_to_removable_media, track_list_filename, scan_threads=scan_threads)
+
+        return manager
+
+    def bench_save_load(self, manager, track_list_filename):
+
+        #one time migration of pickled track list to database isn't timed
+        if manager.has_store(track_list_filename):
+            manager.open_store(track_list_filename)
+
+        self.timed('save_track_list[%s]' % track_list_filename, manager.save_track_list, track_list_filename)
+
+        loaded_manager = managers.TrackListManager()
+        self.timed('load_track_list[%s]' % track_list_filename, loaded_manager.load_track_list, track_list_filename)
+
+        #memory isn't measured while loading, walking of model would be timed too
+        report = loaded_manager.memory_report()
+        if report != None:
+            self.results['load_track_list[%s]' % track_list_filename].update(
+                {'bytes_per_10k_tracks_as_dictionaries': report[0], 'bytes_per_10k_tracks_as_folder_records': report[1]})
+
+        return loaded_manager
+
+    def bench_mark_toggling(self, manager, track_list_filename):
+
+        toggles = 0
+        start = timeit.default_timer()
+
+        for tr_rec in manager.track_list:
+            #folders after limit aren't loaded, their tracks would be timed too
+            if toggles >= self.args.toggles:
+                break
+            for tr in manager.folder_tracks(tr_rec):
+                if toggles >= self.args.toggles:
+                    break
+                manager.mark_track(track_list_filename, tr_rec['folder_name'], tr, not tr[1])
+                toggles += 1
+
+        seconds = timeit.default_timer() - start
+        self.record('mark_track[%s]' % track_list_filename, seconds, toggles=toggles,
+                    per_toggle=seconds / max(toggles, 1))
+
+        manager.compact_journal(track_list_filename)
+
+    def bench_delete_marked_files(self, manager, track_list_filename):
+        """
+            Times engine of MainScreen.delete_marked_files: staging, saving of track list and purging
+        """
+
+        rnd = random.Random(self.args.seed)
+        for tr_rec in manager.track_list:
+            for tr in manager.folder_tracks(tr_rec):
+                tr[1] = rnd.random() < self.args.delete_share
+        manager.save_track_list(track_list_filename)
+
+        start = timeit.default_timer()
+
+        job = managers.DeletionJob(self.path_to_removable_media, manager.marked_tracks())
+        job.stage()
+        manager.remove_tracks(track_list_filename, job.staged, removed_bytes=job.bytes_by_folder(job.staged))
+        job.purge()
+
+        self.record('delete_marked_files', timeit.default_timer() - start, deleted=job.purged,
+                    failed=len(job.failures))
+
+    def bench_widgets(self, manager, track_list_filename):
+        """
+            Times generating of folder buttons and of track list of the biggest folder on MainScreen
+        """
+
+        from kivy.lang import Builder
+        import main
+
+        Builder.load_file(os.path.join(os.path.dirname(os.path.abspath(main.__file__)), 'carstereoenumerator.kv'))
+
+        profile_manager = managers.ProfileManager()
+        profile_manager.active_profile = {'name': 'benchmark', 'db_name': track_list_filename,
+                                          'path_to_removable_media': self.path_to_removable_media,
+                                          'activate_search': False, 'default_profile': True}
+
+        #MainScreen uses managers which application creates as globals
+        main.manager_of_profile_list = profile_manager
+        main.manager_of_track_list = manager
+
+        screen = main.MainScreen()
+
+        self.timed('generate_folder_buttons', screen.generate_folder_buttons)
+
+        biggest_folder = max(manager.track_list, key=lambda tr_rec: len(manager.folder_tracks(tr_rec)))
+        manager.active_folder = biggest_folder['folder_name']
+        self.timed('generate_track_list_output', screen.generate_track_list_output)
+
+    def run(self):
+
+        os.chdir(self.work_dir)
+
+        try:
+            for repeat in range(self.args.repeat):
+
+                self.bench_clear_file_names()
+
+                manager = self.bench_create_new_track_list('.benchmark.tdb')
+
+                for track_list_filename in ('.benchmark.tdb', '.benchmark.tdbs', '.benchmark.sqlite', '.benchmark.tdbm'):
+                    loaded_manager = self.bench_save_load(manager, track_list_filename)
+                    self.bench_mark_toggling(loaded_manager, track_list_filename)
+
+                    if loaded_manager.store != None:
+                        loaded_manager.store.close()
+
+                if not self.args.no_widgets:
+                    self.bench_widgets(manager, '.benchmark.tdb')
+
+                self.bench_delete_marked_files(manager, '.benchmark.tdb')
+
+                if manager.store != None:
+                    manager.store.close()
+
+        finally:
+            os.chdir(os.path.dirname(os.path.abspath(managers.__file__)))
+            if not self.args.keep:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def report(self):
+        """
+            Returns results with parameters of run
+        """
+
+        return {'app_version': app_version(),
+                'python': sys.version.split()[0],
+                'platform': sys.platform,
+                #without os.scandir and scandir backport types of entries aren't known from listing
+                #and stat_calls_saved stays 0
+                'scandir': scandir_implementation(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'parameters': {'folders': self.args.folders,
+                               'tracks_per_folder': self.args.tracks_per_folder,
+                               'dirty_share': self.args.dirty_share,
+                               'track_size': self.args.track_size,
+                               'scan_threads': self.args.scan_threads,
+                               'repeat': self.args.repeat},
+                'results': self.results}
+
+def scandir_implementation():
+    """
+        Returns module of scandir used by MediaScanner, 'os.listdir' if it falls back to listdir_scandir
+    """
+
+    if managers.scandir is managers.listdir_scandir:
+        return 'os.listdir'
+    return managers.scandir.__module__
+
+def app_version():
+    """
+        Returns version of application from buildozer.spec
+    """
+
+    path_to_spec = os.path.join(os.path.dirname(os.path.abspath(managers.__file__)), 'buildozer.spec')
+    if os.path.exists(path_to_spec):
+        for line in open(path_to_spec):
+            if line.startswith('version ='):
+                return line.split('=', 1)[1].strip()
+    return None
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmarks of car stereo enumerator on synthetic removable media')
+    parser.add_argument('--folders', type=int, default=100, help='count of top level folders')
+    parser.add_argument('--tracks-per-folder', type=int, default=100, help='count of tracks in every folder')
+    parser.add_argument('--dirty-share', type=float, default=0.2,
+                        help='share of tracks with not allowed characters in filenames')
+    parser.add_argument('--track-size', type=int, default=1024, help='size of every track in bytes')
+    parser.add_argument('--scan-threads', type=int, default=4, help='threads of parallel scan')
+    parser.add_argument('--toggles', type=int, default=1000, help='count of toggled delete marks')
+    parser.add_argument('--delete-share', type=float, default=0.1, help='share of deleted tracks')
+    parser.add_argument('--repeat', type=int, default=3, help='count of runs, best time is reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed of random filenames')
+    parser.add_argument('--no-widgets', action='store_true', help="don't time MainScreen widgets")
+    parser.add_argument('--keep', action='store_true', help="don't remove work directory")
+    parser.add_argument('--output', default='-', help='file for JSON results, - is stdout')
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    benchmark = Benchmark(args)
+    benchmark.run()
+
+    output = json.dumps(benchmark.report(), indent=2, sort_keys=True)
+
+    if args.output == '-':
+        print(output)
+    else:
+        f = open(args.output, 'w')
+        f.write(output)
+        f.close()
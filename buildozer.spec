@@ -23,6 +23,7 @@ source.exclude_dirs = tests, bin, .profiles
 
 # (list) List of exclusions using pattern matching
 #source.exclude_patterns = license,images/*/*.jpg
+source.exclude_patterns = benchmark.py,cli.py
 
 # (str) Application versioning (method 1)
 #version.regex = __version__ = ['"](.*)['"]
@@ -33,7 +34,7 @@ version = 0.1.0
 
 # (list) Application requirements
 # comma seperated e.g. requirements = sqlite3,kivy
-requirements = kivy
+requirements = sqlite3,scandir,kivy
 
 # (list) Garden requirements
 #garden_requirements =
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Command line interface of car stereo enumerator, works without Kivy.
+
+    Runs command for every given profile (or every profile if none is given). Profiles of different
+    removable media are processed at the same time by --jobs threads, profiles of the same removable
+    media one after another. Results are written as JSON (stats also as CSV).
+
+    Commands:
+        scan        scans changed folders again (or every folder with --full), sanitizes filenames
+        sanitize    removes not allowed characters from filenames, updates track list of renamed folders
+                    (--dry-run only reports planned renames)
+        stats       exports count of folders, tracks, marked tracks and size of tracks
+        purge       deletes tracks marked to delete (--dry-run only counts them)
+        duplicates  finds tracks with the same content (--mark marks all copies but one to delete)
+        convert     converts track database to other format (--to tdbm is memory mapped snapshot,
+                    --to tdb exports pickled track list without switching profile to it)
+        sync        copies new and changed tracks of local library (--source or source library of profile)
+                    into top level folders of removable media (--prune also removes tracks not in library)
+        renumber    writes numbers of tracks in order of track list into prefixes of filenames
+                    (--folder limits it to given folders, --dry-run only reports planned renames)
+
+    Usage:
+        python cli.py --profiles ./.profiles --jobs 8 scan stick1 stick2
+        python cli.py stats --format csv --per-folder --output stats.csv
+        python cli.py purge --dry-run
+        python cli.py sync --source ~/Music --hashes stick1
+"""
+
+import os, sys, csv, json, logging, argparse, threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from managers import ProfileManager, TrackListManager, MediaScanner, DeletionJob
+
+class BatchRunner():
+    """
+        Runs command of args for profiles.
+        self.results contains list of dictionaries {'profile', 'path_to_removable_media', 'ok', 'error', ...}
+        in order of profiles.
+    """
+
+    def __init__(self, args):
+
+        self.args = args
+        self.path_to_profiles = args.profiles
+        self.results = []
+
+    def select_profiles(self, profile_manager, profile_names):
+        """
+            Returns profiles with given names, every profile if no names are given
+        """
+
+        if not profile_names:
+            return list(profile_manager.list_of_profiles)
+
+        profiles = []
+        for profile_name in profile_names:
+            profile = profile_manager.get_profile(profile_name)
+            if profile == {}:
+                raise ValueError('profile %s does not exist' % profile_name)
+            profiles.append(profile)
+        return profiles
+
+    def load_track_list(self, profile):
+        """
+            Returns TrackListManager with loaded track list of profile, or None if it wasn't scanned yet
+        """
+
+        manager = TrackListManager()
+        if not manager.track_list_exists(profile['db_name'], self.path_to_profiles):
+            return None
+
+        manager.load_track_list(profile['db_name'], self.path_to_profiles)
+        return manager
+
+    def scan(self, profile):
+
+        manager = TrackListManager()
+        scan_threads = profile.get('scan_threads', ProfileManager.default_scan_threads)
+
+        if not self.args.full and manager.track_list_exists(profile['db_name'], self.path_to_profiles):
+            manager.load_track_list(profile['db_name'], self.path_to_profiles)
+            scanned = manager.rescan_track_list(profile['path_to_removable_media'], profile['db_name'],
+                                                path_to_profiles=self.path_to_profiles, scan_threads=scan_threads)
+        else:
+            scanned = manager.create_new_track_list(profile['path_to_removable_media'], profile['db_name'],
+                                                    path_to_profiles=self.path_to_profiles, scan_threads=scan_threads)
+
+        return manager, {'ok': scanned, 'folders': len(manager.track_list),
+                         'stat_calls': manager.scanner.stat_calls}
+
+    def sanitize(self, profile):
+
+        path_to_removable_media = unicode(profile['path_to_removable_media'])
+
+        scanner = MediaScanner()
+        renamed = 0
+        renamed_folders = set()
+        report = []
+        failures = []
+
+        for folder_name in scanner.list_folders(path_to_removable_media):
+
+            path_to_folder = os.path.join(path_to_removable_media, folder_name)
+            entries, file_entries = scanner.list_folder(path_to_folder)
+            track_names = [entry.name for entry in file_entries if entry.name.endswith(scanner.track_extensions)]
+
+            plan = scanner.plan_renames(path_to_folder, track_names, [entry.name for entry in entries])
+            if plan.renames == []:
+                continue
+
+            report.extend(os.path.join(folder_name, line) for line in plan.report())
+
+            if self.args.dry_run:
+                continue
+
+            if plan.apply():
+                renamed += len(plan.renames)
+                renamed_folders.add(folder_name)
+            else:
+                failures.extend({'path': path, 'error': error} for path, error in plan.failures)
+
+        if self.args.dry_run:
+            return None, {'ok': True, 'renames': report}
+
+        #track list is updated only for folders with renamed tracks
+        manager = self.load_track_list(profile)
+        if manager != None:
+            manager.apply_folder_changes(path_to_removable_media, profile['db_name'], renamed_folders,
+                                         path_to_profiles=self.path_to_profiles)
+
+        return manager, {'ok': not failures, 'renamed': renamed, 'folders': len(renamed_folders),
+                         'failures': failures}
+
+    def stats(self, profile):
+
+        manager = self.load_track_list(profile)
+        if manager == None:
+            return None, {'ok': False, 'error': 'track list was not scanned yet'}
+
+        #counters are stored with track database, tracks of folders aren't loaded
+        tracks, marked, size = manager.profile_stats()
+        result = {'ok': True, 'folders': len(manager.track_list), 'tracks': tracks, 'marked': marked, 'bytes': size}
+
+        if self.args.per_folder:
+            result['per_folder'] = []
+            for tr_rec in manager.track_list:
+                tracks, marked, size = manager.folder_stats(tr_rec)
+                result['per_folder'].append({'folder_name': tr_rec['folder_name'], 'tracks': tracks,
+                                             'marked': marked, 'bytes': size})
+
+        return manager, result
+
+    def purge(self, profile):
+
+        manager = self.load_track_list(profile)
+        if manager == None:
+            return None, {'ok': False, 'error': 'track list was not scanned yet'}
+
+        marked_tracks = manager.marked_tracks()
+        if self.args.dry_run:
+            return manager, {'ok': True, 'marked': len(marked_tracks), 'deleted': 0}
+
+        job = DeletionJob(profile['path_to_removable_media'], marked_tracks)
+        job.stage()
+
+        #track list is saved once for all moved tracks before files are deleted
+        manager.remove_tracks(profile['db_name'], job.staged, self.path_to_profiles,
+                              removed_bytes=job.bytes_by_folder(job.staged))
+        job.purge()
+
+        return manager, {'ok': not job.failures, 'marked': len(marked_tracks), 'deleted': job.purged,
+                         'failures': [{'path': path, 'error': error} for path, error in job.failures]}
+
+    def duplicates(self, profile):
+
+        manager = self.load_track_list(profile)
+        if manager == None:
+            return None, {'ok': False, 'error': 'track list was not scanned yet'}
+
+        finder = manager.find_duplicates(profile['path_to_removable_media'], profile['db_name'],
+                                         path_to_profiles=self.path_to_profiles,
+                                         hash_threads=profile.get('scan_threads'))
+
+        result = {'ok': True, 'duplicate_bytes': finder.duplicate_bytes, 'files_read': finder.files_read,
+                  'groups': [[os.path.join(folder_name, track_name) for folder_name, track_index, track_name in group]
+                             for group in finder.groups]}
+
+        if self.args.mark:
+            result['marked'] = manager.mark_duplicates(profile['db_name'], finder.groups, self.path_to_profiles)
+
+        return manager, result
+
+    def convert(self, profile):
+
+        manager = TrackListManager()
+        if not manager.track_list_exists(profile['db_name'], self.path_to_profiles):
+            return None, {'ok': False, 'error': 'track list was not scanned yet'}
+
+        new_db_name = os.path.splitext(profile['db_name'])[0] + '.' + self.args.to
+        if new_db_name == profile['db_name']:
+            return None, {'ok': True, 'db_name': new_db_name, 'folders': 0}
+
+        folders = manager.convert_database(profile['db_name'], new_db_name, self.path_to_profiles)
+
+        #pickled track list is only export, profile keeps its database
+        if self.args.to != 'tdb':
+            profile['db_name'] = new_db_name
+
+        return manager, {'ok': True, 'db_name': new_db_name, 'folders': folders}
+
+    def sync(self, profile):
+
+        path_to_source_library = self.args.source or profile.get('path_to_source_library')
+        if not path_to_source_library or not os.path.isdir(path_to_source_library):
+            return None, {'ok': False, 'error': 'source library not found'}
+
+        #tracks which are on removable media already keep their delete marks
+        manager = self.load_track_list(profile)
+        if manager == None:
+            manager = TrackListManager()
+            manager.create_new_track_list(profile['path_to_removable_media'], profile['db_name'],
+                                          path_to_profiles=self.path_to_profiles,
+                                          scan_threads=profile.get('scan_threads', ProfileManager.default_scan_threads))
+
+        sync = manager.sync_library(path_to_source_library, profile['path_to_removable_media'], profile['db_name'],
+                                    path_to_profiles=self.path_to_profiles, copy_threads=self.args.threads,
+                                    compare_hashes=self.args.hashes, prune=self.args.prune)
+
+        return manager, {'ok': not sync.failures, 'tracks': len(sync.plan), 'copied': len(sync.copied),
+                         'bytes_copied': sync.bytes_copied, 'pruned': len(sync.pruned),
+                         'failures': [{'path': path, 'error': error} for path, error in sync.failures]}
+
+    def renumber(self, profile):
+
+        manager = self.load_track_list(profile)
+        if manager == None:
+            return None, {'ok': False, 'error': 'track list was not scanned yet'}
+
+        plans = manager.renumber_tracks(profile['path_to_removable_media'], profile['db_name'], self.args.folder,
+                                        self.path_to_profiles, self.args.dry_run)
+
+        report = []
+        for plan in plans:
+            folder_name = os.path.basename(plan.path_to_folder)
+            report.extend(os.path.join(folder_name, line) for line in plan.report())
+
+        if self.args.dry_run:
+            return manager, {'ok': True, 'renames': report}
+
+        failures = [{'path': path, 'error': error} for plan in plans for path, error in plan.failures]
+        return manager, {'ok': not failures, 'renamed': sum(len(plan.renames) for plan in plans if plan.rollback_log),
+                         'folders': sum(1 for plan in plans if plan.rollback_log), 'failures': failures}
+
+    def run_profile(self, profile):
+        """
+            Runs command for one profile, returns its result
+        """
+
+        result = {'profile': profile['name'], 'path_to_removable_media': profile['path_to_removable_media']}
+
+        if not os.path.isdir(profile['path_to_removable_media']):
+            result.update({'ok': False, 'error': 'removable media not found'})
+            return result
+
+        manager = None
+        try:
+            manager, command_result = getattr(self, self.args.command)(profile)
+            result.update(command_result)
+
+        except Exception as exception:
+            logging.exception('%s of profile %s failed' % (self.args.command, profile['name']))
+            result.update({'ok': False, 'error': str(exception)})
+
+        finally:
+            if manager != None and manager.store != None:
+                manager.store.close()
+
+        return result
+
+    def run(self, profile_names):
+
+        profile_manager = ProfileManager(self.path_to_profiles)
+        profiles = self.select_profiles(profile_manager, profile_names)
+
+        #profiles of the same removable media are processed by one thread one after another
+        groups = {}
+        for index, profile in enumerate(profiles):
+            groups.setdefault(os.path.realpath(profile['path_to_removable_media']), []).append(index)
+
+        groups_queue = queue.Queue()
+        for indexes in groups.values():
+            groups_queue.put(indexes)
+
+        results = [None] * len(profiles)
+
+        def worker():
+            while True:
+                try:
+                    indexes = groups_queue.get_nowait()
+                except queue.Empty:
+                    return
+                for index in indexes:
+                    results[index] = self.run_profile(profiles[index])
+                    logging.info('%s: %s %s' % (profiles[index]['name'], self.args.command,
+                                                'done' if results[index]['ok'] else 'failed'))
+
+        threads = [threading.Thread(target=worker) for i in range(max(1, min(self.args.jobs, len(groups))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.results = results
+
+        #profiles which database was converted are switched to it
+        if self.args.command == 'convert':
+            profile_manager.save_profiles()
+
+        return all(result['ok'] for result in results)
+
+    def write_results(self, f):
+
+        if self.args.command == 'stats' and self.args.format == 'csv':
+            self.write_stats_csv(f)
+        else:
+            f.write(json.dumps(self.results, indent=2, sort_keys=True) + '\n')
+
+    def write_stats_csv(self, f):
+        """
+            Writes row per profile, or per folder with --per-folder
+        """
+
+        writer = csv.writer(f)
+
+        if self.args.per_folder:
+            writer.writerow(['profile', 'folder_name', 'tracks', 'marked', 'bytes'])
+            for result in self.results:
+                for folder in result.get('per_folder', []):
+                    writer.writerow([result['profile'].encode('utf-8'), folder['folder_name'].encode('utf-8'),
+                                     folder['tracks'], folder['marked'], folder['bytes']])
+        else:
+            writer.writerow(['profile', 'path_to_removable_media', 'folders', 'tracks', 'marked', 'bytes', 'error'])
+            for result in self.results:
+                writer.writerow([result['profile'].encode('utf-8'), result['path_to_removable_media'].encode('utf-8'),
+                                 result.get('folders', ''), result.get('tracks', ''), result.get('marked', ''),
+                                 result.get('bytes', ''), result.get('error', '')])
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description='Car stereo enumerator without user interface')
+    parser.add_argument('--profiles', default='./.profiles', help='folder with profiles')
+    parser.add_argument('--jobs', type=int, default=4, help='count of removable media processed at the same time')
+    parser.add_argument('--output', default='-', help='file for results, - is stdout')
+    parser.add_argument('--verbose', '-v', action='store_true', help='log progress to stderr')
+
+    commands = parser.add_subparsers(dest='command')
+
+    scan = commands.add_parser('scan', help='scan removable media of profiles and sanitize filenames')
+    scan.add_argument('--full', action='store_true', help='scan every folder again, delete marks are lost')
+
+    sanitize = commands.add_parser('sanitize', help='remove not allowed characters from filenames')
+    sanitize.add_argument('--dry-run', action='store_true', help="only report planned renames")
+
+    stats = commands.add_parser('stats', help='export count of folders, tracks, marked tracks and size of tracks')
+    stats.add_argument('--format', choices=['json', 'csv'], default='json')
+    stats.add_argument('--per-folder', action='store_true', help='also count tracks of every folder')
+
+    purge = commands.add_parser('purge', help='delete tracks marked to delete')
+    purge.add_argument('--dry-run', action='store_true', help="only count marked tracks, don't delete them")
+
+    duplicates = commands.add_parser('duplicates', help='find tracks with the same content')
+    duplicates.add_argument('--mark', action='store_true', help='mark every copy but one to delete')
+
+    convert = commands.add_parser('convert', help='convert track database to other format')
+    convert.add_argument('--to', choices=['tdbs', 'tdbm', 'sqlite', 'tdb'], required=True,
+                         help='tdbs - shards, tdbm - memory mapped snapshot, sqlite - sqlite, tdb - pickle export')
+
+    sync = commands.add_parser('sync', help='copy new and changed tracks of local library onto removable media')
+    sync.add_argument('--source', help='path to library, source library of profile by default')
+    sync.add_argument('--threads', type=int, default=None, help='count of files copied at the same time')
+    sync.add_argument('--hashes', action='store_true', help='compare files with other mtime by content')
+    sync.add_argument('--prune', action='store_true', help='remove tracks of synced folders which are not in library')
+
+    renumber = commands.add_parser('renumber', help='write numbers of tracks into prefixes of filenames')
+    renumber.add_argument('--folder', action='append', help='folder to renumber, every folder by default')
+    renumber.add_argument('--dry-run', action='store_true', help="only report planned renames")
+
+    for command in (scan, sanitize, stats, purge, duplicates, convert, sync, renumber):
+        command.add_argument('profile_names', nargs='*', metavar='PROFILE', help='names of profiles, every profile by default')
+
+    return parser.parse_args(argv)
+
+def main(argv=None):
+
+    args = parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    runner = BatchRunner(args)
+    try:
+        ok = runner.run(args.profile_names)
+    except ValueError as exception:
+        sys.stderr.write('%s\n' % exception)
+        return 2
+
+    if args.output == '-':
+        runner.write_results(sys.stdout)
+    else:
+        f = open(args.output, 'w')
+        runner.write_results(f)
+        f.close()
+
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
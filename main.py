@@ -10,7 +10,7 @@ from kivy.uix.button import Button
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.gridlayout import GridLayout
 from kivy.factory import Factory
-from kivy.properties import (ObjectProperty, ListProperty, StringProperty)
+from kivy.properties import (ObjectProperty, ListProperty, StringProperty, NumericProperty)
 from kivy.uix.popup import Popup
 from kivy.uix.scrollview import ScrollView
 from kivy.uix.textinput import TextInput
@@ -18,316 +18,57 @@ from kivy.clock import Clock
 from functools import partial
 from kivy.logger import Logger
 from kivy.uix.behaviors import ButtonBehavior
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.effects.scroll import ScrollEffect
+from kivy.utils import escape_markup
 
-import os, glob, pickle, string
+import os, threading
 
-class ProfileManager():
-    
-    """
-        self.list_of_profiles contains list of dictionaries with 
-        the following structure:
-        ('name' : string                      # name of the profile, 
-         'db_name' : string                   # name of file with the database of tracks,
-         'path_to_removable_media' : string   # path to removable media
-         'activate_search' : boolean          # if true, default track list output is search, else is list of tracks
-         'default_profile' : boolean          # usually last used profile should be loaded by default)
-    """
-    
-    def __init__(self,path_to_profiles='./.profiles'):
-        
-        self.active_profile = {}
-        self.load_profiles()
-
-    def profiles_path_exists(self, path_to_profiles='./.profiles'):
-        
-        """
-            Checks existence of profile directory and try to create it if not.
-        """
-        if not os.path.exists(path_to_profiles) or not os.path.isdir(path_to_profiles):
-            
-            try:
-                os.makedirs(path_to_profiles)
-                return True
-            
-            except OSError as exception:
-                if exception.errno != errno.EEXIST:
-                    raise
-                return False
-        else:
-            return True
-
-    def load_profiles(self, path_to_profiles='./.profiles', profile_filename='.profilelist.pfl'):
-        """
-            Loads profile from file
-        """
+from managers import (instrumentation, instrumented, ProfileManager, TrackListManager, MediaWatcher, DeletionJob,
+                      SaveScheduler, stats_text, format_size)
 
-        if self.profiles_path_exists(path_to_profiles):
-            
-            if os.path.exists(os.path.join(path_to_profiles,profile_filename)):
-                
-                f = open(os.path.join(path_to_profiles,profile_filename),'rb')
-                self.list_of_profiles = pickle.load(f)
-                f.close()
-            
-            else:
-                self.list_of_profiles = []
-    
-    def save_profiles(self, path_to_profiles='./.profiles', profile_filename='.profilelist.pfl'):
-        """
-            Saves profile to file 
-        """
-        if self.profiles_path_exists(path_to_profiles):
-            
-            f = open(os.path.join(path_to_profiles,profile_filename),'wb+')
-            pickle.dump(self.list_of_profiles,f)
-            f.close()
-    
-    def create_new_profile(self, profile_name, path_to_removable_media, path_to_profiles='./.profiles'):
-        """
-            Creates new profile:
-                profile_name: string               #name of profile
-                path_to_removable_media: string:   #path to folder with tracks to manage
-        """
-
-        #Make every profile not default, last loaded profile (in this case is new one) will become default.
-        for prof in self.list_of_profiles:
-            prof['default_profile'] = False
-        
-        #Adding new profile
-        self.list_of_profiles.append({'name' : profile_name,
-                                      'db_name' : '.' + profile_name + '.tdb',
-                                      'path_to_removable_media' : path_to_removable_media,
-                                      'default_profile' : True,
-                                      'activate_search' : False})
-        self.save_profiles()
+class CLabel(ButtonBehavior, Label):
+    bgcolor = ListProperty([0,0,0])
 
-    def delete_profile(self, profile_name):
-        """
-            Deletes profile
-        """
-        #Using list slice [:] to have list bu value, not pointer to it.
-        self.list_of_profiles[:] = [tup for tup in self.list_of_profiles if tup['name'] != profile_name]
-        self.save_profiles()
+class TrackRow(RecycleDataViewBehavior, CLabel):
+    """
+        Label of one track in TrackRecycleView. Labels are reused for different tracks while scrolling,
+        text, bgcolor, track_index and track_name are taken from data of recycle view.
+    """
+    track_index = NumericProperty(0)
+    track_name = StringProperty('')
 
-    def get_profile(self, profile_name):
-        """
-            Returns profile by name
-        """
-        profile = {}
-        
-        for current_profile in self.list_of_profiles:
-            if current_profile['name'] == profile_name:
-                profile = current_profile
-        return profile
+    def on_release(self):
+        App.get_running_app().root.get_screen('mainscreen').mark_track_in_list(self.track_index, self.track_name, self)
 
-    def get_default_profile(self):
-        """
-            Returns default profile
-        """
-        profile = {}
-        
-        for current_profile in self.list_of_profiles:
-            if current_profile['default_profile'] == True:
-                profile = current_profile
-        return profile
+class TrackRecycleView(RecycleView):
+    pass
 
-class TrackListManager():
+class FolderButton(RecycleDataViewBehavior, Button):
     """
-        self.track_list contains list of dictionaries with 
-        the following structure:
-        ('folder_name' : string               # name of the folder, containig tracks, 
-         'tracks' : list                      # list of lists with the following structure:
-                                                ['filename of track':string, 'delete_mark':boolean]
+        Button of one folder in FolderRecycleView, buttons are reused for different folders while scrolling
+        and filtering, text (name and counters of folder) and folder_name are taken from data of recycle view.
     """
-    
-    def __init__(self, path_to_profiles='./.profiles/'):
-        
-        self.active_folder = ''
-        self.track_list = []
-
-    def profiles_path_exists(self, path_to_profiles='./.profiles'):
-        """
-            Checks existence of profile directory and try to create it if not.
-        """
-        
-        if not os.path.exists(path_to_profiles) or not os.path.isdir(path_to_profiles):
-            
-            try:
-                
-                os.makedirs(path_to_profiles)
-                return True
-            
-            except OSError as exception:
-                
-                if exception.errno != errno.EEXIST:
-                    raise
-                
-                return False
-        
-        else:
-            return True
-        
-    def create_new_track_list(self, path_to_removable_media, track_list_filename, 
-                              screenmanager_widget,  path_to_profiles='./.profiles'):
-        """
-            Creates new track list. 
-                path_to_removable_media: string              #path to folder with manageble tracks
-                track_list_filename: string                  #file where track list will be saved
-                screenmanager_widget: ScreenManager object   #if passed screen with loading progress will be shown
-        """
+    folder_name = StringProperty('')
 
+    def on_release(self):
+        App.get_running_app().root.get_screen('mainscreen').generate_track_view(self)
 
-        def clear_file_names(path_to_removable_media):
-            """
-                function clears tracks' filenames from not allowed characters
-            """
-
-            #allowed_chars contains allowed for filenames characters in unicode
-            allowed_chars = string.digits + string.letters + '.- '
-            allowed_chars = unicode(allowed_chars)
-            allowed_chars = allowed_chars + u'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя'
-            
-            path_to_removable_media = unicode(path_to_removable_media)
-            
-            if os.path.exists(path_to_removable_media):
-
-                #iterating only top level folders (car stereo can't see more deep hierarchy)
-                for folder in os.listdir(path_to_removable_media):
-                    
-                    path = os.path.join(path_to_removable_media, folder)
-                    if os.path.isdir(path):
-
-                        #iterating tracks in folder:
-                        for track in os.listdir(path):
-                            
-                            new_file_name = track
-                            
-                            if new_file_name.endswith(('.mp3','.wav','.aac','.flac','.wma'),) and \
-                            os.path.isfile(os.path.join(path, track)):
-
-                                #remove every not allowed character from filename
-                                new_file_name = filter(allowed_chars.__contains__, new_file_name)
-                                
-                                #if there was not allowed characters, should rename track
-                                if new_file_name <> track:
-
-                                    previous_path_to_file = os.path.join(path, track)
-                                    
-                                    new_path_to_file = os.path.join(path, new_file_name)
-                                    
-                                    #checking another file haven't same file name after deleting not allowed characters
-                                    while os.path.exists(new_path_to_file):
-
-                                        #split filename and extension
-                                        tmp_file_name, tmp_file_extension = os.path.splitext(new_path_to_file)
-                                        new_path_to_file = tmp_file_name + u'-RENAMED' + tmp_file_extension
-                                                                            
-                                    os.rename(previous_path_to_file, new_path_to_file)
-
-######################End of clear_file_names()###################################################################################################                            
-
-        #if passed screen with loading progress will be shown
-        if screenmanager_widget != None:
-            show_load_widget = True
-            trackscanscreen = screenmanager_widget.get_screen('trackscanscreen')
-
-        path_to_removable_media = unicode(path_to_removable_media)
-
-        if self.profiles_path_exists(path_to_profiles):
-            if os.path.exists(path_to_removable_media):
-                
-                if show_load_widget:
-                    screenmanager_widget.current = 'trackscanscreen'
-
-                #delete not allowed characters from filenames
-                clear_file_names(path_to_removable_media)
-                
-
-                #Collecting folders for progress bar:
-                for folder in os.listdir(path_to_removable_media):
-                    path = os.path.join(path_to_removable_media, folder)
-                    if os.path.isdir(path):
-                        self.track_list.append({'folder_name':folder, 'tracks':[]})
-                
-                #Progress bar:
-                if show_load_widget:
-                    trackscanscreen.ids.progress_bar_scan.max = len(self.track_list)
-                
-                #Iterating collected folders:
-                for element in self.track_list:
-
-                    if show_load_widget:
-                        trackscanscreen.ids.trackscanscreen_current_scanning_folder.text = \
-                        'Now scanning: ' + path_to_removable_media + element['folder_name']
-                        trackscanscreen.ids.progress_bar_scan.value = self.track_list.index(element)
-
-                    current_folder_tracks = []
-                    current_path = os.path.join(path_to_removable_media, element['folder_name'])
-                    
-                    #Collecting tracks:
-                    for track in os.listdir(current_path):
-                        
-                        #Need only musical files with certain extensions                        
-                        if track.endswith(('.mp3','.wav','.aac','.flac','.wma'),) and \
-                        os.path.isfile(os.path.join(current_path, track)):
-
-                            current_folder_tracks.append([track, False])
-                    #Adding list of tracks to dict {'folder_name':string, 'tracks':[]}
-                    element['tracks'] = current_folder_tracks
-
-                #save tracks structure
-                self.save_track_list(track_list_filename)
-
-                #return True will stop bubbling on_release event 
-                return True
-               
-
-    def save_track_list(self, track_list_filename, path_to_profiles='./.profiles'):
-        """
-            Saves track list structure to track_list_filename
-        """
-
-        if self.profiles_path_exists(path_to_profiles):
-            f = open(os.path.join(path_to_profiles,track_list_filename),'wb+')
-            pickle.dump(self.track_list,f)
-            f.close()
-
-    def load_track_list(self, track_list_filename, path_to_profiles='./.profiles'):
-        """
-            Loads track list structure from track_list_filename
-        """
-        
-        if self.profiles_path_exists(path_to_profiles):
-            if os.path.exists(os.path.join(path_to_profiles,track_list_filename)):
-                f = open(os.path.join(path_to_profiles,track_list_filename),'rb')
-                self.track_list = pickle.load(f)
-                f.close()
+class FolderRecycleView(RecycleView):
+    pass
 
-    def choose_tracklist(self, track_list_filename, path_to_removable_media,
-                        screenmanager_widget=None, path_to_profiles='./.profiles'):
-        """
-            If tracks structure earlier was scanned and save - loads it, else creating new one and saving it.
-            Handler for button_profile_ok on ProfileScreen
-        """
-        if self.profiles_path_exists(path_to_profiles):
-            
-            if os.path.exists(os.path.join(path_to_profiles,track_list_filename)):
-                self.load_track_list(track_list_filename)
-            else:
-                self.create_new_track_list(path_to_removable_media,track_list_filename, screenmanager_widget)
+class SearchResultRow(TrackRow):
+    """
+        Label of one found track in SearchRecycleView, result_index is index of track in MainScreen.search_results
+    """
+    result_index = NumericProperty(0)
 
-    def get_current_tracklist_in_folder_name(self, folder_name):
-        """
-            Returns tracks structure ([track_filename:String, mark_to_delete:Boolean]) for folder_name
-        """
-        
-        for tr_rec in self.track_list:
-            if tr_rec['folder_name'] == folder_name:
-                return tr_rec['tracks']
-        return []
+    def on_release(self):
+        App.get_running_app().root.get_screen('mainscreen').mark_search_result(self.result_index, self)
 
-class CLabel(ButtonBehavior, Label):
-    bgcolor = ListProperty([0,0,0])
+class SearchRecycleView(RecycleView):
+    pass
 
 class DigitInput(TextInput):
     """
@@ -347,20 +88,106 @@ class BaseScreenManager(ScreenManager):
     pass
 
 class TrackScanScreen(Screen):
-    pass
+    """
+        Screen with progress of scanning removable media. Scanning runs in worker thread,
+        widgets are updated only from main thread through Clock.
+    """
+
+    def __init__(self,**kwargs):
+
+        super(TrackScanScreen,self).__init__(**kwargs)
+
+        #set by Cancel button, checked by worker before scanning of every folder
+        self.cancel_event = threading.Event()
+        self.scan_thread = None
+
+    def start_scan(self, path_to_removable_media, track_list_filename, rescan=False, scan_threads=1):
+        """
+            Shows this screen and starts scanning of removable media in worker thread.
+            When scan is finished (or cancelled) switches to mainscreen.
+                rescan: boolean     #if true, only changed folders are scanned again
+                scan_threads: int   #count of folders scanned at the same time
+        """
+
+        #only one scan at a time
+        if self.scan_thread != None and self.scan_thread.is_alive():
+            return
+
+        self.cancel_event.clear()
+
+        self.ids.trackscanscreen_header.text = 'Scanning removable media'
+        self.ids.trackscanscreen_current_scanning_folder.text = ''
+        self.ids.progress_bar_scan.value = 0
+        self.manager.current = 'trackscanscreen'
+
+        #scan replaces track list, changes of removable media are applied after it
+        watcher_of_removable_media.pause()
+
+        self.scan_thread = threading.Thread(target=self.scan_worker,
+                                            args=(path_to_removable_media, track_list_filename, rescan,
+                                                  scan_threads))
+        #scan shouldn't keep application alive after its window is closed
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+
+    def scan_worker(self, path_to_removable_media, track_list_filename, rescan, scan_threads):
+        """
+            Runs in worker thread
+        """
+
+        try:
+            result = manager_of_track_list.create_new_track_list(path_to_removable_media, track_list_filename,
+                                                                 self.post_progress, rescan=rescan,
+                                                                 cancel_event=self.cancel_event,
+                                                                 scan_threads=scan_threads)
+        except Exception:
+            Logger.exception('TrackScanScreen: scan of %s failed' % path_to_removable_media)
+            result = False
+
+        Clock.schedule_once(partial(self.scan_finished, result))
+
+    def post_progress(self, index, count, path_to_folder):
+        """
+            Progress callback of create_new_track_list, called in worker thread
+        """
+
+        Clock.schedule_once(partial(self.show_progress, index, count, path_to_folder))
+
+    def show_progress(self, index, count, path_to_folder, *args):
+
+        self.ids.progress_bar_scan.max = count
+        self.ids.progress_bar_scan.value = index
+        self.ids.trackscanscreen_current_scanning_folder.text = 'Now scanning: ' + path_to_folder
+
+    def cancel_scan(self):
+        """
+            Handler for button_cancel_scan
+        """
+
+        self.ids.trackscanscreen_header.text = 'Cancelling..'
+        self.cancel_event.set()
+
+    def scan_finished(self, result, *args):
+
+        self.ids.progress_bar_scan.value = self.ids.progress_bar_scan.max
+
+        watcher_of_removable_media.resume()
+
+        #on_pre_enter of main screen will show folder buttons
+        self.manager.current = 'mainscreen'
 
 class MainScreen(Screen):
 
+    #count of tracks shown by search
+    search_limit = 100
+
     def __init__(self,**kwargs):
         
         super(MainScreen,self).__init__(**kwargs)
         
-        #used to show count of tracks in folder
+        #used to show count of folders, counters of tracks are kept by track list
         self.total_counter = 0
 
-        #used to show number of tracks marked for deleting
-        self.marked_to_del = 0
-
         #background color of Clabel object wich showing tracks marked for delete
         self.bgcolor_marked = [1,.6,.2]
         #text color of Clabel object wich showing tracks marked for delete
@@ -371,6 +198,28 @@ class MainScreen(Screen):
         #text color of Clabel object wich showing tracks NOT marked for delete
         self.textcolor_marked = [0,0,0]
         self.textcolor = [.5,.5,.5]
+
+        #TrackRecycleView of list view, created when first folder is opened
+        self.track_recycle_view = None
+
+        #widgets of folder view, created when folders are shown first time
+        self.folder_view = None
+        self.folder_filter_input = None
+        self.folder_recycle_view = None
+
+        #data of every folder button with lower case folder names for filter, built for folders_version of
+        #track list which is shown
+        self.folder_data = []
+        self.folder_keys = []
+        self.folder_data_version = None
+
+        #widgets of search view, created when search is shown first time
+        self.search_view = None
+        self.search_input = None
+        self.search_recycle_view = None
+
+        #(folder_name, index_of_track_in_folder, trackname) of tracks shown by search
+        self.search_results = []
     
     def on_pre_enter(self):
 
@@ -384,6 +233,63 @@ class MainScreen(Screen):
         if manager_of_profile_list.active_profile != {}:
             manager_of_track_list.active_folder = ''
             self.generate_folder_buttons()
+            self.watch_removable_media()
+
+    def watch_removable_media(self):
+        """
+            Starts MediaWatcher on removable media of active profile (if profile allows it)
+        """
+
+        profile = manager_of_profile_list.active_profile
+
+        if not profile.get('watch_removable_media', True):
+            watcher_of_removable_media.stop()
+            return
+
+        watcher_of_removable_media.watch(profile['path_to_removable_media'], self.post_media_changes,
+                                         manager_of_track_list.folder_fingerprints)
+
+    def post_media_changes(self, folder_names, list_root):
+        """
+            Callback of MediaWatcher, called in watcher thread
+        """
+
+        Clock.schedule_once(partial(self.apply_media_changes, folder_names, list_root))
+
+    def apply_media_changes(self, folder_names, list_root, *args):
+        """
+            Applies changes of removable media to track list and updates shown folders or tracks
+        """
+
+        #scan or deletion started after changes were posted
+        if watcher_of_removable_media.is_paused():
+            watcher_of_removable_media.add_changes(folder_names, list_root)
+            return
+
+        #changes of removable media of previous profile
+        profile = manager_of_profile_list.active_profile
+        if profile == {} or \
+        unicode(profile['path_to_removable_media']) != watcher_of_removable_media.path_to_removable_media:
+            return
+
+        if not manager_of_track_list.apply_folder_changes(profile['path_to_removable_media'], profile['db_name'],
+                                                          folder_names, list_root):
+            return
+
+        #other screens show track list when they're left
+        if self.manager == None or self.manager.current != self.name:
+            return
+
+        active_folder = manager_of_track_list.active_folder
+
+        if active_folder == '' or manager_of_track_list.folder_index.get(active_folder) == None:
+            self.generate_folder_buttons()
+
+        elif list_root or active_folder in folder_names:
+            if profile['activate_search']:
+                self.generate_track_search_output()
+            else:
+                self.generate_track_list_output()
 
     def switch_show_search(self):
         """
@@ -395,7 +301,7 @@ class MainScreen(Screen):
         if self.ids.checkbox_show_search.active:
             
             manager_of_profile_list.active_profile['activate_search'] = self.ids.checkbox_show_search.active
-            manager_of_profile_list.save_profiles()
+            manager_of_profile_list.schedule_save_profiles()
             if manager_of_track_list.active_folder != '':
                 self.generate_track_search_output()
             
@@ -404,58 +310,51 @@ class MainScreen(Screen):
         else:
             
             manager_of_profile_list.active_profile['activate_search'] = self.ids.checkbox_show_search.active
-            manager_of_profile_list.save_profiles()
+            manager_of_profile_list.schedule_save_profiles()
             if manager_of_track_list.active_folder != '':       
                 self.generate_track_list_output()
             
             return True
 
-    def mark_track_to_delete(self, track_dict, current_label):
+    def mark_track_to_delete(self, track_dict, current_label, folder_name=None):
         """
             Marks cliked track for deleting
             track_dict:        [trackname, mark_to_delete] in manager_of_track_list{folder_name}[tracklist]
             current_label:     Cliced Label widget 
+            folder_name:       folder containing track, active folder by default
         """
+
+        if folder_name == None:
+            folder_name = manager_of_track_list.active_folder
+
         #if view is list of tracks, header text will be updated
         update_header = not manager_of_profile_list.active_profile['activate_search']        
 
         if track_dict[1] == True: #If marked to delete, should unmark
             
-            #header text counter
-            self.marked_to_del -= 1
-            
             #change bg_color
             current_label.bgcolor = self.bgcolor
             
-            #change mark_to_delete to False
-            track_dict[1] = not track_dict[1]
+            #change mark_to_delete to False and journal it
+            manager_of_track_list.mark_track(manager_of_profile_list.active_profile['db_name'],
+                                             folder_name, track_dict, False)
             
             #update header text
             if update_header:
-                self.ids.mainscreen_header.text = '[%s]: total: [%s], del: [%s]' % \
-                    (manager_of_track_list.active_folder, str(self.total_counter), str(self.marked_to_del))
-            
-            #save tracklist
-            manager_of_track_list.save_track_list(manager_of_profile_list.active_profile['db_name'])
+                self.show_track_list_header()
         
         else:
             
-            #header text counter   
-            self.marked_to_del += 1
-            
             #change bg_color
             current_label.bgcolor = self.bgcolor_marked
             
-            #change mark_to_delete to False
-            track_dict[1] = not track_dict[1]
+            #change mark_to_delete to True and journal it
+            manager_of_track_list.mark_track(manager_of_profile_list.active_profile['db_name'],
+                                             folder_name, track_dict, True)
             
             #update header text
             if update_header:
-                self.ids.mainscreen_header.text = '[%s]: total: [%s], del: [%s]' % \
-                    (manager_of_track_list.active_folder, str(self.total_counter), str(self.marked_to_del))
-            
-            #save tracklist
-            manager_of_track_list.save_track_list(manager_of_profile_list.active_profile['db_name'])   
+                self.show_track_list_header()
 
         return True
 
@@ -467,8 +366,8 @@ class MainScreen(Screen):
             button_object: clicked Button object
         """
 
-        #set folder at Button object text as active
-        manager_of_track_list.active_folder = button_object.text
+        #set folder of Button object as active
+        manager_of_track_list.active_folder = button_object.folder_name
 
         #if search activated will show search text input:
         if manager_of_profile_list.active_profile['activate_search']:
@@ -478,166 +377,252 @@ class MainScreen(Screen):
         else:
             self.generate_track_list_output()            
 
-    def show_finded_track(self, button_object):
+    def generate_track_search_output(self):
         """
-            Shows finded track (in serach mode)
+            Generates search view (when activate_search checkbox is marked). Tracks of every folder are
+            searched while query is typed, number alone also finds track with this number in active folder.
+            Widgets of search view are created once and reused.
+        """
+
+        if self.search_input == None:
+
+            self.search_view = BoxLayout(size_hint=(1,1), orientation='vertical', padding=[10,10,10,10])
+
+            #text input for words of track name or number of track
+            self.search_input = TextInput(text='', multiline=False, size_hint=(1,.15))
+            self.search_input.bind(text=self.show_found_tracks)
+            self.search_view.add_widget(self.search_input)
+
+            #found tracks
+            self.search_recycle_view = SearchRecycleView(size_hint=(1,.85))
+            self.search_view.add_widget(self.search_recycle_view)
+
+        self.show_output(self.search_view)
+
+        self.search_input.text = ''
+        self.show_found_tracks()
+
+    @instrumented('MainScreen.show_found_tracks')
+    def show_found_tracks(self, *args):
+        """
+            Handler for text of search input, shows tracks found by query
+        """
+
+        query = self.search_input.text.strip()
+
+        #(folder_name, index_of_track_in_folder, trackname) of found tracks
+        self.search_results = []
+
+        #number of track in active folder
+        if query.isdigit() and manager_of_track_list.active_folder != '':
+            index_of_track = int(query) - 1
+            tracks_in_folder = manager_of_track_list.get_current_tracklist_in_folder_name(
+                manager_of_track_list.active_folder)
+            if index_of_track >= 0 and index_of_track < len(tracks_in_folder):
+                self.search_results.append((manager_of_track_list.active_folder, index_of_track,
+                                            tracks_in_folder[index_of_track][0]))
+
+        if query != '':
+            for result in manager_of_track_list.search_tracks(query, self.search_limit):
+                if result not in self.search_results:
+                    self.search_results.append(result)
+
+        data = []
+        for result_index, (folder_name, index_of_track, track_name) in enumerate(self.search_results):
+
+            #delete mark isn't indexed, it's read without loading folder of every result
+            bgcolor = self.bgcolor
+            if manager_of_track_list.is_track_marked(folder_name, index_of_track):
+                bgcolor = self.bgcolor_marked
+
+            data.append({'text': '[b][size=50]' + str(index_of_track + 1) + '[/size][/b]' + ' ' + \
+                            escape_markup(track_name) + '  [i]' + escape_markup(folder_name) + '[/i]',
+                         'bgcolor': bgcolor,
+                         'result_index': result_index})
+
+        self.search_recycle_view.data = data
+        self.search_recycle_view.scroll_y = 1
+
+        #update header
+        self.ids.mainscreen_header.text = 'Search: found [%s]' % str(len(self.search_results))
+
+    def mark_search_result(self, result_index, current_label):
+        """
+            Handler for release of SearchResultRow, marks found track for deleting
+            result_index:      index of track in self.search_results
+            current_label:     Cliced SearchResultRow widget
+        """
+
+        folder_name, index_of_track, track_name = self.search_results[result_index]
+
+        tracks_in_folder = manager_of_track_list.get_current_tracklist_in_folder_name(folder_name)
+
+        #folder was changed by MediaWatcher or rescan since search, tracks are searched again
+        if index_of_track >= len(tracks_in_folder) or tracks_in_folder[index_of_track][0] != track_name:
+            self.show_found_tracks()
+            return True
+
+        self.mark_track_to_delete(tracks_in_folder[index_of_track], current_label, folder_name)
+
+        #recycled label takes bgcolor from data when it shows this track again
+        self.search_recycle_view.data[result_index]['bgcolor'] = current_label.bgcolor
+
+        return True
+
+    @instrumented('MainScreen.generate_track_list_output')
+    def generate_track_list_output(self):
+        """
+            Generates list view (when activate_search checkbox is not marked).
+            TrackRecycleView creates labels only for visible tracks, so folder opens in the same time
+            whatever count of tracks it has.
         """
-        
-        #Find dynamicaly created widgets by ids:
-        children = self.children[:]
-        while children:
-            child = children.pop()
-            if child.id == 'digitinput_search':
-                digitinput_search = child
-            if child.id == 'grid_for_track_output':
-                grid_for_track_output = child
-            children.extend(child.children)
-
-        #Clear earlier found track
-        grid_for_track_output.clear_widgets()
 
         #get list ot tracks and delete marks in active folder
         tracks_in_folder = manager_of_track_list.get_current_tracklist_in_folder_name(manager_of_track_list.active_folder)
 
-        if digitinput_search.text == "":
-            return
-
-        index_of_track = int(digitinput_search.text) - 1
+        #opened folder is the last used one, so it isn't unloaded
+        manager_of_track_list.trim_loaded_folders()
 
-        #do nothing if typed number of track not in list
-        if (index_of_track >= 0 and index_of_track < len(tracks_in_folder)):
-            
-            tr = tracks_in_folder[index_of_track]
-            
-            #SHOW FINDED TRACK:
+        #DATA FOR TRACK LABELS (TrackRow), track_index is index in tracks_in_folder:
+        data = []
+        for track_index, tr in enumerate(tracks_in_folder):
 
             #tr[1] contains delete mark
+            bgcolor = self.bgcolor
             if tr[1] == True:
+                bgcolor = self.bgcolor_marked
 
-                lb_text = '[b][size=50]' + str(index_of_track + 1) + '[/size][/b]' + ' ' + tr[0]
+            data.append({'text': self.track_row_text(track_index, tr[0]),
+                         'bgcolor': bgcolor,
+                         'track_index': track_index,
+                         'track_name': tr[0]})
 
-                lb = CLabel(text=lb_text, bgcolor=self.bgcolor_marked)
-                lb.bind(on_release=partial(self.mark_track_to_delete, tr))
-                grid_for_track_output.add_widget(lb)
-            
-            else:
-                
-                lb_text = '[b][size=50]' + str(index_of_track + 1) + '[/size][/b]' + ' ' + tr[0]
+        #recycle view is created once and only gets new data for every folder
+        if self.track_recycle_view == None:
+            self.track_recycle_view = TrackRecycleView()
 
-                lb = CLabel(text=lb_text, bgcolor=self.bgcolor)
-                lb.bind(on_release=partial(self.mark_track_to_delete, tr))
-                grid_for_track_output.add_widget(lb)
+        self.track_recycle_view.data = data
+        self.track_recycle_view.scroll_y = 1
+        self.show_output(self.track_recycle_view)
 
-        #update header
-        self.ids.mainscreen_header.text = '[%s]' % (manager_of_track_list.active_folder) 
-        
+        #Upadte header
+        self.show_track_list_header()
 
+        if manager_of_profile_list.active_profile.get('read_metadata', False):
+            self.read_track_metadata(manager_of_track_list.active_folder)
 
-    def generate_track_search_output(self):
+    def show_track_list_header(self):
         """
-            Generates search view (when activate_search checkbox is marked)
+            Shows name and counters of active folder in header, counters are kept by folder record
+            of track list, so they aren't counted again after every mark
         """
 
-        #clear main scroll view oputput
-        self.ids.mainscreen_default_output.clear_widgets()
+        tr_rec = manager_of_track_list.folder_index.get(manager_of_track_list.active_folder)
+        if tr_rec == None:
+            return
 
-        #main scroll view oputput, declared in kv file
-        sv = self.ids.mainscreen_default_output
+        self.ids.mainscreen_header.text = '[%s]: %s' % (manager_of_track_list.active_folder,
+                                                        stats_text(manager_of_track_list.folder_stats(tr_rec)))
 
-        #declaring root boxlayot on scroll view
-        blo_root = BoxLayout(id='box_layout_root_in_scroll_view',
-                            size_hint=(1,1), orientation='vertical', padding=[10,10,10,10])
-        
-        sv.add_widget(blo_root)
+    def track_row_text(self, track_index, track_name, metadata=None):
+        """
+            Returns markup of TrackRow: number and filename of track, artist, title and duration
+            if metadata (title, artist, duration) was read from header of track
+        """
 
-        #box layout for serach text input and button 'search'
-        blo_search = BoxLayout(size_hint=(1,.2), orientation='horizontal')
-        blo_root.add_widget(blo_search)
-        
-        #text input for number of track
-        dgtinpt = DigitInput(id = 'digitinput_search', text='',multiline=False,size_hint=(0.6, 1))
-        
-        #button for start search
-        button_search = Button(text='search',size_hint=(0.4,1))
-        button_search.bind(on_release=self.show_finded_track)
+        text = '[b][size=50]' + str(track_index + 1) + '[/size][/b]' + ' ' + track_name
 
-        blo_search.add_widget(dgtinpt)
-        
-        blo_search.add_widget(button_search)
+        if metadata != None:
+            title, artist, duration = metadata
+            details = [value for value in (artist, title) if value]
+            if duration:
+                details.append('%d:%02d' % divmod(int(round(duration)), 60))
+            if details != []:
+                text += '  [size=20][i]' + escape_markup(u' - '.join(details)) + '[/i][/size]'
 
-        #grid for finded track output
-        grid = GridLayout(id = 'grid_for_track_output', cols=1, spacing=(0,10), size_hint=(1,.8), 
-                row_force_default=True, row_default_height=50)
+        return text
 
-        blo_root.add_widget(grid)
+    def read_track_metadata(self, folder_name):
+        """
+            Reads headers of tracks of folder in worker thread, only files which aren't cached
+            in track database yet are read. Rows are updated when headers are read.
+        """
 
-        #update header
-        self.ids.mainscreen_header.text = '[%s]' % (manager_of_track_list.active_folder)
+        tr_rec = manager_of_track_list.folder_index.get(folder_name)
+        if tr_rec == None:
+            return
 
-    def generate_track_list_output(self):
+        path_to_removable_media = manager_of_profile_list.active_profile['path_to_removable_media']
+
+        def worker():
+            try:
+                metadata = manager_of_track_list.folder_metadata(path_to_removable_media, tr_rec)
+            except Exception:
+                Logger.exception('MainScreen: headers of tracks of %s not read' % folder_name)
+                return
+            Clock.schedule_once(partial(self.show_track_metadata, folder_name, metadata))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    def show_track_metadata(self, folder_name, metadata, *args):
+
+        #other folder was opened while headers were read
+        if manager_of_track_list.active_folder != folder_name or self.track_recycle_view == None or \
+        len(self.track_recycle_view.data) != len(metadata):
+            return
+
+        tracks_in_folder = manager_of_track_list.get_current_tracklist_in_folder_name(folder_name)
+        for track_index, row in enumerate(self.track_recycle_view.data):
+            row['text'] = self.track_row_text(track_index, tracks_in_folder[track_index][0], metadata[track_index])
+
+        self.track_recycle_view.refresh_from_data()
+
+    def mark_track_in_list(self, track_index, track_name, current_label):
         """
-            Generates list view (when activate_search checkbox is not marked)
+            Handler for release of TrackRow, marks track of active folder for deleting
+            track_index:       index of track in active folder
+            track_name:        filename of track shown by row
+            current_label:     Cliced TrackRow widget
         """
-        
-        #Clear widgets for futher dynamical generating
-        self.ids.mainscreen_default_output.clear_widgets()        
 
-        #get list ot tracks and delete marks in active folder
         tracks_in_folder = manager_of_track_list.get_current_tracklist_in_folder_name(manager_of_track_list.active_folder)
-        
-        #GridLayout for Labels with tracks
-        grid = GridLayout(cols=1, spacing=(0,10), size_hint_y=None, 
-                padding = [10,10,10,10],row_force_default=True, row_default_height=50)
-        #For proper work of ScrollView
-        grid.bind(minimum_height=grid.setter('height'))
-        
-        #counters for header
-        self.total_counter = 0
-        self.marked_to_del = 0
 
-        #Iterating tracks:
-        for tr in tracks_in_folder:
-            
-            track_number = self.total_counter = tracks_in_folder.index(tr) + 1
-           
-            #DYNAMICLAY GENERATE TRACK LABEL:
+        #folder was rescanned since row was shown, rows are shown again
+        if track_index >= len(tracks_in_folder) or tracks_in_folder[track_index][0] != track_name:
+            self.generate_track_list_output()
+            return True
 
-            #tr[1] contains delete mark
-            if tr[1] == True:
+        self.mark_track_to_delete(tracks_in_folder[track_index], current_label)
 
-                #for header text
-                self.marked_to_del += 1
+        #recycled label takes bgcolor from data when it shows this track again
+        self.track_recycle_view.data[track_index]['bgcolor'] = current_label.bgcolor
 
-                lb_text = '[b][size=50]' + str(track_number) + '[/size][/b]' + ' ' + tr[0]
+        return True
 
-                lb = CLabel(text=lb_text, bgcolor=self.bgcolor_marked)
-                lb.bind(on_release=partial(self.mark_track_to_delete, tr))
-                grid.add_widget(lb)
-            
-            else:
-                
-                lb_text = '[b][size=50]' + str(track_number) + '[/size][/b]' + ' ' + tr[0]
+    def show_output(self, widget, scrollable=False):
+        """
+            Shows widget in main output area
+                scrollable: boolean     #if true, widget is shown in ScrollView
+        """
 
-                lb = CLabel(text=lb_text, bgcolor=self.bgcolor)
-                lb.bind(on_release=partial(self.mark_track_to_delete, tr))
-                grid.add_widget(lb)
+        self.ids.mainscreen_default_output.clear_widgets()
 
-        #Show GridLayout with generated Labels
-        sv = self.ids.mainscreen_default_output
-        sv.add_widget(grid)
+        if scrollable:
+            sv = ScrollView(do_scroll_x=False, effect_cls=ScrollEffect)
+            sv.add_widget(widget)
+            widget = sv
 
-        #Upadte header
-        self.ids.mainscreen_header.text = '[%s]: total: [%s], del: [%s]' % \
-        (manager_of_track_list.active_folder, str(self.total_counter), str(self.marked_to_del))   
+        self.ids.mainscreen_default_output.add_widget(widget)
 
+    @instrumented('MainScreen.generate_folder_buttons')
     def generate_folder_buttons(self):
         """
-            Generate buttons with folder names on MainScreen
+            Shows buttons with folder names on MainScreen. FolderRecycleView creates buttons only for
+            visible folders, its data is built again only when folders of track list were changed.
         """
         
-        #Clear widgets
-        self.ids.mainscreen_default_output.clear_widgets()
-        
         #No folder choosen when folders are being shown
         manager_of_track_list.active_folder = ''
 
@@ -651,63 +636,103 @@ class MainScreen(Screen):
             #Button for rescan
             but = Button(text='Scan removable media' ,strip=True,
                 text_size=(300,300),halign='center',valign='middle')
+            but.bind(on_release=lambda button: self.rescan_removable_media())
             
             grid.add_widget(but)
             
             #Show
-            sv = self.ids.mainscreen_default_output
-            sv.add_widget(grid)
+            self.show_output(grid, scrollable=True)
             
         else:
 
-            #Grid layout which will contain all folder buttons
-            grid = GridLayout(cols=2, spacing=(25,10), size_hint_y=None, 
-                padding = [10,10,10,10], row_force_default=True, row_default_height=100)
-            grid.bind(minimum_height=grid.setter('height'))
-            
-            sv = self.ids.mainscreen_default_output
-            sv.add_widget(grid)
-            
-            #Count folders to display it number in header:
-            self.total_counter = 0
-            
-            #Iterating folders: manager_of_track_list.track_list[{'folder_name'}]
-            for tr_rec in manager_of_track_list.track_list:
-
-                #header text counter
-                self.total_counter += 1
-
-                #folder name for button text
-                folder_name = tr_rec['folder_name']
-                
-                #Create Button
-                but = Button(text=folder_name, size_hint_y=None,
-                halign='center',valign='middle')
-                but.bind(on_release=self.generate_track_view)
-                
-                grid.add_widget(but)
-            
-            #update header
-            self.ids.mainscreen_header.text = 'Folders: %s' % str(self.total_counter)
+            if self.folder_view == None:
 
-            
-    def delete_marked_files(self):
+                self.folder_view = BoxLayout(size_hint=(1,1), orientation='vertical')
+
+                #text input for beginning of folder name
+                self.folder_filter_input = TextInput(text='', multiline=False, size_hint=(1,.12),
+                                                     hint_text='Folder name starts with..')
+                self.folder_filter_input.bind(text=self.filter_folders)
+                self.folder_view.add_widget(self.folder_filter_input)
+
+                self.folder_recycle_view = FolderRecycleView(size_hint=(1,.88))
+                self.folder_view.add_widget(self.folder_recycle_view)
+
+            if self.folder_data_version != manager_of_track_list.folders_version:
+
+                self.folder_data = [{'folder_name': tr_rec['folder_name']} for tr_rec in manager_of_track_list.track_list]
+                self.folder_keys = [row['folder_name'].lower() for row in self.folder_data]
+                self.folder_data_version = manager_of_track_list.folders_version
+
+                self.update_folder_stats()
+                self.filter_folders()
+
+            else:
+                #marks and deleting change only counters of folders, buttons are reused
+                self.update_folder_stats()
+                self.folder_recycle_view.refresh_from_data()
+
+            self.show_output(self.folder_view)
+            self.show_folders_header()
+
+    def update_folder_stats(self):
         """
-            Deletes marked tracks psisicaly
+            Writes names and counters of folders into data of folder buttons. Counters are kept by
+            records of track list, so tracks of folders aren't loaded.
         """
 
-        def delete_track_phisicaly(path_to_removable_media, folder_name, track_dict):
+        for row in self.folder_data:
+            tr_rec = manager_of_track_list.folder_index.get(row['folder_name'])
+            if tr_rec != None:
+                row['text'] = '%s\n%s' % (row['folder_name'], stats_text(manager_of_track_list.folder_stats(tr_rec)))
+
+    def filter_folders(self, *args):
+        """
+            Handler for text of folder filter, shows folders which names start with its text.
+            Only data of recycle view is replaced, buttons are reused.
+        """
 
-            if track_dict[1] == False:
-                return False
+        prefix = self.folder_filter_input.text.strip().lower()
 
-            try:
-                os.remove(os.path.join(path_to_removable_media, folder_name, track_dict[0]))
-                return True
-            except:
-                return False
+        if prefix == '':
+            self.folder_recycle_view.data = self.folder_data
+        else:
+            self.folder_recycle_view.data = [row for row, key in zip(self.folder_data, self.folder_keys)
+                                             if key.startswith(prefix)]
+
+        self.folder_recycle_view.scroll_y = 1
+        self.show_folders_header()
+
+    def show_folders_header(self):
+
+        #Count folders to display it number in header:
+        self.total_counter = len(self.folder_data)
+
+        if len(self.folder_recycle_view.data) == self.total_counter:
+            self.ids.mainscreen_header.text = 'Folders: %s' % str(self.total_counter)
+        else:
+            self.ids.mainscreen_header.text = 'Folders: %s of %s' % (len(self.folder_recycle_view.data),
+                                                                     self.total_counter)
+
+        #counters of whole profile
+        self.ids.mainscreen_header.text += ', ' + stats_text(manager_of_track_list.profile_stats())
 
-#############end of delete_marked_files()####################################################################
+    def rescan_removable_media(self):
+        """
+            Scans again changed folders of removable media of active profile
+        """
+
+        self.manager.get_screen('trackscanscreen').start_scan(
+            manager_of_profile_list.active_profile['path_to_removable_media'],
+            manager_of_profile_list.active_profile['db_name'], rescan=True,
+            scan_threads=manager_of_profile_list.active_profile.get('scan_threads',
+                                                                    manager_of_profile_list.default_scan_threads))
+
+    def delete_marked_files(self):
+        """
+            Deletes marked tracks psisicaly. Deleting runs in background, DeletionPopup shows its progress
+            and lets undo it before files are purged.
+        """
 
         #root folder:
         path_to_removable_media = manager_of_profile_list.active_profile['path_to_removable_media']
@@ -718,20 +743,454 @@ class MainScreen(Screen):
         if not os.path.exists(path_to_removable_media):
             return
 
-        #Iteratin folders:
-        for rec in manager_of_track_list.track_list:
-            
-            folder_name = rec['folder_name']
+        marked_tracks = manager_of_track_list.marked_tracks()
+        if marked_tracks == []:
+            return
+
+        DeletionPopup(DeletionJob(path_to_removable_media, marked_tracks), track_list_filename).start()
+
+    def find_duplicates(self):
+        """
+            Finds tracks with the same content in background, DuplicatesPopup shows its progress
+            and lets mark all copies but one to delete
+        """
+
+        path_to_removable_media = manager_of_profile_list.active_profile['path_to_removable_media']
+        track_list_filename = manager_of_profile_list.active_profile['db_name']
+
+        if not os.path.exists(path_to_removable_media):
+            return
 
-            #If track marked for delete, delete_track_phisicaly() will delete it and track will not
-            #be stored in new list of tracks rec['tracks'][:] (slice used for store value, not pointer)
-            rec['tracks'][:] = [tup for tup in rec['tracks'] if not delete_track_phisicaly(path_to_removable_media, folder_name, tup)]
+        DuplicatesPopup(path_to_removable_media, track_list_filename).start()
 
-        #save new tracklist after deleting
-        manager_of_track_list.save_track_list(track_list_filename)
+    def sync_library(self):
+        """
+            Copies new and changed tracks of source library of profile onto removable media in background,
+            SyncPopup shows its progress
+        """
+
+        path_to_source_library = manager_of_profile_list.active_profile.get('path_to_source_library')
+        path_to_removable_media = manager_of_profile_list.active_profile['path_to_removable_media']
+
+        if not path_to_source_library or not os.path.isdir(path_to_source_library) or \
+                not os.path.exists(path_to_removable_media):
+            popup_error = Popup(title='Error',
+                                content=Label(text='Source library of profile is not found.', strip=True,
+                                              text_size=(self.width*0.45,None)),
+                                auto_dismiss=True, size_hint=[.5,.5])
+            popup_error.open()
+            return
+
+        SyncPopup(path_to_source_library, path_to_removable_media,
+                  manager_of_profile_list.active_profile['db_name']).start()
+
+    def renumber_tracks(self):
+        """
+            Writes numbers of tracks into their filenames in background: of active folder when list
+            of tracks is shown, of every folder when folders are shown. RenumberPopup shows its progress.
+        """
+
+        path_to_removable_media = manager_of_profile_list.active_profile['path_to_removable_media']
+        track_list_filename = manager_of_profile_list.active_profile['db_name']
+
+        if not os.path.exists(path_to_removable_media):
+            return
+
+        folder_names = None
+        if manager_of_track_list.active_folder != '':
+            folder_names = [manager_of_track_list.active_folder]
+
+        RenumberPopup(path_to_removable_media, track_list_filename, folder_names).start()
+
+class DeletionPopup(Popup):
+    """
+        Popup with progress of DeletionJob. Job runs in worker thread, track list and widgets
+        are updated only from main thread through Clock.
+    """
+
+    def __init__(self, job, track_list_filename, **kwargs):
+
+        super(DeletionPopup,self).__init__(**kwargs)
+
+        self.job = job
+        self.track_list_filename = track_list_filename
+
+    def start(self):
+        """
+            Opens popup and moves marked tracks to trash
+        """
+
+        self.set_buttons(undo=False, purge=False, close=False)
+        self.ids.deletion_report.text = 'Moving %d marked files to trash..' % len(self.job.marked_tracks)
+        self.open()
+
+        #indexes of staged tracks should stay valid until track list is updated
+        watcher_of_removable_media.pause()
+
+        self.run_in_background(self.job.stage, self.post_progress)
+
+    def run_in_background(self, function, *args):
+
+        def worker():
+            try:
+                result = function(*args)
+            except Exception:
+                Logger.exception('DeletionPopup: deleting failed')
+                result = None
+            Clock.schedule_once(partial(self.job_finished, function, result))
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    def post_progress(self, done, count):
+        """
+            Progress callback of DeletionJob, called in worker thread
+        """
+
+        Clock.schedule_once(partial(self.show_progress, done, count))
+
+    def show_progress(self, done, count, *args):
+
+        self.ids.progress_bar_deletion.max = max(count, 1)
+        self.ids.progress_bar_deletion.value = done
+
+    def job_finished(self, function, result, *args):
+
+        if function == self.job.stage:
+
+            #track list is saved once for all moved tracks
+            manager_of_track_list.remove_tracks(self.track_list_filename, self.job.staged,
+                                                removed_bytes=self.job.bytes_by_folder(self.job.staged))
+
+            self.ids.progress_bar_deletion.value = self.ids.progress_bar_deletion.max
+            self.ids.deletion_report.text = '%d files moved to trash.' % len(self.job.staged) + self.failures_report()
+            self.set_buttons(undo=self.job.staged != [], purge=True, close=False)
+
+        elif function == self.job.purge:
+
+            self.ids.deletion_report.text = '%d files deleted.' % self.job.purged + self.failures_report()
+            self.set_buttons(undo=False, purge=False, close=True)
+
+        elif function == self.job.undo:
+
+            manager_of_track_list.restore_tracks(self.track_list_filename, result or [],
+                                                 restored_bytes=self.job.bytes_by_folder(result or []))
+            self.dismiss()
+
+    def failures_report(self):
+        """
+            Returns text with files which couldn't be deleted
+        """
+
+        if self.job.failures == []:
+            return ''
+
+        report = '\n%d files failed:' % len(self.job.failures)
+        for path_to_file, error in self.job.failures[:5]:
+            report += '\n%s: %s' % (os.path.basename(path_to_file), error)
+        if len(self.job.failures) > 5:
+            report += '\n..'
+        return report
+
+    def set_buttons(self, undo, purge, close):
+
+        self.ids.button_undo_deletion.disabled = not undo
+        self.ids.button_purge.disabled = not purge
+        self.ids.button_close_deletion.disabled = not close
+
+    def undo(self):
+        """
+            Handler for button_undo_deletion
+        """
+
+        self.set_buttons(undo=False, purge=False, close=False)
+        self.ids.deletion_report.text = 'Moving files back..'
+        self.run_in_background(self.job.undo)
+
+    def purge(self):
+        """
+            Handler for button_purge
+        """
+
+        self.set_buttons(undo=False, purge=False, close=False)
+        self.ids.deletion_report.text = 'Deleting files..'
+        self.ids.progress_bar_deletion.value = 0
+        self.run_in_background(self.job.purge, self.post_progress)
+
+    def on_dismiss(self):
+
+        watcher_of_removable_media.resume()
 
         #show folder buttons
-        self.generate_folder_buttons()   
+        App.get_running_app().root.get_screen('mainscreen').generate_folder_buttons()
+
+class DuplicatesPopup(Popup):
+    """
+        Popup with progress and result of search of duplicates. Search runs in worker thread,
+        track list and widgets are updated only from main thread through Clock.
+    """
+
+    #names of steps of DuplicateFinder shown in progress
+    steps = {'stat': 'Reading sizes', 'partial': 'Comparing beginnings', 'full': 'Comparing whole files'}
+
+    def __init__(self, path_to_removable_media, track_list_filename, **kwargs):
+
+        super(DuplicatesPopup,self).__init__(**kwargs)
+
+        self.path_to_removable_media = path_to_removable_media
+        self.track_list_filename = track_list_filename
+        self.cancel_event = threading.Event()
+        self.finder = None
+
+    def start(self):
+        """
+            Opens popup and starts search
+        """
+
+        self.ids.button_mark_duplicates.disabled = True
+        self.ids.duplicates_report.text = 'Searching duplicates..'
+        self.open()
+
+        #indexes of found tracks should stay valid until they are marked
+        watcher_of_removable_media.pause()
+
+        thread = threading.Thread(target=self.find)
+        thread.daemon = True
+        thread.start()
+
+    def find(self):
+
+        try:
+            finder = manager_of_track_list.find_duplicates(self.path_to_removable_media, self.track_list_filename,
+                                                           self.post_progress, self.cancel_event)
+        except Exception:
+            Logger.exception('DuplicatesPopup: search of duplicates failed')
+            finder = None
+        Clock.schedule_once(partial(self.search_finished, finder))
+
+    def post_progress(self, step, done, count):
+        """
+            Progress callback of DuplicateFinder, called in worker threads
+        """
+
+        Clock.schedule_once(partial(self.show_progress, step, done, count))
+
+    def show_progress(self, step, done, count, *args):
+
+        if self.finder != None:
+            return
+
+        self.ids.duplicates_report.text = '%s: %d of %d files..' % (self.steps[step], done, count)
+        self.ids.progress_bar_duplicates.max = max(count, 1)
+        self.ids.progress_bar_duplicates.value = done
+
+    def search_finished(self, finder, *args):
+
+        if self.cancel_event.is_set():
+            return
+
+        self.finder = finder
+        self.ids.progress_bar_duplicates.value = self.ids.progress_bar_duplicates.max
+
+        if finder == None:
+            self.ids.duplicates_report.text = 'Search of duplicates failed.'
+            return
+
+        copies = sum(len(group) - 1 for group in finder.groups)
+        self.ids.duplicates_report.text = '%d groups of duplicates, %d extra copies (%.1f MB).' % (
+            len(finder.groups), copies, finder.duplicate_bytes / (1024.0 * 1024.0))
+        self.ids.button_mark_duplicates.disabled = copies == 0
+
+    def mark_duplicates(self):
+        """
+            Handler for button_mark_duplicates
+        """
+
+        marked = manager_of_track_list.mark_duplicates(self.track_list_filename, self.finder.groups)
+        self.ids.duplicates_report.text += '\n%d tracks marked to delete.' % marked
+        self.ids.button_mark_duplicates.disabled = True
+
+    def on_dismiss(self):
+
+        #search still running is stopped, its result is ignored
+        self.cancel_event.set()
+        watcher_of_removable_media.resume()
+
+        #show folder buttons with new marks
+        App.get_running_app().root.get_screen('mainscreen').generate_folder_buttons()
+
+class SyncPopup(Popup):
+    """
+        Popup with progress and result of sync of source library. Sync runs in worker thread, track list
+        is updated by it at the end, widgets are updated only from main thread through Clock.
+    """
+
+    #names of steps of LibrarySync shown in progress
+    steps = {'compare': 'Comparing', 'copy': 'Copying'}
+
+    def __init__(self, path_to_source_library, path_to_removable_media, track_list_filename, **kwargs):
+
+        super(SyncPopup,self).__init__(**kwargs)
+
+        self.path_to_source_library = path_to_source_library
+        self.path_to_removable_media = path_to_removable_media
+        self.track_list_filename = track_list_filename
+        self.cancel_event = threading.Event()
+        self.finished = False
+
+    def start(self):
+        """
+            Opens popup and starts sync
+        """
+
+        self.ids.sync_report.text = 'Reading source library..'
+        self.open()
+
+        #track list is updated by sync itself, copied files shouldn't be scanned again
+        watcher_of_removable_media.pause()
+
+        thread = threading.Thread(target=self.sync)
+        thread.daemon = True
+        thread.start()
+
+    def sync(self):
+
+        try:
+            result = manager_of_track_list.sync_library(self.path_to_source_library, self.path_to_removable_media,
+                                                        self.track_list_filename, self.post_progress,
+                                                        self.cancel_event)
+        except Exception:
+            Logger.exception('SyncPopup: sync of %s failed' % self.path_to_source_library)
+            result = None
+        Clock.schedule_once(partial(self.sync_finished, result))
+
+    def post_progress(self, step, done, count):
+        """
+            Progress callback of LibrarySync, called in worker threads
+        """
+
+        Clock.schedule_once(partial(self.show_progress, step, done, count))
+
+    def show_progress(self, step, done, count, *args):
+
+        if self.finished:
+            return
+
+        self.ids.sync_report.text = '%s: %d of %d files..' % (self.steps[step], done, count)
+        self.ids.progress_bar_sync.max = max(count, 1)
+        self.ids.progress_bar_sync.value = done
+
+    def sync_finished(self, sync, *args):
+
+        self.finished = True
+        self.ids.progress_bar_sync.value = self.ids.progress_bar_sync.max
+        self.ids.button_close_sync.text = 'Close'
+
+        if sync == None:
+            self.ids.sync_report.text = 'Sync failed.'
+        else:
+            self.ids.sync_report.text = '%d of %d tracks copied (%s).' % (len(sync.copied), len(sync.plan),
+                                                                          format_size(sync.bytes_copied))
+            if sync.failures != []:
+                self.ids.sync_report.text += '\n%d files not copied.' % len(sync.failures)
+
+        if self.cancel_event.is_set():
+            self.dismiss()
+
+    def on_dismiss(self):
+
+        #copying is stopped, copied tracks are applied to track list when worker finishes
+        if not self.finished:
+            self.cancel_event.set()
+            self.ids.sync_report.text = 'Cancelling..'
+            return True
+
+        watcher_of_removable_media.resume()
+
+        #show folder buttons with copied tracks
+        App.get_running_app().root.get_screen('mainscreen').generate_folder_buttons()
+
+class RenumberPopup(Popup):
+    """
+        Popup with progress of renumbering of tracks. Plans are made from track list in main thread,
+        files are renamed in worker thread, track list is updated in main thread when every file is renamed.
+        Popup is modal until then, so no track can be marked under its old name.
+    """
+
+    def __init__(self, path_to_removable_media, track_list_filename, folder_names=None, **kwargs):
+
+        super(RenumberPopup,self).__init__(**kwargs)
+
+        self.path_to_removable_media = path_to_removable_media
+        self.track_list_filename = track_list_filename
+        self.folder_names = folder_names
+        self.finished = False
+
+    def start(self):
+        """
+            Opens popup and starts renaming
+        """
+
+        plans = manager_of_track_list.plan_renumbering(self.path_to_removable_media, self.folder_names)
+
+        self.ids.button_close_renumber.disabled = True
+        self.ids.renumber_report.text = 'Renaming tracks of %d folders..' % len(plans)
+        self.open()
+
+        #renamed tracks are applied to track list by renumbering itself
+        watcher_of_removable_media.pause()
+
+        thread = threading.Thread(target=self.rename, args=(plans,))
+        thread.daemon = True
+        thread.start()
+
+    def rename(self, plans):
+
+        for index, plan in enumerate(plans):
+            try:
+                plan.apply()
+            except Exception:
+                Logger.exception('RenumberPopup: renumbering of %s failed' % plan.path_to_folder)
+            Clock.schedule_once(partial(self.show_progress, index + 1, len(plans)))
+
+        Clock.schedule_once(partial(self.renaming_finished, plans))
+
+    def show_progress(self, done, count, *args):
+
+        self.ids.progress_bar_renumber.max = max(count, 1)
+        self.ids.progress_bar_renumber.value = done
+
+    def renaming_finished(self, plans, *args):
+
+        manager_of_track_list.apply_renumbering(self.track_list_filename, plans)
+
+        self.finished = True
+        self.ids.progress_bar_renumber.value = self.ids.progress_bar_renumber.max
+        self.ids.button_close_renumber.disabled = False
+
+        self.ids.renumber_report.text = '%d tracks renamed.' % sum(len(plan.renames) for plan in plans
+                                                                    if plan.rollback_log)
+        failed_folders = sum(1 for plan in plans if plan.failures)
+        if failed_folders:
+            self.ids.renumber_report.text += '\n%d folders not renumbered, their tracks keep old names.' % \
+                failed_folders
+
+    def on_dismiss(self):
+
+        #files are being renamed, track list isn't updated yet
+        if not self.finished:
+            return True
+
+        watcher_of_removable_media.resume()
+
+        #show tracks with new names
+        mainscreen = App.get_running_app().root.get_screen('mainscreen')
+        if manager_of_track_list.active_folder != '' and \
+                not manager_of_profile_list.active_profile['activate_search']:
+            mainscreen.generate_track_list_output()
+        else:
+            mainscreen.generate_folder_buttons()
 
 class ProfileScreen(Screen):
 
@@ -763,17 +1222,33 @@ class ProfileScreen(Screen):
             self.parent.current = 'newprofilescreen'
         
         else:
+            #marks of previous profile are saved before its track list is replaced
+            if manager_of_profile_list.active_profile != {}:
+                manager_of_track_list.compact_journal(manager_of_profile_list.active_profile['db_name'])
+
             #get choosen profile
             profile = manager_of_profile_list.get_profile(button_text)
 
-            #Load track list or scan if it doesn't exist
-            manager_of_track_list.choose_tracklist(profile['db_name'], profile['path_to_removable_media'],self.parent)
-            
+            #pickled track list is migrated to sqlite database only when user asks for it
+            if self.ids.checkbox_profile_sqlite_database.active:
+                manager_of_profile_list.use_sqlite_database(profile['name'])
+                self.ids.checkbox_profile_sqlite_database.active = False
+
             #set active profile
             manager_of_profile_list.active_profile = profile
 
-            #switch to main screen
-            self.parent.current = 'mainscreen'
+            #Load track list or scan if it doesn't exist
+            if manager_of_track_list.choose_tracklist(profile['db_name'], profile['path_to_removable_media']):
+
+                #switch to main screen
+                self.parent.current = 'mainscreen'
+
+            else:
+
+                #scan screen switches to main screen when scan is finished
+                self.parent.get_screen('trackscanscreen').start_scan(profile['path_to_removable_media'],
+                    profile['db_name'],
+                    scan_threads=profile.get('scan_threads', manager_of_profile_list.default_scan_threads))
 
     def button_profile_delete_release(self):
         """
@@ -799,6 +1274,7 @@ class NewProfileScreen(Screen):
     loadfile = ObjectProperty(None)
     text_input_path_to_removable_media = ObjectProperty(None)
     text_input_new_profile = ObjectProperty(None)
+    text_input_scan_threads = ObjectProperty(None)
 
     def on_pre_enter(self):
 
@@ -836,16 +1312,26 @@ class NewProfileScreen(Screen):
             popup_error.open()
             return
         
-        for tup in manager_of_profile_list.list_of_profiles:
-            if tup['name'] == self.text_input_new_profile.text or tup['name'] == 'New..':
-                popup_error = Popup(title='Error', 
-                            content=Label(text='Profile with same name is already exists.',strip=True,text_size=(self.width*0.45,None)),
-                          auto_dismiss=True, size_hint=[.5,.5])
-                popup_error.open()
-                return
+        if manager_of_profile_list.get_profile(self.text_input_new_profile.text) != {} or \
+        self.text_input_new_profile.text == 'New..':
+            popup_error = Popup(title='Error', 
+                        content=Label(text='Profile with same name is already exists.',strip=True,text_size=(self.width*0.45,None)),
+                      auto_dismiss=True, size_hint=[.5,.5])
+            popup_error.open()
+            return
+
+        #empty field means default count of scan threads
+        scan_threads = None
+        if self.text_input_scan_threads.text != '':
+            scan_threads = max(1, int(self.text_input_scan_threads.text))
 
         #create new profile with input given
-        manager_of_profile_list.create_new_profile(self.text_input_new_profile.text, self.text_input_path_to_removable_media.text)
+        manager_of_profile_list.create_new_profile(self.text_input_new_profile.text, self.text_input_path_to_removable_media.text,
+                                                   scan_threads=scan_threads,
+                                                   sqlite_database=self.ids.checkbox_sqlite_database.active,
+                                                   watch_removable_media=self.ids.checkbox_watch_removable_media.active,
+                                                   read_metadata=self.ids.checkbox_read_metadata.active,
+                                                   path_to_source_library=self.ids.text_input_path_to_source_library.text.strip() or None)
         self.parent.current = 'profilescreen'
 
 class SpinnerProfileSelect(Spinner):
@@ -895,12 +1381,32 @@ class CarStereoEnumeratorApp(App):
             bsm.current = 'mainscreen'
         
         return bsm
+
+    def on_pause(self):
+
+        #application can be killed while paused, journaled marks and scheduled saves are written
+        if manager_of_profile_list.active_profile != {}:
+            manager_of_track_list.compact_journal(manager_of_profile_list.active_profile['db_name'])
+        scheduler_of_saves.flush()
+        return True
+
+    def on_stop(self):
+
+        if manager_of_profile_list.active_profile != {}:
+            manager_of_track_list.compact_journal(manager_of_profile_list.active_profile['db_name'])
+
+        scheduler_of_saves.stop()
+        watcher_of_removable_media.stop()
+
+        instrumentation.report_counters()
         
 #Factory for Load Dialog
 Factory.register('LoadDialog', cls=LoadDialog)
         
 if __name__ == '__main__':
-    manager_of_profile_list = ProfileManager()
-    manager_of_track_list = TrackListManager()
+    scheduler_of_saves = SaveScheduler()
+    manager_of_profile_list = ProfileManager(save_scheduler=scheduler_of_saves)
+    manager_of_track_list = TrackListManager(save_scheduler=scheduler_of_saves)
+    watcher_of_removable_media = MediaWatcher()
 
     CarStereoEnumeratorApp().run()
\ No newline at end of file
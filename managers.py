@@ -0,0 +1,4740 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Profiles, scanning of removable media and track databases of car stereo enumerator.
+    This module doesn't depend on Kivy, it's used by application (main.py) and by command line
+    interface (cli.py).
+"""
+
+from functools import wraps
+from collections import OrderedDict
+
+import os, re, sys, errno, pickle, string, threading, json, array, bisect, hashlib, mmap, select, struct, time, timeit, logging, logging.handlers
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        #backport of os.scandir for python 2
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+#kivy Logger is logger 'kivy' of logging, messages get to log of application when Kivy is loaded
+Logger = logging.getLogger('kivy')
+Logger.addHandler(logging.NullHandler())
+
+class NullSpan(object):
+    """
+        Span used when instrumentation is disabled, does nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class Span(object):
+    """
+        Times block of code and reports it to Instrumentation when block is finished
+    """
+
+    __slots__ = ('instrumentation', 'name', 'start', 'parent')
+
+    def __init__(self, instrumentation, name):
+
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+
+        stack = self.instrumentation.span_stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, *args):
+
+        duration = timeit.default_timer() - self.start
+        self.instrumentation.span_stack().pop()
+        self.instrumentation.report_span(self, duration)
+        return False
+
+class Instrumentation():
+    """
+        Timing spans and counters of hot paths. Spans are reported through kivy Logger and, if path
+        to trace file is given, as JSON lines to rotating trace file.
+        When instrumentation is disabled span() returns shared NullSpan and count() returns at once.
+
+        Enabled by environment variable CARSTEREOENUMERATOR_TRACE:
+            1                    #spans and counters only in log
+            path to file         #also JSON trace file
+    """
+
+    NULL_SPAN = NullSpan()
+
+    #trace file is rotated when it reaches trace_max_bytes, trace_backup_count old files are kept
+    trace_max_bytes = 1024 * 1024
+    trace_backup_count = 3
+
+    def __init__(self):
+
+        self.enabled = False
+        self.counters = {}
+        self.trace_logger = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def enable(self, path_to_trace=None):
+        """
+            Enables instrumentation
+                path_to_trace: string    #if passed, spans are also written to this file as JSON lines
+        """
+
+        self.enabled = True
+
+        if path_to_trace != None:
+            handler = logging.handlers.RotatingFileHandler(path_to_trace, maxBytes=self.trace_max_bytes,
+                                                           backupCount=self.trace_backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+
+            self.trace_logger = logging.getLogger('carstereoenumerator.trace')
+            self.trace_logger.propagate = False
+            self.trace_logger.setLevel(logging.INFO)
+            self.trace_logger.addHandler(handler)
+
+    def disable(self):
+
+        self.enabled = False
+
+    def span_stack(self):
+        """
+            Returns stack of open spans of current thread
+        """
+
+        stack = getattr(self.local, 'stack', None)
+        if stack == None:
+            stack = self.local.stack = []
+        return stack
+
+    def span(self, name):
+        """
+            Returns context manager timing block of code:
+                with instrumentation.span('scan'):
+                    ...
+        """
+
+        if not self.enabled:
+            return self.NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name, value=1):
+        """
+            Adds value to counter name
+        """
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report_span(self, span, duration):
+
+        Logger.debug('Instrumentation: %s%s %.1f ms' % ('  ' * len(self.span_stack()), span.name, duration * 1000))
+
+        if self.trace_logger != None:
+            self.trace_logger.info(json.dumps({'span': span.name,
+                                               'parent': span.parent,
+                                               'thread': threading.current_thread().name,
+                                               'start': time.time() - duration,
+                                               'ms': round(duration * 1000, 3)}))
+
+    def report_counters(self):
+        """
+            Reports and resets counters
+        """
+
+        if not self.enabled or self.counters == {}:
+            return
+
+        with self.lock:
+            counters = self.counters
+            self.counters = {}
+
+        for name in sorted(counters):
+            Logger.info('Instrumentation: %s = %s' % (name, counters[name]))
+
+        if self.trace_logger != None:
+            self.trace_logger.info(json.dumps({'counters': counters, 'time': time.time()}))
+
+def instrumented(name):
+    """
+        Decorator timing every call of function with span name
+    """
+
+    def decorator(function):
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+
+            if not instrumentation.enabled:
+                return function(*args, **kwargs)
+
+            with instrumentation.span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+instrumentation = Instrumentation()
+
+if os.environ.get('CARSTEREOENUMERATOR_TRACE'):
+    if os.environ['CARSTEREOENUMERATOR_TRACE'] == '1':
+        instrumentation.enable()
+    else:
+        instrumentation.enable(os.environ['CARSTEREOENUMERATOR_TRACE'])
+
+class ProfileManager():
+    
+    """
+        self.list_of_profiles contains list of dictionaries with 
+        the following structure:
+        ('name' : string                      # name of the profile, 
+         'db_name' : string                   # name of file with the database of tracks,
+                                                .tdbs is folder manifest with shard of tracks per folder,
+                                                .tdb is pickled track list, .sqlite is sqlite database,
+                                                .tdbm is memory mapped binary snapshot
+         'path_to_removable_media' : string   # path to removable media
+         'activate_search' : boolean          # if true, default track list output is search, else is list of tracks
+         'default_profile' : boolean          # usually last used profile should be loaded by default
+         'scan_threads' : int                 # count of folders scanned at the same time, slow card readers
+                                                are faster with several threads waiting for I/O together
+         'watch_removable_media' : boolean    # if true, changes of removable media are applied to track list
+                                                while application is open
+         'read_metadata' : boolean            # if true, title, artist and duration are read from headers
+                                                of tracks of opened folder
+         'path_to_source_library' : string    # local library which is synced onto removable media, None if
+                                                removable media is filled by hand)
+    """
+
+    #scan_threads of profiles created before this setting appeared
+    default_scan_threads = 4
+    
+    def __init__(self,path_to_profiles='./.profiles', save_scheduler=None):
+        
+        self.active_profile = {}
+
+        #folder with list of profiles and their track lists
+        self.path_to_profiles = path_to_profiles
+
+        #SaveScheduler of schedule_save_profiles(), without it profiles are saved at once
+        self.save_scheduler = save_scheduler
+
+        #scheduled save can run in timer thread while profiles are saved directly
+        self.save_lock = threading.Lock()
+
+        #{profile name: profile} and default profile, kept in sync with self.list_of_profiles by index_profiles()
+        self.profile_index = {}
+        self.default_profile = {}
+
+        self.load_profiles(path_to_profiles)
+
+    def index_profiles(self):
+        """
+            Rebuilds index of profiles by name and pointer to default profile
+        """
+
+        self.profile_index = {}
+        self.default_profile = {}
+
+        for current_profile in self.list_of_profiles:
+            self.profile_index[current_profile['name']] = current_profile
+            if current_profile['default_profile'] == True:
+                self.default_profile = current_profile
+
+    def profiles_path_exists(self, path_to_profiles='./.profiles'):
+        
+        """
+            Checks existence of profile directory and try to create it if not.
+        """
+        if not os.path.exists(path_to_profiles) or not os.path.isdir(path_to_profiles):
+            
+            try:
+                os.makedirs(path_to_profiles)
+                return True
+            
+            except OSError as exception:
+                if exception.errno != errno.EEXIST:
+                    raise
+                return False
+        else:
+            return True
+
+    def load_profiles(self, path_to_profiles=None, profile_filename='.profilelist.pfl'):
+        """
+            Loads profile from file, path_to_profiles is self.path_to_profiles by default
+        """
+
+        if path_to_profiles == None:
+            path_to_profiles = self.path_to_profiles
+
+        if self.profiles_path_exists(path_to_profiles):
+            
+            if os.path.exists(os.path.join(path_to_profiles,profile_filename)):
+                
+                f = open(os.path.join(path_to_profiles,profile_filename),'rb')
+                self.list_of_profiles = pickle.load(f)
+                f.close()
+            
+            else:
+                self.list_of_profiles = []
+
+            self.index_profiles()
+    
+    def save_profiles(self, path_to_profiles=None, profile_filename='.profilelist.pfl'):
+        """
+            Saves profile to file, path_to_profiles is self.path_to_profiles by default
+        """
+
+        if path_to_profiles == None:
+            path_to_profiles = self.path_to_profiles
+
+        if self.save_scheduler != None:
+            self.save_scheduler.cancel(('profiles', path_to_profiles, profile_filename))
+
+        if self.profiles_path_exists(path_to_profiles):
+
+            with self.save_lock:
+                write_pickle_atomically([dict(profile) for profile in self.list_of_profiles],
+                                        os.path.join(path_to_profiles,profile_filename))
+
+    def schedule_save_profiles(self, path_to_profiles=None, profile_filename='.profilelist.pfl'):
+        """
+            Saves profiles by self.save_scheduler, so several changes in short time are saved once
+        """
+
+        if path_to_profiles == None:
+            path_to_profiles = self.path_to_profiles
+
+        if self.save_scheduler == None:
+            self.save_profiles(path_to_profiles, profile_filename)
+            return
+
+        self.save_scheduler.request(('profiles', path_to_profiles, profile_filename), self.save_profiles,
+                                    path_to_profiles, profile_filename)
+    
+    def create_new_profile(self, profile_name, path_to_removable_media, path_to_profiles=None,
+                           scan_threads=None, sqlite_database=False, watch_removable_media=True, read_metadata=False,
+                           path_to_source_library=None):
+        """
+            Creates new profile:
+                profile_name: string               #name of profile
+                path_to_removable_media: string:   #path to folder with tracks to manage
+                scan_threads: int                  #count of folders scanned at the same time
+                sqlite_database: boolean           #if true, tracks are stored in sqlite database instead of shards
+                watch_removable_media: boolean     #if true, MediaWatcher applies changes of removable media
+                read_metadata: boolean             #if true, tracks are shown with title, artist and duration
+                path_to_source_library: string     #local library which is synced onto removable media
+        """
+
+        if scan_threads == None:
+            scan_threads = self.default_scan_threads
+
+        #Make every profile not default, last loaded profile (in this case is new one) will become default.
+        for prof in self.list_of_profiles:
+            prof['default_profile'] = False
+        
+        db_extension = '.tdbs'
+        if sqlite_database:
+            db_extension = '.sqlite'
+
+        #Adding new profile
+        profile = {'name' : profile_name,
+                   'db_name' : '.' + profile_name + db_extension,
+                   'path_to_removable_media' : path_to_removable_media,
+                   'default_profile' : True,
+                   'activate_search' : False,
+                   'scan_threads' : scan_threads,
+                   'watch_removable_media' : watch_removable_media,
+                   'read_metadata' : read_metadata,
+                   'path_to_source_library' : path_to_source_library}
+        self.list_of_profiles.append(profile)
+
+        self.profile_index[profile_name] = profile
+        self.default_profile = profile
+
+        self.save_profiles(path_to_profiles)
+
+    def use_sqlite_database(self, profile_name):
+        """
+            Switches profile to sqlite database, existing pickled track list is migrated when it's loaded next time
+        """
+
+        profile = self.get_profile(profile_name)
+        if profile != {} and profile['db_name'].endswith('.tdb'):
+            profile['db_name'] = profile['db_name'][:-len('.tdb')] + '.sqlite'
+            self.save_profiles()
+
+    def delete_profile(self, profile_name):
+        """
+            Deletes profile
+        """
+        #Using list slice [:] to have list bu value, not pointer to it.
+        self.list_of_profiles[:] = [tup for tup in self.list_of_profiles if tup['name'] != profile_name]
+
+        profile = self.profile_index.pop(profile_name, {})
+        if profile is self.default_profile:
+            self.default_profile = {}
+
+        self.save_profiles()
+
+    def get_profile(self, profile_name):
+        """
+            Returns profile by name
+        """
+        return self.profile_index.get(profile_name, {})
+
+    def get_default_profile(self):
+        """
+            Returns default profile
+        """
+        return self.default_profile
+
+class ListdirEntry():
+    """
+        Replacement of os.DirEntry for python without os.scandir and scandir module.
+        Type of entry isn't cached, every is_file()/is_dir() call is a stat call.
+    """
+
+    def __init__(self, path_to_folder, name):
+
+        self.name = name
+        self.path = os.path.join(path_to_folder, name)
+
+    def is_file(self):
+        return os.path.isfile(self.path)
+
+    def is_dir(self):
+        return os.path.isdir(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+def listdir_scandir(path_to_folder):
+    """
+        os.scandir replacement based on os.listdir
+    """
+    return [ListdirEntry(path_to_folder, name) for name in os.listdir(path_to_folder)]
+
+if scandir == None:
+    scandir = listdir_scandir
+
+class SanitizeTable(dict):
+    """
+        Translation table for unicode.translate() which deletes not allowed characters from filenames.
+        Allowed characters are put into table in advance, other characters are added (as deleted)
+        when they are met first time, so every character is looked up once.
+    """
+
+    #allowed for filenames characters
+    allowed_chars = unicode(string.digits + string.ascii_letters + '.- ') + \
+        u'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+
+    def __init__(self):
+        dict.__init__(self, ((ord(char), ord(char)) for char in self.allowed_chars))
+
+    def __missing__(self, code):
+        self[code] = None
+        return None
+
+class RenamePlan():
+    """
+        Renames of files of one folder planned in memory. Collisions are resolved with names from
+        listing of folder, so no file is checked on removable media: -RENAMED is added before extension
+        while new name is taken. Names are compared ignoring case, as FAT of removable media does.
+
+        apply() renames files in one batch, if any rename fails, done renames are rolled back in reverse order.
+
+        self.renames contains list of tuples (old_name, new_name)
+        self.new_names contains filenames after renaming in order of names
+        self.rollback_log contains renames done by apply() which weren't rolled back
+        self.failures contains list of tuples (path_to_file, error message)
+    """
+
+    collision_suffix = u'-RENAMED'
+
+    def __init__(self, path_to_folder, names, entry_names, sanitize_table):
+        """
+            names: list          #filenames to clear
+            entry_names: list    #names of every entry of folder, listed only if some file is renamed
+        """
+
+        self.path_to_folder = path_to_folder
+        self.names = list(names)
+        self.new_names = []
+        self.renames = []
+        self.rollback_log = []
+        self.failures = []
+
+        taken = None
+
+        for name in self.names:
+
+            new_name = name.translate(sanitize_table)
+
+            if new_name != name:
+
+                if taken == None:
+                    if entry_names == None:
+                        entry_names = os.listdir(path_to_folder)
+                    taken = set(entry_name.lower() for entry_name in entry_names)
+
+                file_name, file_extension = os.path.splitext(new_name)
+                while new_name.lower() in taken:
+                    file_name += self.collision_suffix
+                    new_name = file_name + file_extension
+
+                taken.add(new_name.lower())
+                self.renames.append((name, new_name))
+
+            self.new_names.append(new_name)
+
+    def report(self):
+        """
+            Returns lines 'old_name -> new_name' of planned renames (dry run)
+        """
+        return [u'%s -> %s' % (old_name, new_name) for old_name, new_name in self.renames]
+
+    def apply(self):
+        """
+            Renames files, returns True if every file was renamed.
+            If rename fails, files renamed before it get their old names back.
+        """
+
+        for old_name, new_name in self.renames:
+
+            path_to_file = os.path.join(self.path_to_folder, old_name)
+
+            try:
+                os.rename(path_to_file, os.path.join(self.path_to_folder, new_name))
+            except OSError as exception:
+                self.failures.append((path_to_file, exception.strerror))
+                Logger.warning('RenamePlan: renaming of %s failed (%s), %d renames are rolled back' % \
+                    (path_to_file, exception.strerror, len(self.rollback_log)))
+                self.rollback()
+                return False
+
+            self.rollback_log.append((old_name, new_name))
+
+        instrumentation.count('scan.files_renamed', len(self.renames))
+        return True
+
+    def rollback(self):
+        """
+            Gives old names back to renamed files
+        """
+
+        while self.rollback_log:
+
+            old_name, new_name = self.rollback_log.pop()
+            path_to_file = os.path.join(self.path_to_folder, new_name)
+
+            try:
+                os.rename(path_to_file, os.path.join(self.path_to_folder, old_name))
+            except OSError as exception:
+                self.failures.append((path_to_file, exception.strerror))
+
+class RenumberPlan():
+    """
+        Renames of tracks of one folder which write their numbers in order of track list into prefixes
+        of filenames ('07 - Title.mp3'), so car stereo which plays files in order of names plays them in
+        order of track list. Only tracks which prefix differs from their number are renamed.
+
+        Only prefix which renumbering writes itself (zero padded number and ' - ') is taken as old number
+        and replaced, so titles which begin with digits ('50 Cent - ..', '3.14 Pi', '1999 - ..') keep them
+        and the number is put before them. Numbers are padded to the width of count of tracks, width folder
+        was numbered with before is taken from its zero padded prefixes, so folder which had 100 tracks
+        ('001 - ..') is renumbered correctly after it shrinks.
+
+        Target name can be current name of other renamed track (tracks changed places), such tracks are
+        renamed in two phases: to temporary name first, to target name when every other rename is done.
+        Tracks which target names are free are renamed at once.
+
+        apply() renames files in one batch, if any rename fails, done renames are rolled back in reverse order.
+        Plan isn't applied at all if its target or temporary name belongs to file which isn't renamed by it
+        (not musical file, track which isn't in track list), rename would overwrite that file.
+
+        Every rename is written to log_filename in folder before it's done. If application is killed while
+        files are renamed, recover() gives tracks their old names back by this log (it's called by scan
+        of folder and by planning of its renumbering), temporary names keep extension of track meanwhile.
+
+        self.renames contains list of tuples (old_name, new_name)
+        self.new_names contains filenames after renaming in order of names
+        self.failures contains list of tuples (path_to_file, error message)
+    """
+
+    #prefix written by renumbering: '07 - '
+    prefix_pattern = re.compile(u'^(\\d+) - ')
+
+    separator = u' - '
+
+    #numbers are zero padded at least to this count of digits
+    min_digits = 2
+
+    #temporary name of track which target name is taken by other track, extension is added to it
+    temporary_name = u'.renumber-%d'
+
+    log_filename = u'.renumber.jnl'
+
+    def __init__(self, path_to_folder, names):
+        """
+            names: list    #filenames of tracks in order of track list
+        """
+
+        self.path_to_folder = path_to_folder
+        self.names = list(names)
+        self.new_names = []
+        self.renames = []
+        self.rollback_log = []
+        self.failures = []
+
+        self.digits = max(self.min_digits, len(str(len(self.names))))
+
+        #width of numbers written by last renumbering, tracks below 10 have zero padded prefix of it
+        self.numbered_digits = 0
+        for name in self.names:
+            match = self.prefix_pattern.match(os.path.splitext(name)[0])
+            if match != None and match.group(1).startswith(u'0'):
+                self.numbered_digits = max(self.numbered_digits, len(match.group(1)))
+
+        for index, name in enumerate(self.names):
+            new_name = self.numbered_name(name, u'%0*d' % (self.digits, index + 1))
+            if new_name != name:
+                self.renames.append((name, new_name))
+            self.new_names.append(new_name)
+
+    def is_number_prefix(self, match, file_name):
+        """
+            Checks match of prefix_pattern is prefix written by renumbering of folder of this size or smaller
+            (numbers are padded to min_digits..self.digits digits) or by its last renumbering, not digits
+            of title like '1999 - Prince'
+        """
+
+        if match == None or match.end() >= len(file_name):
+            return False
+
+        digits = len(match.group(1))
+        return self.min_digits <= digits <= self.digits or \
+            (digits == self.numbered_digits and digits >= self.min_digits)
+
+    def numbered_name(self, name, number):
+        """
+            Returns name with number as prefix, prefix of old number is replaced
+        """
+
+        file_name, file_extension = os.path.splitext(name)
+
+        match = self.prefix_pattern.match(file_name)
+        if not self.is_number_prefix(match, file_name):
+            return number + self.separator + name
+
+        if match.group(1) == number:
+            return name
+        return number + self.separator + file_name[match.end():] + file_extension
+
+    def report(self):
+        """
+            Returns lines 'old_name -> new_name' of planned renames (dry run)
+        """
+        return [u'%s -> %s' % (old_name, new_name) for old_name, new_name in self.renames]
+
+    def apply(self):
+        """
+            Renames files, returns True if every file was renamed.
+            If rename fails, files renamed before it get their old names back.
+        """
+
+        #names are compared ignoring case, as FAT of removable media does
+        renamed_names = set(old_name.lower() for old_name, new_name in self.renames)
+
+        first_phase = []
+        second_phase = []
+        for index, (old_name, new_name) in enumerate(self.renames):
+            if new_name.lower() in renamed_names:
+                temporary_name = self.temporary_name % index + os.path.splitext(new_name)[1]
+                first_phase.append((old_name, temporary_name))
+                second_phase.append((temporary_name, new_name))
+            else:
+                first_phase.append((old_name, new_name))
+
+        #names of files which stay where they are
+        try:
+            taken = set(name.lower() for name in os.listdir(self.path_to_folder)) - renamed_names
+        except OSError as exception:
+            self.failures.append((self.path_to_folder, exception.strerror))
+            return False
+
+        for old_name, new_name in first_phase:
+            if new_name.lower() in taken:
+                path_to_file = os.path.join(self.path_to_folder, new_name)
+                self.failures.append((path_to_file, os.strerror(errno.EEXIST)))
+                Logger.warning('RenumberPlan: %s already exists, %s is not renumbered' % \
+                    (path_to_file, self.path_to_folder))
+                return False
+
+        path_to_log = os.path.join(self.path_to_folder, self.log_filename)
+
+        try:
+            log = open(path_to_log, 'ab')
+        except IOError as exception:
+            self.failures.append((path_to_log, exception.strerror))
+            return False
+
+        for old_name, new_name in first_phase + second_phase:
+
+            path_to_file = os.path.join(self.path_to_folder, old_name)
+
+            try:
+                #rename is logged before it's done, recover() skips logged rename which wasn't done
+                log.write(json.dumps([old_name, new_name]).encode('utf-8') + b'\n')
+                log.flush()
+                os.fsync(log.fileno())
+
+                os.rename(path_to_file, os.path.join(self.path_to_folder, new_name))
+            except (IOError, OSError) as exception:
+                log.close()
+                self.failures.append((path_to_file, exception.strerror))
+                Logger.warning('RenumberPlan: renaming of %s failed (%s), %d renames are rolled back' % \
+                    (path_to_file, exception.strerror, len(self.rollback_log)))
+
+                #log is kept if some rename wasn't undone, recover() tries it again
+                if self.rollback():
+                    os.remove(path_to_log)
+                return False
+
+            self.rollback_log.append((old_name, new_name))
+
+        log.close()
+        os.remove(path_to_log)
+
+        instrumentation.count('renumber.files_renamed', len(self.renames))
+        return True
+
+    def rollback(self):
+        """
+            Gives old names back to renamed files, returns True if every file got its old name
+        """
+
+        undone = True
+
+        while self.rollback_log:
+
+            old_name, new_name = self.rollback_log.pop()
+            path_to_file = os.path.join(self.path_to_folder, new_name)
+
+            try:
+                os.rename(path_to_file, os.path.join(self.path_to_folder, old_name))
+            except OSError as exception:
+                self.failures.append((path_to_file, exception.strerror))
+                undone = False
+
+        return undone
+
+    @classmethod
+    def recover(cls, path_to_folder):
+        """
+            Gives old names back to tracks which were renamed by renumbering interrupted before it
+            finished (application was killed), renames are undone in reverse order by log of folder.
+            Returns True if folder had no log or every rename was undone.
+        """
+
+        path_to_log = os.path.join(path_to_folder, cls.log_filename)
+        if not os.path.exists(path_to_log):
+            return True
+
+        renames = []
+        f = open(path_to_log, 'rb')
+        for line in f:
+            try:
+                renames.append(json.loads(line.decode('utf-8')))
+            except ValueError:
+                #line which was being written when application was killed
+                break
+        f.close()
+
+        for old_name, new_name in reversed(renames):
+
+            path_to_file = os.path.join(path_to_folder, new_name)
+            path_to_old_file = os.path.join(path_to_folder, old_name)
+
+            #logged rename which wasn't done, or was undone by rollback already
+            if not os.path.exists(path_to_file) or os.path.exists(path_to_old_file):
+                continue
+
+            try:
+                os.rename(path_to_file, path_to_old_file)
+            except OSError as exception:
+                Logger.warning('RenumberPlan: %s not recovered (%s)' % (path_to_file, exception.strerror))
+                return False
+
+        os.remove(path_to_log)
+        Logger.info('RenumberPlan: interrupted renumbering of %s is undone' % path_to_folder)
+        return True
+
+class MediaScanner():
+    """
+        Scans removable media in single pass. os.scandir returns DirEntry objects, which
+        already know type of entry from directory listing, so checking is it file or folder
+        doesn't need separate stat call. On FAT-formatted USB media every stat call is a round trip.
+
+        Python 2.7 has no os.scandir, so scandir backport is in requirements of buildozer.spec. listdir_scandir
+        is used only where neither exists, every is_file()/is_dir() check is stat call there.
+
+        self.stat_calls_saved: int     #is_file()/is_dir() checks answered from directory listing
+        self.stat_calls: int           #stat calls made by scanner
+    """
+
+    track_extensions = ('.mp3','.wav','.aac','.flac','.wma')
+
+    #shared by scanners of all threads
+    sanitize_table = SanitizeTable()
+
+    def __init__(self):
+
+        self.reset_counters()
+
+        #DirEntry types are cached only with real scandir
+        self.cached_types = scandir is not listdir_scandir
+
+    def reset_counters(self):
+
+        self.stat_calls_saved = 0
+        self.stat_calls = 0
+
+    def count_type_check(self):
+        """
+            Counts one is_file()/is_dir() call
+        """
+        if self.cached_types:
+            self.stat_calls_saved += 1
+        else:
+            self.stat_calls += 1
+
+    @instrumented('scan.list_folders')
+    def list_folders(self, path_to_removable_media):
+        """
+            Returns names of top level folders (car stereo can't see more deep hierarchy)
+        """
+
+        folders = []
+        for entry in scandir(path_to_removable_media):
+
+            #tracks in trash are going to be deleted
+            if entry.name == DeletionJob.trash_folder_name:
+                continue
+
+            self.count_type_check()
+            if entry.is_dir():
+                folders.append(entry.name)
+        return folders
+
+    def list_folder(self, path_to_folder):
+        """
+            Returns (entries, track_entries) of folder, track_entries contains only musical files
+        """
+
+        entries = list(scandir(path_to_folder))
+        track_entries = []
+
+        for entry in entries:
+            self.count_type_check()
+            if entry.is_file():
+                track_entries.append(entry)
+
+        return entries, track_entries
+
+    def files_size(self, file_entries):
+        """
+            Returns total size of files in file_entries
+        """
+        return sum(self.file_sizes(file_entries).values())
+
+    def file_sizes(self, file_entries):
+        """
+            Returns {filename: size} of files in file_entries
+        """
+
+        sizes = {}
+        for entry in file_entries:
+            self.stat_calls += 1
+            sizes[entry.name] = entry.stat().st_size
+        return sizes
+
+    def folder_fingerprint(self, path_to_folder):
+        """
+            Returns fingerprint of folder: (mtime, entry_count, total_size).
+            If fingerprint of folder is the same as stored one, folder wasn't changed since last scan.
+        """
+
+        entries, file_entries = self.list_folder(path_to_folder)
+        total_size = self.files_size(file_entries)
+
+        self.stat_calls += 1
+        return (os.stat(path_to_folder).st_mtime, len(entries), total_size)
+
+    @instrumented('scan.fingerprint_matches')
+    def fingerprint_matches(self, path_to_folder, fingerprint):
+        """
+            Checks folder wasn't changed since fingerprint was taken.
+            Changed mtime of folder is enough to say folder was changed, so folder isn't listed in this case.
+        """
+
+        if fingerprint == None:
+            return False
+
+        self.stat_calls += 1
+        if os.stat(path_to_folder).st_mtime != fingerprint[0]:
+            return False
+
+        return self.folder_fingerprint(path_to_folder) == fingerprint
+
+    def plan_renames(self, path_to_folder, track_names, entry_names=None):
+        """
+            Returns RenamePlan which clears tracks' filenames in path_to_folder from not allowed characters
+                track_names: list    #filenames of musical files in path_to_folder
+                entry_names: list    #names of every entry of path_to_folder, listed if not passed
+        """
+        return RenamePlan(path_to_folder, track_names, entry_names, self.sanitize_table)
+
+    @instrumented('scan.clear_file_names')
+    def clear_file_names(self, path_to_folder, track_names, entry_names=None):
+        """
+            Clears tracks' filenames in path_to_folder from not allowed characters.
+            track_names: list    #filenames of musical files in path_to_folder
+            entry_names: list    #names of every entry of path_to_folder, listed if not passed
+            Returns list of filenames after renaming (old filenames if renaming failed and was rolled back)
+        """
+
+        plan = self.plan_renames(path_to_folder, track_names, entry_names)
+
+        if plan.apply():
+            return plan.new_names
+        return plan.names
+
+    @instrumented('scan.scan_folder')
+    def scan_folder(self, path_to_folder, old_tracks=None):
+        """
+            Clears filenames and collects tracks of one top level folder in single listing.
+                path_to_folder: string     #path to folder with tracks
+                old_tracks: list           #earlier scanned tracks of this folder, delete marks are taken from it
+            Returns (tracks, fingerprint, track_bytes), track_bytes is total size of tracks
+        """
+
+        path_to_folder = unicode(path_to_folder)
+
+        #delete marks of tracks which are still on removable media should be kept
+        old_marks = {}
+        if old_tracks:
+            for tr in old_tracks:
+                old_marks[tr[0]] = tr[1]
+
+        entries, file_entries = self.list_folder(path_to_folder)
+
+        #renumbering of folder was interrupted, tracks get their names back before they're collected
+        if any(entry.name == RenumberPlan.log_filename for entry in entries):
+            RenumberPlan.recover(path_to_folder)
+            entries, file_entries = self.list_folder(path_to_folder)
+
+        #size is taken before renaming, DirEntry of renamed file can't be stated
+        sizes = self.file_sizes(file_entries)
+        total_size = sum(sizes.values())
+
+        #Need only musical files with certain extensions
+        track_names = [entry.name for entry in file_entries if entry.name.endswith(self.track_extensions)]
+        track_bytes = sum(sizes[track_name] for track_name in track_names)
+
+        #delete not allowed characters from filenames, collisions are resolved with names from listing
+        track_names = self.clear_file_names(path_to_folder, track_names, [entry.name for entry in entries])
+
+        current_folder_tracks = [[track, old_marks.get(track, False)] for track in track_names]
+
+        #mtime is taken after renaming, because renaming changes mtime of folder,
+        #renaming doesn't change count and size of entries, so listing is reused
+        self.stat_calls += 1
+        fingerprint = (os.stat(path_to_folder).st_mtime, len(entries), total_size)
+
+        return current_folder_tracks, fingerprint, track_bytes
+
+def load_inotify():
+    """
+        Returns libc with inotify functions, or None where inotify isn't available
+    """
+
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (ImportError, OSError, AttributeError):
+        return None
+    return libc
+
+class MediaWatcher():
+    """
+        Watches removable media while application is open and reports changed top level folders,
+        so track list is updated without rescan. On Linux inotify watches root of removable media
+        and its top level folders, elsewhere mtimes of folders are polled every poll_interval seconds.
+
+        Events are collected until removable media is quiet for debounce_delay seconds (copying of album
+        is one change), then on_changes is called in watcher thread with (folder_names, list_root):
+            folder_names: set      #names of top level folders which were created, deleted, renamed or changed
+            list_root: boolean     #events were lost, every folder of removable media should be checked
+        While watcher is paused (scan or deletion is running) changes are kept and reported after resume().
+    """
+
+    debounce_delay = 2.0
+    poll_interval = 10.0
+
+    #events of inotify (linux/inotify.h)
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    root_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+    folder_mask = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR
+
+    def __init__(self):
+
+        self.path_to_removable_media = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        #changes which aren't reported yet, guarded by lock
+        self.lock = threading.Lock()
+        self.changed_folders = set()
+        self.list_root = False
+        self.last_change = 0
+        self.pauses = 0
+
+    def watch(self, path_to_removable_media, on_changes, folder_fingerprints):
+        """
+            Starts watching of path_to_removable_media, watching of other path is stopped.
+                on_changes: function             #called with (folder_names, list_root) in watcher thread
+                folder_fingerprints: function    #returns {folder_name: fingerprint} of track list, used by polling
+        """
+
+        path_to_removable_media = unicode(path_to_removable_media)
+
+        if self.thread != None and self.thread.is_alive() and self.path_to_removable_media == path_to_removable_media:
+            self.on_changes = on_changes
+            self.folder_fingerprints = folder_fingerprints
+            return
+
+        self.stop()
+
+        if not os.path.isdir(path_to_removable_media):
+            return
+
+        self.path_to_removable_media = path_to_removable_media
+        self.on_changes = on_changes
+        self.folder_fingerprints = folder_fingerprints
+
+        with self.lock:
+            self.changed_folders = set()
+            self.list_root = False
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+        if self.thread != None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def pause(self):
+        with self.lock:
+            self.pauses += 1
+
+    def resume(self):
+        with self.lock:
+            self.pauses = max(0, self.pauses - 1)
+
+    def is_paused(self):
+        return self.pauses > 0
+
+    def add_changes(self, folder_names, list_root=False):
+        """
+            Adds changes to be reported after debounce_delay, also used to return changes which
+            couldn't be applied yet
+        """
+
+        with self.lock:
+            self.changed_folders.update(folder_names)
+            self.list_root = self.list_root or list_root
+            self.last_change = time.time()
+
+    def report_changes(self):
+        """
+            Calls on_changes if removable media is quiet for debounce_delay and watcher isn't paused
+        """
+
+        with self.lock:
+            if self.pauses > 0 or (not self.changed_folders and not self.list_root) or \
+            time.time() - self.last_change < self.debounce_delay:
+                return
+
+            folder_names, list_root = self.changed_folders, self.list_root
+            self.changed_folders = set()
+            self.list_root = False
+
+        Logger.info('MediaWatcher: %d folders changed' % len(folder_names))
+        self.on_changes(folder_names, list_root)
+
+    def run(self):
+
+        libc = load_inotify()
+        fd = -1
+        if libc != None:
+            fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+
+        if fd < 0:
+            Logger.info('MediaWatcher: inotify is not available, polling %s' % self.path_to_removable_media)
+            self.poll()
+            return
+
+        try:
+            self.watch_inotify(libc, fd)
+        finally:
+            os.close(fd)
+
+    def add_watch(self, libc, fd, path, mask):
+        return libc.inotify_add_watch(fd, path.encode(sys.getfilesystemencoding() or 'utf-8'), mask)
+
+    def watch_inotify(self, libc, fd):
+        """
+            Reads inotify events of root and top level folders until watcher is stopped
+        """
+
+        root_wd = self.add_watch(libc, fd, self.path_to_removable_media, self.root_mask)
+
+        #{watch descriptor: folder_name} of top level folders
+        folders = {}
+        for folder_name in MediaScanner().list_folders(self.path_to_removable_media):
+            wd = self.add_watch(libc, fd, os.path.join(self.path_to_removable_media, folder_name), self.folder_mask)
+            if wd >= 0:
+                folders[wd] = folder_name
+
+        Logger.info('MediaWatcher: watching %s and %d folders' % (self.path_to_removable_media, len(folders)))
+
+        while not self.stop_event.is_set():
+
+            readable, writable, failed = select.select([fd], [], [], 0.5)
+            if readable:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError:
+                    data = b''
+
+                changed_folders, list_root = self.parse_events(data, root_wd, folders, libc, fd)
+                if changed_folders or list_root:
+                    self.add_changes(changed_folders, list_root)
+
+            self.report_changes()
+
+    def parse_events(self, data, root_wd, folders, libc, fd):
+        """
+            Returns (folder_names, list_root) of inotify events in data, watches new top level folders
+        """
+
+        folder_names = set()
+        list_root = False
+
+        offset = 0
+        while offset + 16 <= len(data):
+
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += 16 + length
+
+            if mask & self.IN_Q_OVERFLOW:
+                list_root = True
+
+            elif wd == root_wd:
+
+                #removable media was unmounted or moved
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    list_root = True
+
+                #files in root aren't tracks of any folder, tracks in trash are going to be deleted
+                elif mask & self.IN_ISDIR and name != DeletionJob.trash_folder_name:
+                    folder_names.add(name)
+
+                    #renamed folder keeps its watch descriptor, so only its name is updated
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        new_wd = self.add_watch(libc, fd, os.path.join(self.path_to_removable_media, name),
+                                                self.folder_mask)
+                        if new_wd >= 0:
+                            folders[new_wd] = name
+
+            elif mask & self.IN_IGNORED:
+                folders.pop(wd, None)
+
+            elif wd in folders:
+                folder_names.add(folders[wd])
+
+        return folder_names, list_root
+
+    def poll(self):
+        """
+            Compares top level folders and their mtimes with fingerprints of track list every poll_interval
+        """
+
+        scanner = MediaScanner()
+
+        while not self.stop_event.wait(self.poll_interval):
+
+            if self.is_paused() or not os.path.isdir(self.path_to_removable_media):
+                continue
+
+            fingerprints = self.folder_fingerprints()
+            folder_names = set()
+
+            try:
+                current_folders = scanner.list_folders(self.path_to_removable_media)
+            except OSError:
+                continue
+
+            #created, deleted and renamed folders
+            folder_names.update(set(current_folders).symmetric_difference(fingerprints))
+
+            for folder_name in current_folders:
+                fingerprint = fingerprints.get(folder_name)
+                try:
+                    if fingerprint != None and \
+                    os.stat(os.path.join(self.path_to_removable_media, folder_name)).st_mtime != fingerprint[0]:
+                        folder_names.add(folder_name)
+                except OSError:
+                    folder_names.add(folder_name)
+
+            if folder_names:
+                #polling finds changes late already, so they are reported at once
+                with self.lock:
+                    self.changed_folders.update(folder_names)
+                    self.last_change = 0
+                self.report_changes()
+
+class FolderRecord(object):
+    """
+        Compact record of one folder of track list. Names of tracks are stored in one utf-8 blob
+        with array of offsets, delete marks are stored as bits. Record can be used as dictionary
+        {'folder_name', 'tracks', 'fingerprint'}, record['tracks'] returns FolderTracks adapter
+        which behaves as list of [trackname, mark_to_delete] lists (or None if tracks aren't loaded yet).
+
+        self.metadata contains cache of track headers {trackname: (size, mtime, title, artist, duration)},
+        None if it isn't loaded yet
+
+        Counters of folder are kept while tracks aren't loaded, so folder can be described without loading it:
+            self.track_count    #count of tracks
+            self.marked         #count of tracks marked to delete, updated by every set_mark()
+            self.track_bytes    #total size of tracks, set by scan and changed by deleting
+        Counter is None if it isn't known (database was saved before counters appeared).
+    """
+
+    __slots__ = ('folder_name', 'fingerprint', 'names_blob', 'offsets', 'marks', 'loaded', 'dirty', 'metadata',
+                 'track_count', 'marked', 'track_bytes')
+
+    def __init__(self, folder_name, tracks=None, fingerprint=None, metadata=None, stats=None):
+        """
+            tracks: list     #[[trackname, mark_to_delete]], None if tracks aren't loaded yet
+            stats: tuple     #(track_count, marked_count, track_bytes) stored in database
+        """
+
+        self.folder_name = folder_name
+        self.fingerprint = fingerprint
+        self.metadata = metadata
+        self.track_count, self.marked, self.track_bytes = stats or (None, None, None)
+        self.set_tracks(tracks)
+
+    def set_tracks(self, tracks):
+        """
+            Replaces tracks of folder with list of [trackname, mark_to_delete] (or None to unload them)
+        """
+
+        self.loaded = tracks != None
+
+        #tracks or marks were changed since they were loaded from database or saved into it
+        self.dirty = self.loaded
+
+        #tracks can be FolderTracks of this record, so they are read before blob is replaced
+        tracks = [(tr[0], tr[1]) for tr in (tracks or [])]
+
+        encoded_names = [track_name.encode('utf-8') for track_name, mark in tracks]
+
+        #offsets[i] is start of i-th name in blob, offsets[-1] is length of blob
+        self.offsets = array.array('I', [0])
+        for encoded_name in encoded_names:
+            self.offsets.append(self.offsets[-1] + len(encoded_name))
+        self.names_blob = b''.join(encoded_names)
+
+        self.marks = bytearray((len(tracks) + 7) // 8)
+        for index, (track_name, mark) in enumerate(tracks):
+            if mark:
+                self.marks[index >> 3] |= 1 << (index & 7)
+
+        #counters of unloaded folder stay as they were
+        if self.loaded:
+            self.track_count = len(tracks)
+            self.marked = sum(1 for track_name, mark in tracks if mark)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def track_name(self, index):
+        return self.names_blob[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+    def is_marked(self, index):
+        return bool(self.marks[index >> 3] & (1 << (index & 7)))
+
+    def set_mark(self, index, mark):
+
+        self.dirty = True
+        if mark != self.is_marked(index):
+            self.marked += 1 if mark else -1
+
+        if mark:
+            self.marks[index >> 3] |= 1 << (index & 7)
+        else:
+            self.marks[index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+    def marked_count(self):
+        return self.marked
+
+    def stats(self):
+        """
+            Returns (track_count, marked_count, track_bytes) of folder
+        """
+        return self.track_count, self.marked, self.track_bytes
+
+    def __getitem__(self, key):
+
+        if key == 'folder_name':
+            return self.folder_name
+        if key == 'fingerprint':
+            return self.fingerprint
+        if key == 'tracks':
+            if not self.loaded:
+                return None
+            return FolderTracks(self)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+
+        if key == 'folder_name':
+            self.folder_name = value
+        elif key == 'fingerprint':
+            self.fingerprint = value
+        elif key == 'tracks':
+            self.set_tracks(value)
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        """
+            Returns folder as dictionary of pickled track list format
+        """
+
+        tracks = None
+        if self.loaded:
+            tracks = [[self.track_name(index), self.is_marked(index)] for index in range(len(self))]
+        return {'folder_name':self.folder_name, 'tracks':tracks, 'fingerprint':self.fingerprint,
+                'metadata':self.metadata, 'track_bytes':self.track_bytes}
+
+    @classmethod
+    def from_dict(cls, tr_rec):
+        return cls(tr_rec['folder_name'], tr_rec['tracks'], tr_rec.get('fingerprint'), tr_rec.get('metadata'),
+                   (None, None, tr_rec.get('track_bytes')))
+
+    def memory_size(self):
+        """
+            Returns count of bytes used by record
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self.names_blob) + sys.getsizeof(self.offsets) + \
+            sys.getsizeof(self.marks)
+
+class TrackRef(object):
+    """
+        One track of FolderRecord, behaves as [trackname, mark_to_delete] list
+    """
+
+    __slots__ = ('record', 'index')
+
+    def __init__(self, record, index):
+
+        self.record = record
+        self.index = index
+
+    def __getitem__(self, key):
+
+        if key == 0:
+            return self.record.track_name(self.index)
+        if key == 1:
+            return self.record.is_marked(self.index)
+        raise IndexError(key)
+
+    def __setitem__(self, key, value):
+
+        if key != 1:
+            raise IndexError('only delete mark of track can be changed')
+        self.record.set_mark(self.index, value)
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        return iter((self[0], self[1]))
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, TrackRef)):
+            return False
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+class FolderTracks(object):
+    """
+        Adapter of FolderRecord which behaves as list of [trackname, mark_to_delete] lists
+    """
+
+    __slots__ = ('record',)
+
+    def __init__(self, record):
+        self.record = record
+
+    def __len__(self):
+        return len(self.record)
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [TrackRef(self.record, i) for i in range(*index.indices(len(self.record)))]
+        if index < 0:
+            index += len(self.record)
+        if index < 0 or index >= len(self.record):
+            raise IndexError(index)
+        return TrackRef(self.record, index)
+
+    def __setitem__(self, index, value):
+
+        #only tracks[:] = new_tracks is supported
+        if index != slice(None, None, None):
+            raise TypeError('only whole list of tracks can be replaced')
+        self.record.set_tracks(value)
+
+    def __iter__(self):
+        for index in range(len(self.record)):
+            yield TrackRef(self.record, index)
+
+    def insert(self, index, track):
+
+        tracks = [(tr[0], tr[1]) for tr in self]
+        tracks.insert(index, track)
+        self.record.set_tracks(tracks)
+
+    def append(self, track):
+        self.insert(len(self.record), track)
+
+    def __repr__(self):
+        return repr(list(self))
+
+def dict_model_memory_size(track_list):
+    """
+        Returns count of bytes track_list would use as list of dictionaries with lists of [trackname, mark] lists
+    """
+
+    size = sys.getsizeof(track_list)
+
+    for tr_rec in track_list:
+        tracks = tr_rec['tracks'] or []
+        size += sys.getsizeof({'folder_name':None, 'tracks':None, 'fingerprint':None})
+        size += sys.getsizeof(tr_rec['folder_name']) + sys.getsizeof([None] * len(tracks))
+        for tr in tracks:
+            size += sys.getsizeof([None, None]) + sys.getsizeof(tr[0])
+
+    return size
+
+class TrackSearchIndex():
+    """
+        Index of names of every track of track list for search as you type. Names are split into lowercase
+        tokens (words), every token has list of ids of tracks containing it. Query word matches tokens which
+        contain it, so vocabulary of tokens is scanned instead of every track name. Track matches query
+        if every word of query matches some token of track.
+
+        Index is updated by folders: update_folder() replaces tracks of one folder, ids of old tracks
+        are marked as removed and postings are compacted when removed ids are too many.
+        Delete marks aren't indexed, they're read from track list when results are shown.
+
+        self.tracks contains (folder_name, index_of_track_in_folder, trackname) by id, None for removed tracks
+    """
+
+    token_pattern = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self):
+
+        self.tracks = []
+
+        #{token: [ids of tracks]}
+        self.postings = {}
+
+        #{folder_name: [ids of its tracks]}
+        self.folder_ids = {}
+
+        self.removed = 0
+
+        #tokens matching last query word, next word typed over it is matched only against them
+        self.last_word = None
+        self.last_tokens = None
+
+    def tokens(self, track_name):
+        return set(self.token_pattern.findall(track_name.lower()))
+
+    def update_folder(self, folder_name, track_names):
+        """
+            Replaces indexed tracks of folder, track_names is None if folder was removed
+        """
+
+        for track_id in self.folder_ids.pop(folder_name, []):
+            self.tracks[track_id] = None
+            self.removed += 1
+
+        if track_names != None:
+
+            ids = []
+            for track_index, track_name in enumerate(track_names):
+                track_id = len(self.tracks)
+                self.tracks.append((folder_name, track_index, track_name))
+                ids.append(track_id)
+
+                for token in self.tokens(track_name):
+                    postings = self.postings.get(token)
+                    if postings == None:
+                        postings = self.postings[token] = []
+                        self.last_word = None
+                    postings.append(track_id)
+
+            self.folder_ids[folder_name] = ids
+
+        if self.removed > len(self.tracks) // 2:
+            self.compact()
+
+    def compact(self):
+        """
+            Rebuilds index without removed tracks
+        """
+
+        tracks = [track for track in self.tracks if track != None]
+
+        self.tracks = []
+        self.postings = {}
+        self.folder_ids = {}
+        self.removed = 0
+        self.last_word = None
+
+        folder_names = []
+        track_names = {}
+        for folder_name, track_index, track_name in tracks:
+            if folder_name not in track_names:
+                folder_names.append(folder_name)
+                track_names[folder_name] = []
+            track_names[folder_name].append(track_name)
+
+        for folder_name in folder_names:
+            self.update_folder(folder_name, track_names[folder_name])
+
+    def matching_tokens(self, word):
+
+        tokens = self.postings
+        if self.last_word != None and self.last_word in word:
+            tokens = self.last_tokens
+
+        matching_tokens = [token for token in tokens if word in token]
+
+        self.last_word = word
+        self.last_tokens = matching_tokens
+        return matching_tokens
+
+    def search(self, query, limit=100):
+        """
+            Returns list of (folder_name, index_of_track_in_folder, trackname) of tracks matching query,
+            at most limit tracks in order of indexing
+        """
+
+        words = self.tokens(query)
+        if not words:
+            return []
+
+        matching_ids = None
+
+        #the longest word has the fewest matching tokens
+        for word in sorted(words, key=len, reverse=True):
+
+            ids = set()
+            for token in self.matching_tokens(word):
+                ids.update(self.postings[token])
+
+            if matching_ids == None:
+                matching_ids = ids
+            else:
+                matching_ids &= ids
+
+            if not matching_ids:
+                return []
+
+        results = []
+        for track_id in sorted(matching_ids):
+            if self.tracks[track_id] != None:
+                results.append(self.tracks[track_id])
+                if len(results) >= limit:
+                    break
+
+        return results
+
+class SqliteTrackStore():
+    """
+        Track database in sqlite file. Folders and tracks are stored in separate tables, so
+        opening of folder or changing of delete mark touches only rows of that folder or track.
+
+        folders:  (id, position, folder_name, mtime, entry_count, total_size, track_bytes)
+        tracks:   (id, folder_id, position, track_name, delete_mark)
+        metadata: (folder_id, track_name, size, mtime, title, artist, duration) - cached headers of tracks
+    """
+
+    def __init__(self, path_to_db):
+
+        self.path_to_db = path_to_db
+
+        #track list is saved by scan in worker thread, access to connection is serialized by lock
+        self.lock = threading.Lock()
+
+        #sqlite3 is imported only by profiles with sqlite database, other formats don't need it on device
+        import sqlite3
+        self.connection = sqlite3.connect(path_to_db, check_same_thread=False)
+
+        with self.lock:
+            #with write ahead log every mark is small append, readers don't block writer
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('PRAGMA foreign_keys=ON')
+
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS folders (
+                    id INTEGER PRIMARY KEY,
+                    position INTEGER NOT NULL,
+                    folder_name TEXT NOT NULL,
+                    mtime REAL,
+                    entry_count INTEGER,
+                    total_size INTEGER,
+                    track_bytes INTEGER);
+                CREATE UNIQUE INDEX IF NOT EXISTS folders_folder_name ON folders (folder_name);
+
+                CREATE TABLE IF NOT EXISTS tracks (
+                    id INTEGER PRIMARY KEY,
+                    folder_id INTEGER NOT NULL REFERENCES folders (id) ON DELETE CASCADE,
+                    position INTEGER NOT NULL,
+                    track_name TEXT NOT NULL,
+                    delete_mark INTEGER NOT NULL DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS tracks_folder_id_track_name ON tracks (folder_id, track_name);
+                CREATE INDEX IF NOT EXISTS tracks_delete_mark ON tracks (delete_mark);
+
+                CREATE TABLE IF NOT EXISTS metadata (
+                    folder_id INTEGER NOT NULL REFERENCES folders (id) ON DELETE CASCADE,
+                    track_name TEXT NOT NULL,
+                    size INTEGER,
+                    mtime REAL,
+                    title TEXT,
+                    artist TEXT,
+                    duration REAL,
+                    PRIMARY KEY (folder_id, track_name));
+            """)
+
+            #databases created before track_bytes column
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(folders)').fetchall()]
+            if 'track_bytes' not in columns:
+                self.connection.execute('ALTER TABLE folders ADD COLUMN track_bytes INTEGER')
+
+            self.connection.commit()
+
+    def close(self):
+
+        with self.lock:
+            self.connection.close()
+
+    def load_folders(self):
+        """
+            Returns track list of FolderRecord with not loaded tracks, counters of folders are
+            counted by one query over index of tracks
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT folders.folder_name, folders.mtime, folders.entry_count, folders.total_size, '
+                'folders.track_bytes, COUNT(tracks.id), TOTAL(tracks.delete_mark) '
+                'FROM folders LEFT JOIN tracks ON tracks.folder_id = folders.id '
+                'GROUP BY folders.id ORDER BY folders.position').fetchall()
+
+        track_list = []
+        for folder_name, mtime, entry_count, total_size, track_bytes, track_count, marked_count in rows:
+            fingerprint = None
+            if mtime != None:
+                fingerprint = (mtime, entry_count, total_size)
+            track_list.append(FolderRecord(folder_name, None, fingerprint,
+                                           stats=(track_count, int(marked_count), track_bytes)))
+        return track_list
+
+    def load_tracks(self, folder_name):
+        """
+            Returns tracks of folder: [[trackname, mark_to_delete]]
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT track_name, delete_mark FROM tracks WHERE folder_id = '
+                '(SELECT id FROM folders WHERE folder_name = ?) ORDER BY position', (folder_name,)).fetchall()
+
+        return [[track_name, bool(delete_mark)] for track_name, delete_mark in rows]
+
+    def load_metadata(self, folder_name):
+        """
+            Returns cached headers of tracks of folder: {trackname: (size, mtime, title, artist, duration)}
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT track_name, size, mtime, title, artist, duration FROM metadata WHERE folder_id = '
+                '(SELECT id FROM folders WHERE folder_name = ?)', (folder_name,)).fetchall()
+
+        return dict((row[0], tuple(row[1:])) for row in rows)
+
+    def save_metadata(self, folder_name, metadata):
+        """
+            Replaces cached headers of tracks of folder
+        """
+
+        with self.lock:
+            with self.connection:
+                row = self.connection.execute('SELECT id FROM folders WHERE folder_name = ?', (folder_name,)).fetchone()
+                if row == None:
+                    return
+                self.connection.execute('DELETE FROM metadata WHERE folder_id = ?', (row[0],))
+                self.connection.executemany(
+                    'INSERT INTO metadata (folder_id, track_name, size, mtime, title, artist, duration) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(row[0], track_name) + tuple(entry) for track_name, entry in metadata.items()])
+
+    def marked_folder_names(self):
+        """
+            Returns set of names of folders which have tracks marked to delete
+        """
+
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT DISTINCT folders.folder_name FROM tracks JOIN folders ON folders.id = tracks.folder_id '
+                'WHERE tracks.delete_mark = 1').fetchall()
+
+        return set(row[0] for row in rows)
+
+    def set_mark(self, folder_name, track_name, mark):
+        """
+            Updates delete mark of one track
+        """
+
+        with self.lock:
+            with self.connection:
+                self.connection.execute(
+                    'UPDATE tracks SET delete_mark = ? WHERE folder_id = '
+                    '(SELECT id FROM folders WHERE folder_name = ?) AND track_name = ?',
+                    (int(mark), folder_name, track_name))
+
+    def save_track_list(self, track_list):
+        """
+            Saves track list in one transaction. Tracks are rewritten only for folders which tracks
+            were loaded ('tracks' isn't None), rows of other folders stay untouched.
+        """
+
+        with self.lock:
+            with self.connection:
+
+                folder_ids = dict(self.connection.execute('SELECT folder_name, id FROM folders').fetchall())
+
+                #folders which aren't on removable media any more
+                folder_names = set(tr_rec['folder_name'] for tr_rec in track_list)
+                for folder_name, folder_id in folder_ids.items():
+                    if folder_name not in folder_names:
+                        self.connection.execute('DELETE FROM folders WHERE id = ?', (folder_id,))
+
+                for position, tr_rec in enumerate(track_list):
+
+                    fingerprint = tr_rec.get('fingerprint') or (None, None, None)
+                    folder_id = folder_ids.get(tr_rec['folder_name'])
+
+                    if folder_id == None:
+                        folder_id = self.connection.execute(
+                            'INSERT INTO folders (position, folder_name, mtime, entry_count, total_size, track_bytes) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (position, tr_rec['folder_name']) + tuple(fingerprint) + (tr_rec.track_bytes,)).lastrowid
+                    else:
+                        self.connection.execute(
+                            'UPDATE folders SET position = ?, mtime = ?, entry_count = ?, total_size = ?, '
+                            'track_bytes = ? WHERE id = ?',
+                            (position,) + tuple(fingerprint) + (tr_rec.track_bytes, folder_id))
+
+                    if tr_rec['tracks'] != None:
+                        self.connection.execute('DELETE FROM tracks WHERE folder_id = ?', (folder_id,))
+                        self.connection.executemany(
+                            'INSERT INTO tracks (folder_id, position, track_name, delete_mark) VALUES (?, ?, ?, ?)',
+                            [(folder_id, index, tr[0], int(tr[1])) for index, tr in enumerate(tr_rec['tracks'])])
+
+class ShardedTrackStore():
+    """
+        Track database split into small manifest of folders and one pickled shard of tracks per folder.
+        Only manifest is read when track list is loaded, shard is read when its folder is opened.
+        Loaded folders are kept in bounded LRU, only shards of changed folders are written back.
+
+        manifest: [(folder_name, fingerprint, count_of_marked_tracks, count_of_tracks, size_of_tracks)],
+                  manifests written before counters of tracks have only three first fields
+        shard:    [[trackname, mark_to_delete]]
+        metadata: {trackname: (size, mtime, title, artist, duration)}, written next to shard when
+                  headers of folder are read
+    """
+
+    manifest_filename = 'manifest.pkl'
+
+    #count of folders which tracks stay loaded after they were used
+    cache_size = 32
+
+    def __init__(self, path_to_db, cache_size=None):
+
+        self.path_to_db = path_to_db
+
+        if cache_size != None:
+            self.cache_size = cache_size
+
+        if not os.path.isdir(path_to_db):
+            os.makedirs(path_to_db)
+
+        #track list is saved by scan in worker thread
+        self.lock = threading.RLock()
+
+        #{folder_name: FolderRecord} of loaded folders, least recently used first
+        self.loaded_folders = OrderedDict()
+
+        #{folder_name: count_of_marked_tracks} of folders which shards are saved
+        self.marked_counts = {}
+
+    def close(self):
+
+        with self.lock:
+            self.loaded_folders.clear()
+
+    def shard_path(self, folder_name):
+        """
+            Returns path to shard of folder, its filename doesn't depend on characters of folder name
+        """
+        return os.path.join(self.path_to_db, hashlib.md5(folder_name.encode('utf-8')).hexdigest() + '.shard')
+
+    def metadata_path(self, folder_name):
+        return os.path.splitext(self.shard_path(folder_name))[0] + '.meta'
+
+    def load_folders(self):
+        """
+            Returns track list of FolderRecord with not loaded tracks
+        """
+
+        manifest = []
+
+        path_to_manifest = os.path.join(self.path_to_db, self.manifest_filename)
+        if os.path.exists(path_to_manifest):
+            f = open(path_to_manifest,'rb')
+            manifest = pickle.load(f)
+            f.close()
+
+        #old manifests don't know count and size of tracks
+        manifest = [tuple(entry) + (None, None)[:5 - len(entry)] for entry in manifest]
+
+        with self.lock:
+            self.loaded_folders.clear()
+            self.marked_counts = dict((entry[0], entry[2]) for entry in manifest)
+
+        return [FolderRecord(folder_name, None, fingerprint, stats=(track_count, marked_count, track_bytes))
+                for folder_name, fingerprint, marked_count, track_count, track_bytes in manifest]
+
+    def load_tracks(self, folder_name):
+        """
+            Returns tracks of folder: [[trackname, mark_to_delete]]
+        """
+
+        path_to_shard = self.shard_path(folder_name)
+        if not os.path.exists(path_to_shard):
+            return []
+
+        f = open(path_to_shard,'rb')
+        tracks = pickle.load(f)
+        f.close()
+
+        return tracks
+
+    def load_metadata(self, folder_name):
+        """
+            Returns cached headers of tracks of folder: {trackname: (size, mtime, title, artist, duration)}
+        """
+
+        path_to_metadata = self.metadata_path(folder_name)
+        if not os.path.exists(path_to_metadata):
+            return {}
+
+        f = open(path_to_metadata,'rb')
+        metadata = pickle.load(f)
+        f.close()
+
+        return metadata
+
+    def save_metadata(self, folder_name, metadata):
+        write_pickle_atomically(metadata, self.metadata_path(folder_name))
+
+    def marked_folder_names(self):
+        """
+            Returns set of names of folders which have tracks marked to delete in saved shards
+        """
+
+        with self.lock:
+            return set(folder_name for folder_name, marked_count in self.marked_counts.items() if marked_count > 0)
+
+    def write_shard(self, tr_rec):
+
+        write_pickle_atomically(tr_rec.to_dict()['tracks'], self.shard_path(tr_rec['folder_name']))
+        self.marked_counts[tr_rec['folder_name']] = tr_rec.marked_count()
+        tr_rec.dirty = False
+
+    def touch(self, tr_rec):
+        """
+            Moves loaded folder to the end of LRU
+        """
+
+        with self.lock:
+            self.loaded_folders.pop(tr_rec['folder_name'], None)
+            self.loaded_folders[tr_rec['folder_name']] = tr_rec
+
+    def trim(self):
+        """
+            Unloads least recently used folders above cache_size, changed ones are written before
+        """
+
+        with self.lock:
+            while len(self.loaded_folders) > self.cache_size:
+                folder_name, tr_rec = self.loaded_folders.popitem(last=False)
+                if tr_rec.loaded:
+                    if tr_rec.dirty:
+                        self.write_shard(tr_rec)
+                    tr_rec.set_tracks(None)
+                    tr_rec.metadata = None
+
+    def save_track_list(self, track_list):
+        """
+            Writes shards of changed and new folders, removes shards of folders which aren't in track_list
+            and writes manifest. Loaded folders which aren't in LRU are unloaded after it.
+        """
+
+        with self.lock:
+
+            for tr_rec in track_list:
+                if tr_rec.loaded and (tr_rec.dirty or tr_rec['folder_name'] not in self.marked_counts):
+                    self.write_shard(tr_rec)
+
+            #folders which aren't on removable media any more
+            records = dict((tr_rec['folder_name'], tr_rec) for tr_rec in track_list)
+            for folder_name in list(self.marked_counts):
+                if folder_name not in records:
+                    del self.marked_counts[folder_name]
+                    for path_to_file in (self.shard_path(folder_name), self.metadata_path(folder_name)):
+                        if os.path.exists(path_to_file):
+                            os.remove(path_to_file)
+
+            #records which were replaced by scan or removed aren't kept in LRU
+            for folder_name, tr_rec in list(self.loaded_folders.items()):
+                if records.get(folder_name) is not tr_rec:
+                    del self.loaded_folders[folder_name]
+
+            #manifest is written after shards, so it never points to shard which isn't written
+            write_pickle_atomically([(tr_rec['folder_name'], tr_rec.get('fingerprint'),
+                                      self.marked_counts.get(tr_rec['folder_name'], 0), tr_rec.track_count,
+                                      tr_rec.track_bytes) for tr_rec in track_list],
+                                    os.path.join(self.path_to_db, self.manifest_filename))
+
+            #every folder is saved now, folders loaded by scan are read from shards again when they're opened
+            for tr_rec in track_list:
+                if tr_rec.loaded and self.loaded_folders.get(tr_rec['folder_name']) is not tr_rec:
+                    tr_rec.set_tracks(None)
+
+            self.trim()
+
+class MappedTrackStore():
+    """
+        Track database in versioned binary snapshot which is opened with mmap. Opening reads only header
+        and table of folders, names of tracks are decoded when their folder is opened, delete mark
+        is changed by flipping its bit in mapped file.
+
+        header:        magic, version, header_size, folder_count, track_count and offsets of sections
+        folders:       (name_offset, name_length, first_track, track_count, has_fingerprint,
+                        mtime, entry_count, total_size, track_bytes) per folder, version 1 has no track_bytes
+        track offsets: track_count + 1 offsets of utf-8 names of tracks in names blob
+        names:         utf-8 names of folders, then names of every track in order of folders
+        marks:         bitmap of delete marks, bit per track
+    """
+
+    magic = b'CSTM'
+    version = 2
+
+    #magic, version, header_size, folder_count, track_count, folders, track offsets, names, marks offsets
+    header_struct = struct.Struct('<4sHHIIQQQQ')
+
+    #table of folders of every readable version, snapshot is always written in the latest one
+    folder_structs = {1: struct.Struct('<QIIIBdqq'), 2: struct.Struct('<QIIIBdqqq')}
+    folder_struct = folder_structs[version]
+
+    def __init__(self, path_to_db):
+
+        self.path_to_db = path_to_db
+
+        #marks are flipped from main thread while track list can be saved by scan in worker thread
+        self.lock = threading.RLock()
+
+        self.file = None
+        self.map = None
+
+        #{folder_name: (index_of_folder, first_track, track_count)}
+        self.folders = {}
+
+        #{folder_name: {trackname: index_of_track_in_folder}} of folders which marks were changed
+        self.track_indexes = {}
+
+        #{folder_name: {trackname: (size, mtime, title, artist, duration)}}, read when first needed
+        self.metadata = None
+
+        self.folder_count = self.track_count = 0
+        self.folders_offset = self.track_offsets_offset = self.names_offset = self.marks_offset = 0
+
+        #struct of table of folders of mapped file
+        self.mapped_folder_struct = self.folder_struct
+
+    def close(self):
+
+        with self.lock:
+            if self.map != None:
+                self.map.close()
+                self.file.close()
+            self.map = None
+            self.file = None
+
+    def open_map(self):
+        """
+            Maps database file and reads its header
+        """
+
+        self.close()
+        self.folders = {}
+        self.track_indexes = {}
+
+        if not os.path.exists(self.path_to_db):
+            self.folder_count = self.track_count = 0
+            return
+
+        self.file = open(self.path_to_db, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        (magic, version, header_size, self.folder_count, self.track_count, self.folders_offset,
+         self.track_offsets_offset, self.names_offset, self.marks_offset) = self.header_struct.unpack_from(self.map, 0)
+
+        if magic != self.magic or version not in self.folder_structs:
+            self.close()
+            raise ValueError('%s is not track database of version %d' % (self.path_to_db, self.version))
+
+        self.mapped_folder_struct = self.folder_structs[version]
+
+    def folder_entries(self):
+        """
+            Yields (folder_name, first_track, track_count, fingerprint, track_bytes) from table of folders,
+            track_bytes is None in files of version 1
+        """
+
+        folder_struct = self.mapped_folder_struct
+
+        for index in range(self.folder_count):
+
+            fields = folder_struct.unpack_from(self.map, self.folders_offset + index * folder_struct.size)
+            name_offset, name_length, first_track, track_count, has_fingerprint, mtime, entry_count, total_size = fields[:8]
+
+            start = self.names_offset + name_offset
+            fingerprint = None
+            if has_fingerprint:
+                fingerprint = (mtime, entry_count, total_size)
+
+            track_bytes = None
+            if len(fields) > 8 and fields[8] >= 0:
+                track_bytes = fields[8]
+
+            yield self.map[start:start + name_length].decode('utf-8'), first_track, track_count, fingerprint, track_bytes
+
+    def load_folders(self):
+        """
+            Returns track list of FolderRecord with not loaded tracks
+        """
+
+        with self.lock:
+            self.open_map()
+
+            entries = list(self.folder_entries())
+            for index, (folder_name, first_track, track_count, fingerprint, track_bytes) in enumerate(entries):
+                self.folders[folder_name] = (index, first_track, track_count)
+
+            marked_counts = self.marked_counts()
+
+            track_list = []
+            for folder_name, first_track, track_count, fingerprint, track_bytes in entries:
+                track_list.append(FolderRecord(folder_name, None, fingerprint,
+                                               stats=(track_count, marked_counts.get(folder_name, 0), track_bytes)))
+
+        return track_list
+
+    def encoded_tracks(self, folder_name):
+        """
+            Returns (utf-8 names, marks) of tracks of folder as they're stored in mapped file
+        """
+
+        folder = self.folders.get(folder_name)
+        if folder == None or folder[2] == 0:
+            return [], []
+
+        index, first_track, track_count = folder
+        offsets = struct.unpack_from('<%dQ' % (track_count + 1), self.map, self.track_offsets_offset + first_track * 8)
+        names = [self.map[self.names_offset + offsets[i]:self.names_offset + offsets[i + 1]] for i in range(track_count)]
+
+        marks_blob = bytearray(self.map[self.marks_offset + first_track // 8:
+                                        self.marks_offset + (first_track + track_count + 7) // 8 + 1])
+        start_bit = first_track & 7
+        marks = [bool(marks_blob[(start_bit + i) >> 3] & (1 << ((start_bit + i) & 7))) for i in range(track_count)]
+
+        return names, marks
+
+    def load_tracks(self, folder_name):
+        """
+            Returns tracks of folder: [[trackname, mark_to_delete]]
+        """
+
+        with self.lock:
+            names, marks = self.encoded_tracks(folder_name)
+        return [[name.decode('utf-8'), mark] for name, mark in zip(names, marks)]
+
+    def marked_counts(self):
+        """
+            Returns {folder_name: count_of_marked_tracks} of folders which have tracks marked to delete
+            in mapped file
+        """
+
+        with self.lock:
+
+            if self.map == None:
+                return {}
+
+            marks = bytearray(self.map[self.marks_offset:self.marks_offset + (self.track_count + 7) // 8])
+            marked_tracks = [byte_index * 8 + bit for byte_index, byte in enumerate(marks) if byte
+                             for bit in range(8) if byte & (1 << bit)]
+            if marked_tracks == []:
+                return {}
+
+            folder_starts = sorted((first_track, folder_name) for folder_name, (index, first_track, track_count)
+                                   in self.folders.items() if track_count > 0)
+            starts = [first_track for first_track, folder_name in folder_starts]
+
+            counts = {}
+            for track in marked_tracks:
+                folder_name = folder_starts[bisect.bisect_right(starts, track) - 1][1]
+                counts[folder_name] = counts.get(folder_name, 0) + 1
+            return counts
+
+    def marked_folder_names(self):
+        """
+            Returns set of names of folders which have tracks marked to delete in mapped file
+        """
+        return set(self.marked_counts())
+
+    def set_mark(self, folder_name, track_name, mark):
+        """
+            Flips delete mark of one track in mapped file and flushes its page
+        """
+
+        with self.lock:
+
+            folder = self.folders.get(folder_name)
+            if folder == None:
+                return
+
+            if folder_name not in self.track_indexes:
+                names, marks = self.encoded_tracks(folder_name)
+                self.track_indexes[folder_name] = dict((name.decode('utf-8'), index) for index, name in enumerate(names))
+
+            track_index = self.track_indexes[folder_name].get(track_name)
+            if track_index == None:
+                return
+
+            bit = folder[1] + track_index
+            position = self.marks_offset + (bit >> 3)
+            byte = bytearray(self.map[position:position + 1])[0]
+            if mark:
+                byte |= 1 << (bit & 7)
+            else:
+                byte &= ~(1 << (bit & 7)) & 0xff
+            self.map[position:position + 1] = bytes(bytearray([byte]))
+
+            page = position - position % mmap.ALLOCATIONGRANULARITY
+            self.map.flush(page, position + 1 - page)
+
+    def save_track_list(self, track_list):
+        """
+            Writes new snapshot of track list and maps it. Tracks of folders which weren't loaded
+            are copied from mapped file without decoding.
+        """
+
+        with self.lock:
+
+            folders = []
+            for tr_rec in track_list:
+                if tr_rec.loaded:
+                    names = [tr_rec.track_name(index).encode('utf-8') for index in range(len(tr_rec))]
+                    marks = [tr_rec.is_marked(index) for index in range(len(tr_rec))]
+                else:
+                    names, marks = self.encoded_tracks(tr_rec['folder_name'])
+                folders.append((tr_rec['folder_name'].encode('utf-8'), tr_rec.get('fingerprint'), names, marks,
+                                tr_rec.track_bytes))
+
+            snapshot = self.snapshot(folders)
+
+            self.close()
+
+            path_to_tmp = self.path_to_db + '.tmp'
+            f = open(path_to_tmp, 'wb')
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            getattr(os, 'replace', os.rename)(path_to_tmp, self.path_to_db)
+
+            self.open_map()
+            for index, entry in enumerate(list(self.folder_entries())):
+                self.folders[entry[0]] = (index, entry[1], entry[2])
+
+            #cached headers of folders which aren't in track list any more
+            metadata = self.load_all_metadata()
+            if any(folder_name not in self.folders for folder_name in metadata):
+                self.metadata = dict((folder_name, folder_metadata) for folder_name, folder_metadata
+                                     in metadata.items() if folder_name in self.folders)
+                write_pickle_atomically(self.metadata, self.path_to_db + '.meta')
+
+    def snapshot(self, folders):
+        """
+            Returns bytes of database file with folders:
+                [(utf-8 folder_name, fingerprint, utf-8 names, marks, track_bytes)]
+        """
+
+        track_count = sum(len(names) for folder_name, fingerprint, names, marks, track_bytes in folders)
+
+        folders_offset = self.header_struct.size
+        track_offsets_offset = folders_offset + len(folders) * self.folder_struct.size
+        names_offset = track_offsets_offset + (track_count + 1) * 8
+
+        folder_table = []
+        blob = []
+        blob_size = 0
+
+        for folder_name, fingerprint, names, marks, track_bytes in folders:
+            blob.append(folder_name)
+            blob_size += len(folder_name)
+
+        track_offsets = []
+        marks_bitmap = bytearray((track_count + 7) // 8)
+        first_track = 0
+        name_offset = 0
+
+        for folder_name, fingerprint, names, marks, track_bytes in folders:
+
+            #size of tracks which isn't known is written as -1
+            folder_table.append(self.folder_struct.pack(name_offset, len(folder_name), first_track, len(names),
+                                                        fingerprint != None, *(tuple(fingerprint or (0.0, 0, 0)) +
+                                                        (-1 if track_bytes == None else track_bytes,))))
+            name_offset += len(folder_name)
+
+            for index, (name, mark) in enumerate(zip(names, marks)):
+                track_offsets.append(blob_size)
+                blob.append(name)
+                blob_size += len(name)
+                if mark:
+                    marks_bitmap[(first_track + index) >> 3] |= 1 << ((first_track + index) & 7)
+
+            first_track += len(names)
+
+        track_offsets.append(blob_size)
+        marks_offset = names_offset + blob_size
+
+        header = self.header_struct.pack(self.magic, self.version, self.header_struct.size, len(folders), track_count,
+                                         folders_offset, track_offsets_offset, names_offset, marks_offset)
+
+        return b''.join([header] + folder_table + [struct.pack('<%dQ' % len(track_offsets), *track_offsets)] +
+                        blob + [bytes(marks_bitmap)])
+
+    def load_all_metadata(self):
+
+        if self.metadata == None:
+            self.metadata = {}
+            if os.path.exists(self.path_to_db + '.meta'):
+                f = open(self.path_to_db + '.meta', 'rb')
+                self.metadata = pickle.load(f)
+                f.close()
+        return self.metadata
+
+    def load_metadata(self, folder_name):
+        """
+            Returns cached headers of tracks of folder: {trackname: (size, mtime, title, artist, duration)}
+        """
+
+        with self.lock:
+            return dict(self.load_all_metadata().get(folder_name, {}))
+
+    def save_metadata(self, folder_name, metadata):
+        """
+            Replaces cached headers of tracks of folder, they're kept in pickle next to database file
+        """
+
+        with self.lock:
+            self.load_all_metadata()[folder_name] = metadata
+            write_pickle_atomically(self.metadata, self.path_to_db + '.meta')
+
+class DeletionJob():
+    """
+        Deletes marked tracks in background in two steps:
+            stage()    - moves marked tracks into trash folder on the same removable media (cheap renames),
+                         after it track list can be updated and saved at once
+            purge()    - deletes files from trash folder in batches with progress
+        Before purge() staged tracks can be moved back with undo().
+
+        self.staged contains list of tuples (folder_name, index_of_track_in_folder, trackname)
+        self.failures contains list of tuples (path_to_file, error message)
+        self.sizes contains {(folder_name, trackname): size} of staged tracks
+    """
+
+    #trash folder in root of removable media, MediaScanner doesn't list it as folder with tracks
+    trash_folder_name = '.carstereoenumerator-trash'
+
+    #count of files deleted between progress reports
+    purge_batch_size = 50
+
+    def __init__(self, path_to_removable_media, marked_tracks):
+        """
+            marked_tracks: list    #tuples (folder_name, index_of_track_in_folder, trackname) of marked tracks
+        """
+
+        self.path_to_removable_media = unicode(path_to_removable_media)
+        self.path_to_trash = os.path.join(self.path_to_removable_media, self.trash_folder_name)
+        self.marked_tracks = marked_tracks
+
+        self.staged = []
+        self.failures = []
+        self.purged = 0
+        self.sizes = {}
+
+    def trash_path(self, folder_name, track_name):
+        return os.path.join(self.path_to_trash, folder_name, track_name)
+
+    def bytes_by_folder(self, tracks):
+        """
+            Returns {folder_name: size_of_tracks} of tracks: list of tuples (folder_name, index_of_track_in_folder, trackname)
+        """
+
+        folder_bytes = {}
+        for folder_name, track_index, track_name in tracks:
+            folder_bytes[folder_name] = folder_bytes.get(folder_name, 0) + self.sizes.get((folder_name, track_name), 0)
+        return folder_bytes
+
+    def stage(self, progress_callback=None):
+        """
+            Moves marked tracks into trash folder. Tracks which can't be moved stay marked in track list.
+                progress_callback: function    #called with (count_of_staged, count_of_marked)
+        """
+
+        for index, (folder_name, track_index, track_name) in enumerate(self.marked_tracks):
+
+            path_to_file = os.path.join(self.path_to_removable_media, folder_name, track_name)
+
+            try:
+                #size is taken before renaming, it's subtracted from size of tracks of folder
+                size = os.stat(path_to_file).st_size
+                if not os.path.isdir(os.path.join(self.path_to_trash, folder_name)):
+                    os.makedirs(os.path.join(self.path_to_trash, folder_name))
+                os.rename(path_to_file, self.trash_path(folder_name, track_name))
+                self.staged.append((folder_name, track_index, track_name))
+                self.sizes[(folder_name, track_name)] = size
+
+            except OSError as exception:
+                self.failures.append((path_to_file, exception.strerror))
+
+            if progress_callback != None and index % self.purge_batch_size == 0:
+                progress_callback(index, len(self.marked_tracks))
+
+        Logger.info('DeletionJob: %d tracks moved to trash, %d failed' % (len(self.staged), len(self.failures)))
+
+    def undo(self):
+        """
+            Moves staged tracks back from trash folder
+            Returns list of tuples (folder_name, index_of_track_in_folder, trackname) of restored tracks
+        """
+
+        restored = []
+
+        for folder_name, track_index, track_name in self.staged:
+
+            path_to_file = os.path.join(self.path_to_removable_media, folder_name, track_name)
+
+            try:
+                os.rename(self.trash_path(folder_name, track_name), path_to_file)
+                restored.append((folder_name, track_index, track_name))
+
+            except OSError as exception:
+                self.failures.append((path_to_file, exception.strerror))
+
+        self.staged = []
+        self.remove_trash_folders()
+
+        return restored
+
+    def purge(self, progress_callback=None):
+        """
+            Deletes every file in trash folder, files left there by interrupted job are deleted too.
+                progress_callback: function    #called after every batch with (count_of_deleted, count_of_files)
+        """
+
+        if not os.path.isdir(self.path_to_trash):
+            return
+
+        paths = []
+        for folder_name in os.listdir(self.path_to_trash):
+            path_to_folder = os.path.join(self.path_to_trash, folder_name)
+            if os.path.isdir(path_to_folder):
+                paths.extend(os.path.join(path_to_folder, track_name) for track_name in os.listdir(path_to_folder))
+
+        for start in range(0, len(paths), self.purge_batch_size):
+
+            for path_to_file in paths[start:start + self.purge_batch_size]:
+                try:
+                    os.remove(path_to_file)
+                    self.purged += 1
+                except OSError as exception:
+                    self.failures.append((path_to_file, exception.strerror))
+
+            if progress_callback != None:
+                progress_callback(min(start + self.purge_batch_size, len(paths)), len(paths))
+
+        self.staged = []
+        self.remove_trash_folders()
+
+        Logger.info('DeletionJob: %d files purged, %d failed' % (self.purged, len(self.failures)))
+
+    def remove_trash_folders(self):
+        """
+            Removes empty folders of trash, car stereo shouldn't see them
+        """
+
+        if not os.path.isdir(self.path_to_trash):
+            return
+
+        for folder_name in os.listdir(self.path_to_trash):
+            try:
+                os.rmdir(os.path.join(self.path_to_trash, folder_name))
+            except OSError:
+                #folder isn't empty, some files couldn't be deleted
+                pass
+
+        try:
+            os.rmdir(self.path_to_trash)
+        except OSError:
+            pass
+
+def format_size(size):
+    """
+        Returns size in bytes as text for user: '512 B', '3.4 MB', '2.1 GB'
+    """
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            break
+        size /= 1024.0
+
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %s' % (size, unit)
+
+def stats_text(stats):
+    """
+        Returns counters (track_count, marked_count, track_bytes) of folder or profile as '12/340 marked, 2.1 GB'
+    """
+
+    track_count, marked_count, track_bytes = stats
+    text = '%d/%d marked' % (marked_count, track_count)
+    if track_bytes != None:
+        text += ', ' + format_size(track_bytes)
+    return text
+
+def write_pickle_atomically(obj, path_to_file):
+    """
+        Pickles obj into temporary file and replaces path_to_file with it, so path_to_file
+        contains either old or new data even if application is killed while writing
+    """
+
+    path_to_tmp = path_to_file + '.tmp'
+
+    f = open(path_to_tmp,'wb')
+    pickle.dump(obj,f)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+    #os.replace doesn't exist in python 2, os.rename replaces file atomically on posix
+    getattr(os, 'replace', os.rename)(path_to_tmp, path_to_file)
+
+class SaveScheduler():
+    """
+        Write-behind of saves. Save requested by request() is performed by timer thread delay seconds
+        after first request of its key, next requests of the same key in this time are coalesced into
+        that save (which gets arguments of last request). flush() performs pending saves at once,
+        it's called on pause and stop of application.
+
+        self.requested and self.performed count requested and performed saves
+    """
+
+    delay = 2.0
+
+    def __init__(self, delay=None):
+
+        if delay != None:
+            self.delay = delay
+
+        #{key: (deadline, function, args)}
+        self.pending = {}
+
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = False
+
+        self.requested = 0
+        self.performed = 0
+
+    def request(self, key, function, *args):
+        """
+            Schedules function(*args) as save of key
+        """
+
+        instrumentation.count('saves.requested')
+
+        with self.condition:
+
+            self.requested += 1
+
+            if not self.stopped:
+                deadline = time.time() + self.delay
+                if key in self.pending:
+                    deadline = self.pending[key][0]
+                self.pending[key] = (deadline, function, args)
+
+                if self.thread == None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+                self.condition.notify()
+                return
+
+        #after stop() saves aren't delayed
+        self.perform(function, args)
+
+    def cancel(self, key):
+        """
+            Drops pending save of key, it's called when key is saved directly
+        """
+
+        with self.condition:
+            self.pending.pop(key, None)
+
+    def has_pending(self):
+
+        with self.condition:
+            return self.pending != {}
+
+    def run(self):
+
+        while True:
+
+            with self.condition:
+
+                while not self.stopped:
+                    if self.pending == {}:
+                        self.condition.wait()
+                        continue
+                    timeout = min(deadline for deadline, function, args in self.pending.values()) - time.time()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+
+                if self.stopped:
+                    return
+
+                now = time.time()
+                saves = [(key, save) for key, save in self.pending.items() if save[0] <= now]
+                for key, save in saves:
+                    del self.pending[key]
+
+            for key, (deadline, function, args) in saves:
+                self.perform(function, args)
+
+    def perform(self, function, args):
+
+        try:
+            function(*args)
+        except Exception:
+            Logger.exception('SaveScheduler: save failed')
+
+        with self.condition:
+            self.performed += 1
+        instrumentation.count('saves.performed')
+
+    def flush(self):
+        """
+            Performs every pending save in calling thread
+        """
+
+        with self.condition:
+            saves = sorted(self.pending.values(), key=lambda save: save[0])
+            self.pending.clear()
+
+        for deadline, function, args in saves:
+            self.perform(function, args)
+
+    def stop(self):
+        """
+            Flushes pending saves and stops timer thread, later saves are performed at once
+        """
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        #save which timer thread is performing is finished before application exits
+        if self.thread != None:
+            self.thread.join()
+
+        self.flush()
+
+        Logger.info('SaveScheduler: %d saves requested, %d performed' % (self.requested, self.performed))
+
+def queue_of_folders(track_list):
+    """
+        Returns queue with indexes of all folders of track_list
+    """
+
+    folders_queue = queue.Queue()
+    for index in range(len(track_list)):
+        folders_queue.put(index)
+    return folders_queue
+
+def map_in_threads(function, items, threads, progress_callback=None, cancel_event=None):
+    """
+        Calls function for every item by worker threads and returns list of results in order of items.
+        Items not processed because cancel_event was set have result None.
+            progress_callback(processed, count)    #called from worker threads
+    """
+
+    items_queue = queue.Queue()
+    for index in range(len(items)):
+        items_queue.put(index)
+
+    results = [None] * len(items)
+    lock = threading.Lock()
+    counter = [0]
+
+    def worker():
+        while cancel_event == None or not cancel_event.is_set():
+            try:
+                index = items_queue.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = function(items[index])
+            with lock:
+                counter[0] += 1
+                processed = counter[0]
+            if progress_callback != None:
+                progress_callback(processed, len(items))
+
+    workers = [threading.Thread(target=worker) for i in range(max(1, min(threads, len(items))))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return results
+
+class HashCache():
+    """
+        Content hashes of tracks, saved in profile next to track list. Entry is keyed by path of track
+        relative to removable media and is valid while size and mtime of file stay the same:
+            self.entries: {relative_path: (size, mtime, partial_hash, full_hash)}
+        Hashes which weren't computed yet are None.
+    """
+
+    def __init__(self, path_to_cache):
+
+        self.path_to_cache = path_to_cache
+        self.entries = {}
+        self.changed = False
+
+        #entries are stored by hashing threads
+        self.lock = threading.Lock()
+
+        if os.path.exists(path_to_cache):
+            try:
+                f = open(path_to_cache, 'rb')
+                self.entries = pickle.load(f)
+                f.close()
+            except Exception as exception:
+                #cache is only an optimization, broken cache is computed again
+                Logger.warning('HashCache: %s not loaded: %s' % (path_to_cache, exception))
+
+    def lookup(self, relative_path, size, mtime):
+        """
+            Returns (partial_hash, full_hash) of unchanged file, (None, None) if file isn't cached or was changed
+        """
+
+        entry = self.entries.get(relative_path)
+        if entry == None or entry[0] != size or entry[1] != mtime:
+            return None, None
+        return entry[2], entry[3]
+
+    def store(self, relative_path, size, mtime, partial_hash=None, full_hash=None):
+
+        with self.lock:
+            entry = self.entries.get(relative_path)
+            if entry != None and entry[0] == size and entry[1] == mtime:
+                partial_hash = partial_hash or entry[2]
+                full_hash = full_hash or entry[3]
+            self.entries[relative_path] = (size, mtime, partial_hash, full_hash)
+            self.changed = True
+
+    def prune(self, relative_paths):
+        """
+            Removes entries of files which aren't in relative_paths any more
+        """
+
+        with self.lock:
+            for relative_path in list(self.entries):
+                if relative_path not in relative_paths:
+                    del self.entries[relative_path]
+                    self.changed = True
+
+    def save(self):
+
+        with self.lock:
+            if self.changed:
+                write_pickle_atomically(self.entries, self.path_to_cache)
+                self.changed = False
+
+class DuplicateFinder():
+    """
+        Finds tracks with the same content on removable media. Files are compared in steps, every step
+        only looks at candidates left by previous one:
+            1. size of every track (stat) - tracks with unique size can't have duplicates
+            2. hash of first partial_hash_size bytes of tracks with the same size
+            3. hash of whole file of tracks with the same partial hash (files not longer than
+               partial_hash_size were already hashed whole by step 2)
+        Files are read by hash_threads threads, hashes are kept in HashCache, so unchanged files
+        aren't read again by next search.
+
+        self.groups contains list of groups of duplicates, every group is list of tuples
+        (folder_name, index_of_track_in_folder, trackname) in order of track list
+        self.duplicate_bytes contains size of all copies except one of every group
+    """
+
+    partial_hash_size = 64 * 1024
+
+    #size of blocks in which whole files are read
+    read_size = 1024 * 1024
+
+    hash_threads = 4
+
+    def __init__(self, path_to_removable_media, hash_cache=None, hash_threads=None):
+
+        self.path_to_removable_media = unicode(path_to_removable_media)
+        self.hash_cache = hash_cache
+        if hash_threads != None:
+            self.hash_threads = hash_threads
+
+        self.groups = []
+        self.duplicate_bytes = 0
+        self.files_read = 0
+
+    def stat_track(self, track):
+        """
+            Returns (track, relative_path, size, mtime) of track, None if file doesn't exist
+        """
+
+        relative_path = os.path.join(track[0], track[2])
+        try:
+            stat = os.stat(os.path.join(self.path_to_removable_media, relative_path))
+        except OSError:
+            return None
+        return (track, relative_path, stat.st_size, stat.st_mtime)
+
+    def hash_file(self, relative_path, limit=None):
+        """
+            Returns sha1 of first limit bytes of file (of whole file if limit is None)
+        """
+
+        digest = hashlib.sha1()
+        f = open(os.path.join(self.path_to_removable_media, relative_path), 'rb')
+        try:
+            remaining = limit
+            while remaining == None or remaining > 0:
+                block = f.read(self.read_size if remaining == None else min(self.read_size, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                if remaining != None:
+                    remaining -= len(block)
+        finally:
+            f.close()
+
+        self.files_read += 1
+        return digest.hexdigest()
+
+    def cached_hash(self, stat, full):
+        """
+            Returns partial or full hash of file from cache, file is read only if hash isn't cached.
+            Returns None if file can't be read.
+        """
+
+        track, relative_path, size, mtime = stat
+
+        if self.hash_cache != None:
+            partial_hash, full_hash = self.hash_cache.lookup(relative_path, size, mtime)
+            if full and full_hash != None:
+                return full_hash
+            if not full and partial_hash != None:
+                return partial_hash
+
+        try:
+            file_hash = self.hash_file(relative_path, None if full else self.partial_hash_size)
+        except (IOError, OSError) as exception:
+            Logger.warning('DuplicateFinder: %s not hashed: %s' % (relative_path, exception))
+            return None
+
+        if self.hash_cache != None:
+            if full:
+                self.hash_cache.store(relative_path, size, mtime, full_hash=file_hash)
+            else:
+                self.hash_cache.store(relative_path, size, mtime, partial_hash=file_hash)
+        return file_hash
+
+    def group_by(self, stats, key):
+        """
+            Returns groups of stats with the same key which have more than one member
+        """
+
+        groups = OrderedDict()
+        for stat in stats:
+            value = key(stat)
+            if value != None:
+                groups.setdefault(value, []).append(stat)
+        return [group for group in groups.values() if len(group) > 1]
+
+    @instrumented('DuplicateFinder.find')
+    def find(self, tracks, progress_callback=None, cancel_event=None):
+        """
+            Finds duplicates among tracks, returns self.groups.
+                tracks: list    #tuples (folder_name, index_of_track_in_folder, trackname)
+                progress_callback(step, processed, count)    #step is 'stat', 'partial' or 'full'
+        """
+
+        def progress(step):
+            if progress_callback == None:
+                return None
+            return lambda processed, count: progress_callback(step, processed, count)
+
+        stats = [stat for stat in map_in_threads(self.stat_track, tracks, self.hash_threads,
+                                                 progress('stat'), cancel_event) if stat != None]
+
+        #cancelled stat pass doesn't list every track, their cached hashes are kept
+        if self.hash_cache != None and (cancel_event == None or not cancel_event.is_set()):
+            self.hash_cache.prune(set(stat[1] for stat in stats))
+
+        #empty files are all equal, but they aren't worth deleting as duplicates
+        size_groups = self.group_by(stats, lambda stat: stat[2] or None)
+
+        candidates = [stat for group in size_groups for stat in group]
+        partial_hashes = dict(zip((stat[1] for stat in candidates),
+                                  map_in_threads(lambda stat: self.cached_hash(stat, False), candidates,
+                                                 self.hash_threads, progress('partial'), cancel_event)))
+
+        partial_groups = []
+        for size_group in size_groups:
+            partial_groups.extend(self.group_by(size_group, lambda stat: partial_hashes[stat[1]]))
+
+        #partial hash of file not longer than partial_hash_size covers whole file
+        groups = [group for group in partial_groups if group[0][2] <= self.partial_hash_size]
+        partial_groups = [group for group in partial_groups if group[0][2] > self.partial_hash_size]
+
+        candidates = [stat for group in partial_groups for stat in group]
+        full_hashes = dict(zip((stat[1] for stat in candidates),
+                               map_in_threads(lambda stat: self.cached_hash(stat, True), candidates,
+                                              self.hash_threads, progress('full'), cancel_event)))
+
+        for partial_group in partial_groups:
+            groups.extend(self.group_by(partial_group, lambda stat: full_hashes[stat[1]]))
+
+        if cancel_event != None and cancel_event.is_set():
+            groups = []
+
+        #groups are reported in order of track list
+        positions = dict((stat[1], position) for position, stat in enumerate(stats))
+        groups.sort(key=lambda group: positions[group[0][1]])
+
+        self.groups = [[stat[0] for stat in group] for group in groups]
+        self.duplicate_bytes = sum(group[0][2] * (len(group) - 1) for group in groups)
+        return self.groups
+
+class LibrarySync():
+    """
+        Mirrors local source library onto removable media. Car stereo sees only top level folders, so every
+        folder of library which has tracks becomes top level folder named by its path in library
+        ('Artist - Album'). Names of folders and tracks are cleared with the same rules as
+        MediaScanner.clear_file_names, so next scan has nothing to rename.
+
+        Files are compared in two steps:
+            1. size and mtime - copied file gets mtime of its source, so unchanged file is found by stat only
+            2. with compare_hashes files of the same size and other mtime are compared by sha1 (cached in
+               HashCache), file with the same content isn't copied, it only gets mtime of its source
+        Changed and new files are copied by copy_threads threads into temporary file which is renamed
+        when whole file is written, so car stereo never sees half copied track.
+
+        self.plan contains list of tuples (path_to_source_file, folder_name, trackname, size, mtime)
+        self.folders contains {folder_name: [tracknames in order of library]} of synced folders
+        self.copied contains list of tuples (folder_name, trackname) of copied tracks
+        self.pruned contains list of tuples (folder_name, trackname) of tracks removed with prune
+        self.failures contains list of tuples (path_to_file, error message)
+    """
+
+    folder_separator = u' - '
+
+    #name of folder for tracks which are in root of library
+    root_folder_name = u'Library'
+
+    #parallel copies, removable media is slower than local disk, so few threads are enough
+    copy_threads = 2
+
+    #size of blocks of buffered copying
+    buffer_size = 1024 * 1024
+
+    #FAT stores mtime with 2 seconds resolution
+    mtime_tolerance = 2
+
+    temporary_suffix = u'.part'
+
+    def __init__(self, path_to_source_library, path_to_removable_media, hash_cache=None, source_hash_cache=None,
+                 copy_threads=None, compare_hashes=False, prune=False):
+        """
+            hash_cache: HashCache           #hashes of tracks of removable media (shared with DuplicateFinder)
+            source_hash_cache: HashCache    #hashes of files of source library
+            compare_hashes: boolean         #files with other mtime are compared by content
+            prune: boolean                  #tracks of synced folders which aren't in library are removed
+        """
+
+        self.path_to_source_library = unicode(path_to_source_library)
+        self.path_to_removable_media = unicode(path_to_removable_media)
+        self.compare_hashes = compare_hashes
+        self.prune = prune
+        if copy_threads != None:
+            self.copy_threads = copy_threads
+
+        #hashes are computed and cached by DuplicateFinder of every side
+        self.source_hasher = DuplicateFinder(self.path_to_source_library, source_hash_cache)
+        self.media_hasher = DuplicateFinder(self.path_to_removable_media, hash_cache)
+
+        self.plan = []
+        self.folders = {}
+        self.copied = []
+        self.pruned = []
+        self.failures = []
+        self.bytes_copied = 0
+
+        #copying threads append to results
+        self.lock = threading.Lock()
+
+    def target_folder_name(self, relative_path, taken):
+        """
+            Returns name of top level folder for folder of library, taken contains lower case names of
+            folders of other folders of library
+        """
+
+        if relative_path == os.curdir:
+            folder_name = self.root_folder_name
+        else:
+            folder_name = self.folder_separator.join(relative_path.split(os.sep))
+
+        folder_name = folder_name.translate(MediaScanner.sanitize_table).strip() or self.root_folder_name
+
+        while folder_name.lower() in taken:
+            folder_name += RenamePlan.collision_suffix
+        taken.add(folder_name.lower())
+
+        return folder_name
+
+    @instrumented('sync.plan')
+    def plan_sync(self):
+        """
+            Walks source library and plans target of every track
+        """
+
+        #trash of removable media is never target folder, folder of library with its name gets other name
+        taken = set([DeletionJob.trash_folder_name.lower()])
+
+        for path_to_folder, folder_names, file_names in os.walk(self.path_to_source_library):
+
+            #folders are walked in the same order every time, so collisions of names are resolved the same way
+            folder_names.sort()
+
+            track_names = sorted(name for name in file_names if name.endswith(MediaScanner.track_extensions))
+            if track_names == []:
+                continue
+
+            folder_name = self.target_folder_name(os.path.relpath(path_to_folder, self.path_to_source_library), taken)
+
+            #names of tracks are cleared in memory, source files aren't renamed
+            new_names = RenamePlan(path_to_folder, track_names, track_names, MediaScanner.sanitize_table).new_names
+            self.folders[folder_name] = new_names
+
+            for track_name, new_name in zip(track_names, new_names):
+                path_to_file = os.path.join(path_to_folder, track_name)
+                try:
+                    stat = os.stat(path_to_file)
+                except OSError as exception:
+                    self.failures.append((path_to_file, exception.strerror))
+                    continue
+                self.plan.append((path_to_file, folder_name, new_name, stat.st_size, stat.st_mtime))
+
+    def needs_copy(self, entry):
+        """
+            Returns True if track of plan isn't on removable media or differs from its source
+        """
+
+        path_to_file, folder_name, track_name, size, mtime = entry
+        relative_path = os.path.join(folder_name, track_name)
+        path_to_target = os.path.join(self.path_to_removable_media, relative_path)
+
+        try:
+            stat = os.stat(path_to_target)
+        except OSError:
+            return True
+
+        if stat.st_size != size:
+            return True
+        if abs(stat.st_mtime - mtime) <= self.mtime_tolerance:
+            return False
+        if not self.compare_hashes:
+            return True
+
+        source_hash = self.source_hasher.cached_hash(
+            (None, os.path.relpath(path_to_file, self.path_to_source_library), size, mtime), True)
+        target_hash = self.media_hasher.cached_hash((None, relative_path, stat.st_size, stat.st_mtime), True)
+        if source_hash == None or source_hash != target_hash:
+            return True
+
+        #next sync finds this track unchanged by stat
+        try:
+            os.utime(path_to_target, (mtime, mtime))
+            if self.media_hasher.hash_cache != None:
+                stat = os.stat(path_to_target)
+                self.media_hasher.hash_cache.store(relative_path, stat.st_size, stat.st_mtime, full_hash=target_hash)
+        except OSError as exception:
+            Logger.warning('LibrarySync: mtime of %s not changed: %s' % (path_to_target, exception.strerror))
+
+        return False
+
+    def copy_data(self, source, target):
+        """
+            Copies content of open source file into open target file in blocks of buffer_size
+        """
+
+        while True:
+            block = source.read(self.buffer_size)
+            if not block:
+                return
+            target.write(block)
+
+    def copy_track(self, entry):
+        """
+            Copies track of plan into temporary file and renames it to name of track
+            Returns True if track was copied
+        """
+
+        path_to_file, folder_name, track_name, size, mtime = entry
+        path_to_folder = os.path.join(self.path_to_removable_media, folder_name)
+        path_to_target = os.path.join(path_to_folder, track_name)
+
+        #name of temporary file doesn't end with extension of tracks, so scanner doesn't take it as track
+        path_to_tmp = os.path.join(path_to_folder, u'.' + track_name + self.temporary_suffix)
+
+        try:
+            source = open(path_to_file, 'rb')
+            try:
+                target = open(path_to_tmp, 'wb')
+                try:
+                    self.copy_data(source, target)
+                    target.flush()
+                    os.fsync(target.fileno())
+                finally:
+                    target.close()
+            finally:
+                source.close()
+
+            os.utime(path_to_tmp, (mtime, mtime))
+            getattr(os, 'replace', os.rename)(path_to_tmp, path_to_target)
+
+        except (IOError, OSError) as exception:
+            with self.lock:
+                self.failures.append((path_to_target, exception.strerror))
+            if os.path.exists(path_to_tmp):
+                os.remove(path_to_tmp)
+            return False
+
+        with self.lock:
+            self.copied.append((folder_name, track_name))
+            self.bytes_copied += size
+        instrumentation.count('sync.bytes_copied', size)
+        return True
+
+    def prune_folders(self):
+        """
+            Removes tracks of synced folders which aren't in source library any more
+        """
+
+        for folder_name, track_names in self.folders.items():
+
+            #tracks in trash are removed only by DeletionJob
+            if folder_name == DeletionJob.trash_folder_name:
+                continue
+
+            path_to_folder = os.path.join(self.path_to_removable_media, folder_name)
+            if not os.path.isdir(path_to_folder):
+                continue
+
+            names = set(track_names)
+            for name in os.listdir(path_to_folder):
+                if name.endswith(MediaScanner.track_extensions) and name not in names:
+                    try:
+                        os.remove(os.path.join(path_to_folder, name))
+                        self.pruned.append((folder_name, name))
+                    except OSError as exception:
+                        self.failures.append((os.path.join(path_to_folder, name), exception.strerror))
+
+    @instrumented('sync.run')
+    def run(self, progress_callback=None, cancel_event=None):
+        """
+            Plans, compares and copies tracks.
+                progress_callback: function    #called from worker threads with (step, done, count),
+                                               #step is 'compare' or 'copy'
+                cancel_event: threading.Event  #set to stop sync, copied tracks stay on removable media
+        """
+
+        def progress(step):
+            if progress_callback == None:
+                return None
+            return lambda done, count: progress_callback(step, done, count)
+
+        self.plan_sync()
+
+        changed = map_in_threads(self.needs_copy, self.plan, self.copy_threads, progress('compare'), cancel_event)
+        to_copy = [entry for entry, copy in zip(self.plan, changed) if copy]
+
+        for folder_name in set(entry[1] for entry in to_copy):
+            path_to_folder = os.path.join(self.path_to_removable_media, folder_name)
+            if not os.path.isdir(path_to_folder):
+                os.makedirs(path_to_folder)
+
+        map_in_threads(self.copy_track, to_copy, self.copy_threads, progress('copy'), cancel_event)
+
+        if self.prune and (cancel_event == None or not cancel_event.is_set()):
+            self.prune_folders()
+
+        Logger.info('LibrarySync: %d of %d tracks copied (%d bytes), %d pruned, %d failed' % \
+            (len(self.copied), len(self.plan), self.bytes_copied, len(self.pruned), len(self.failures)))
+
+class FileSlices(object):
+    """
+        Read only view of file for AudioMetadataReader when file can't be memory mapped:
+        data[start:stop] reads only bytes of slice, len(data) is size of file
+    """
+
+    def __init__(self, f):
+
+        self.f = f
+        f.seek(0, os.SEEK_END)
+        self.size = f.tell()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+
+        start, stop, step = key.indices(self.size)
+        if stop <= start:
+            return b''
+        self.f.seek(start)
+        return self.f.read(stop - start)
+
+    def close(self):
+        pass
+
+def syncsafe_int(data):
+    """
+        Returns integer of ID3v2 syncsafe bytes (7 bits of every byte are used)
+    """
+
+    value = 0
+    for byte in bytearray(data):
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+class AudioMetadataReader():
+    """
+        Reads title, artist and duration of track from headers of ID3 (mp3), FLAC and WAV files.
+        File is memory mapped, so only pages which are looked at are read from removable media:
+        beginning of file, headers of tag frames and metadata blocks (their bodies are jumped over,
+        not read, e.g. cover pictures), first MPEG frame and ID3v1 tag in last 128 bytes.
+    """
+
+    #longest text frame, vorbis comment or INFO list which is read
+    max_text_size = 16 * 1024
+
+    #bytes after ID3v2 tag searched for first MPEG frame
+    frame_search_size = 4096
+
+    #ID3v2.2 and ID3v2.3/2.4 frames with title, artist and length in milliseconds
+    id3_frames = {'TT2': 'title', 'TIT2': 'title', 'TP1': 'artist', 'TPE1': 'artist',
+                  'TLE': 'duration', 'TLEN': 'duration'}
+
+    id3_encodings = {0: 'latin-1', 1: 'utf-16', 2: 'utf-16-be', 3: 'utf-8'}
+
+    #kbit/s by (mpeg1, layer) where layer 3 is layer I and 1 is layer III
+    mpeg_bitrates = {
+        (True, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+        (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+        (True, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+        (False, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+        (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+        (False, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160)}
+
+    #Hz by version bits of MPEG frame header: 3 is MPEG1, 2 is MPEG2, 0 is MPEG2.5
+    mpeg_samplerates = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+    def read(self, path_to_file):
+        """
+            Returns (title, artist, duration_in_seconds) of track, unknown values are None
+        """
+
+        result = {'title': None, 'artist': None, 'duration': None}
+
+        f = open(path_to_file, 'rb')
+        try:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                #empty file or file system without mmap support
+                data = FileSlices(f)
+
+            try:
+                self.parse(data, path_to_file.lower().endswith('.mp3'), result)
+            except (struct.error, IndexError, ValueError, LookupError) as exception:
+                Logger.debug('AudioMetadataReader: broken header of %s: %s' % (path_to_file, exception))
+            finally:
+                data.close()
+        finally:
+            f.close()
+
+        return result['title'], result['artist'], result['duration']
+
+    def parse(self, data, mpeg, result):
+
+        magic = data[0:4]
+
+        if magic == b'fLaC':
+            self.parse_flac(data, result)
+
+        elif magic == b'RIFF' and data[8:12] == b'WAVE':
+            self.parse_wav(data, result)
+
+        else:
+            audio_start = 0
+            if magic[:3] == b'ID3':
+                audio_start = self.parse_id3v2(data, result)
+            audio_end = self.parse_id3v1(data, result)
+
+            if mpeg and result['duration'] == None:
+                result['duration'] = self.mpeg_duration(data, audio_start, audio_end)
+
+    def decode_id3_text(self, raw):
+
+        if len(raw) < 2:
+            return None
+        encoding = self.id3_encodings.get(bytearray(raw[:1])[0], 'latin-1')
+        text = raw[1:].decode(encoding, 'replace')
+
+        #frame can contain several strings separated by zero
+        return text.split(u'\0')[0].strip() or None
+
+    def parse_id3v2(self, data, result):
+        """
+            Reads frames of ID3v2 tag at start of data, returns offset of first byte after tag
+        """
+
+        header = bytearray(data[0:10])
+        version, flags = header[3], header[5]
+        tag_end = 10 + syncsafe_int(header[6:10])
+
+        position = 10
+        if flags & 0x40 and version == 3:
+            position += 4 + struct.unpack('>I', data[10:14])[0]
+        elif flags & 0x40 and version == 4:
+            position += syncsafe_int(data[10:14])
+
+        id_size, header_size = (3, 6) if version == 2 else (4, 10)
+
+        while position + header_size <= tag_end:
+
+            frame_header = bytearray(data[position:position + header_size])
+            if frame_header[0] == 0:
+                #padding
+                break
+
+            frame_id = bytes(frame_header[:id_size]).decode('latin-1')
+            if version == 2:
+                size = (frame_header[3] << 16) | (frame_header[4] << 8) | frame_header[5]
+            elif version == 4:
+                size = syncsafe_int(frame_header[4:8])
+            else:
+                size = struct.unpack('>I', bytes(frame_header[4:8]))[0]
+
+            key = self.id3_frames.get(frame_id)
+            if key != None and result[key] == None:
+                text = self.decode_id3_text(data[position + header_size:
+                                                 position + header_size + min(size, self.max_text_size)])
+                if key == 'duration':
+                    if text != None and text.isdigit() and int(text) > 0:
+                        result[key] = int(text) / 1000.0
+                else:
+                    result[key] = text
+
+            if None not in result.values():
+                break
+            position += header_size + size
+
+        #footer of ID3v2.4
+        if flags & 0x10:
+            tag_end += 10
+        return tag_end
+
+    def parse_id3v1(self, data, result):
+        """
+            Fills missing title and artist from ID3v1 tag in last 128 bytes, returns offset of end of audio
+        """
+
+        if len(data) < 128:
+            return len(data)
+
+        tag = data[len(data) - 128:len(data)]
+        if tag[:3] != b'TAG':
+            return len(data)
+
+        for key, start in (('title', 3), ('artist', 33)):
+            if result[key] == None:
+                result[key] = tag[start:start + 30].split(b'\0')[0].decode('latin-1').strip() or None
+
+        return len(data) - 128
+
+    def mpeg_duration(self, data, audio_start, audio_end):
+        """
+            Returns duration of MPEG audio by Xing or VBRI header of first frame, or by bitrate
+            of first frame if file has constant bitrate
+        """
+
+        window = bytearray(data[audio_start:audio_start + self.frame_search_size])
+
+        for offset in range(len(window) - 3):
+
+            if window[offset] != 0xff or window[offset + 1] & 0xe0 != 0xe0:
+                continue
+
+            version = (window[offset + 1] >> 3) & 3
+            layer = (window[offset + 1] >> 1) & 3
+            bitrate_index = window[offset + 2] >> 4
+            samplerate_index = (window[offset + 2] >> 2) & 3
+            if version == 1 or layer == 0 or bitrate_index in (0, 15) or samplerate_index == 3:
+                continue
+
+            mpeg1 = version == 3
+            mono = window[offset + 3] >> 6 == 3
+            samplerate = self.mpeg_samplerates[version][samplerate_index]
+            samples_per_frame = 384 if layer == 3 else 1152 if mpeg1 or layer == 2 else 576
+
+            frame_start = audio_start + offset
+
+            #Xing header follows side information of layer III frame
+            xing = frame_start + 4 + ((17 if mono else 32) if mpeg1 else (9 if mono else 17))
+            if data[xing:xing + 4] in (b'Xing', b'Info') and struct.unpack('>I', data[xing + 4:xing + 8])[0] & 1:
+                frames = struct.unpack('>I', data[xing + 8:xing + 12])[0]
+                return frames * samples_per_frame / float(samplerate)
+
+            vbri = frame_start + 36
+            if data[vbri:vbri + 4] == b'VBRI':
+                frames = struct.unpack('>I', data[vbri + 14:vbri + 18])[0]
+                return frames * samples_per_frame / float(samplerate)
+
+            bitrate = self.mpeg_bitrates[(mpeg1, layer)][bitrate_index] * 1000
+            return (audio_end - frame_start) * 8.0 / bitrate
+
+        return None
+
+    def parse_flac(self, data, result):
+        """
+            Reads STREAMINFO and VORBIS_COMMENT metadata blocks, other blocks are jumped over
+        """
+
+        position = 4
+        while position + 4 <= len(data):
+
+            header = bytearray(data[position:position + 4])
+            block_type = header[0] & 0x7f
+            size = (header[1] << 16) | (header[2] << 8) | header[3]
+
+            if block_type == 0:
+                info = bytearray(data[position + 4:position + 22])
+                samplerate = (info[10] << 12) | (info[11] << 4) | (info[12] >> 4)
+                samples = ((info[13] & 0x0f) << 32) | (info[14] << 24) | (info[15] << 16) | (info[16] << 8) | info[17]
+                if samplerate > 0 and samples > 0:
+                    result['duration'] = samples / float(samplerate)
+
+            elif block_type == 4:
+                self.parse_vorbis_comment(data[position + 4:position + 4 + min(size, self.max_text_size)], result)
+
+            #last metadata block
+            if header[0] & 0x80 or None not in result.values():
+                break
+            position += 4 + size
+
+    def parse_vorbis_comment(self, block, result):
+
+        position = 4 + struct.unpack('<I', block[0:4])[0]
+        count = struct.unpack('<I', block[position:position + 4])[0]
+        position += 4
+
+        for index in range(count):
+
+            if position + 4 > len(block):
+                break
+            length = struct.unpack('<I', block[position:position + 4])[0]
+            key, separator, value = block[position + 4:position + 4 + length].decode('utf-8', 'replace').partition(u'=')
+            position += 4 + length
+
+            key = key.lower()
+            if key in ('title', 'artist') and result[key] == None:
+                result[key] = value.strip() or None
+
+    def parse_wav(self, data, result):
+        """
+            Reads fmt chunk, size of data chunk and INFO list of RIFF file, data chunk is jumped over
+        """
+
+        byte_rate = None
+        data_size = None
+
+        position = 12
+        while position + 8 <= len(data):
+
+            chunk_id = data[position:position + 4]
+            size = struct.unpack('<I', data[position + 4:position + 8])[0]
+
+            if chunk_id == b'fmt ':
+                byte_rate = struct.unpack('<I', data[position + 16:position + 20])[0]
+
+            elif chunk_id == b'data':
+                #size of streamed wav isn't known
+                data_size = min(size, len(data) - position - 8)
+
+            elif chunk_id == b'LIST' and data[position + 8:position + 12] == b'INFO':
+                self.parse_riff_info(data[position + 12:position + 8 + min(size, self.max_text_size)], result)
+
+            position += 8 + size + (size & 1)
+
+        if byte_rate and data_size:
+            result['duration'] = data_size / float(byte_rate)
+
+    def parse_riff_info(self, info, result):
+
+        position = 0
+        while position + 8 <= len(info):
+
+            chunk_id = info[position:position + 4]
+            size = struct.unpack('<I', info[position + 4:position + 8])[0]
+            key = {b'INAM': 'title', b'IART': 'artist'}.get(chunk_id)
+
+            if key != None and result[key] == None:
+                value = info[position + 8:position + 8 + size].split(b'\0')[0]
+                try:
+                    result[key] = value.decode('utf-8').strip() or None
+                except UnicodeDecodeError:
+                    result[key] = value.decode('latin-1').strip() or None
+
+            position += 8 + size + (size & 1)
+
+class TrackListManager():
+    """
+        self.track_list contains list of FolderRecord, which are used as dictionaries with 
+        the following structure:
+        ('folder_name' : string               # name of the folder, containig tracks, 
+         'tracks' : FolderTracks              # behaves as list of lists with the following structure:
+                                                ['filename of track':string, 'delete_mark':boolean]
+         'fingerprint' : tuple                # (mtime, entry_count, total_size) of folder at last scan,
+                                                used to rescan only changed folders)
+        Track list is pickled as list of such dictionaries (.tdb), split into manifest and shards
+        by ShardedTrackStore (.tdbs), stored by SqliteTrackStore (.sqlite) or in memory mapped
+        snapshot by MappedTrackStore (.tdbm).
+    """
+    
+    #upper bound of scan_threads, more threads only add contention on removable media
+    max_scan_threads = 16
+
+    #count of journaled marks after which journal is compacted into track list file
+    journal_compact_threshold = 500
+
+    def __init__(self, path_to_profiles='./.profiles/', save_scheduler=None):
+        
+        self.active_folder = ''
+        self.track_list = []
+
+        #{folder_name: element of self.track_list}, kept in sync by set_track_list()
+        self.folder_index = {}
+
+        #changed by set_track_list() when folders of track list (or their order) are changed,
+        #views of folders are built again only for new version
+        self.folders_version = 0
+
+        self.scanner = MediaScanner()
+
+        #ShardedTrackStore or SqliteTrackStore of profile which database isn't pickled track list
+        self.store = None
+
+        #count of marks in journal which aren't in saved track list yet
+        self.journal_entries = 0
+
+        #pickled track list has cached headers of tracks which aren't saved yet
+        self.metadata_changed = False
+
+        #SaveScheduler of schedule_save_track_list(), without it track list is saved at once
+        self.save_scheduler = save_scheduler
+
+        #scheduled save can run in timer thread while track list is saved directly
+        self.save_lock = threading.RLock()
+
+        #TrackSearchIndex of track list, built by first search
+        self.search_index = None
+
+        #{folder_name: [mark_to_delete]} of folders which aren't loaded, read by is_track_marked()
+        self.mark_cache = {}
+
+    def set_track_list(self, track_list):
+        """
+            Replaces track list and rebuilds index of its folders by name
+        """
+
+        #scheduled save writes self.track_list, so it's done before list is replaced by other profile's one
+        if self.save_scheduler != None:
+            self.save_scheduler.flush()
+
+        if [tr_rec['folder_name'] for tr_rec in track_list] != [tr_rec['folder_name'] for tr_rec in self.track_list]:
+            self.folders_version += 1
+
+        self.track_list = track_list
+        self.folder_index = dict((tr_rec['folder_name'], tr_rec) for tr_rec in track_list)
+        self.search_index = None
+        self.mark_cache = {}
+
+    def memory_report(self):
+        """
+            Returns (bytes_per_10k_tracks_as_dictionaries, bytes_per_10k_tracks_as_folder_records)
+            for loaded tracks of track list, or None if no tracks are loaded. It walks every loaded track,
+            so it's recorded by benchmark.py, not measured by loading of track list.
+        """
+
+        loaded_folders = [tr_rec for tr_rec in self.track_list if tr_rec.loaded]
+        count_of_tracks = sum(len(tr_rec) for tr_rec in loaded_folders)
+
+        if count_of_tracks == 0:
+            return None
+
+        dict_model_size = dict_model_memory_size(loaded_folders)
+        compact_size = sys.getsizeof(loaded_folders) + sum(tr_rec.memory_size() for tr_rec in loaded_folders)
+
+        return (dict_model_size * 10000 // count_of_tracks, compact_size * 10000 // count_of_tracks)
+
+    def profiles_path_exists(self, path_to_profiles='./.profiles'):
+        """
+            Checks existence of profile directory and try to create it if not.
+        """
+        
+        if not os.path.exists(path_to_profiles) or not os.path.isdir(path_to_profiles):
+            
+            try:
+                
+                os.makedirs(path_to_profiles)
+                return True
+            
+            except OSError as exception:
+                
+                if exception.errno != errno.EEXIST:
+                    raise
+                
+                return False
+        
+        else:
+            return True
+        
+    @instrumented('TrackListManager.create_new_track_list')
+    def create_new_track_list(self, path_to_removable_media, track_list_filename, 
+                              progress_callback=None, path_to_profiles='./.profiles', rescan=False,
+                              cancel_event=None, scan_threads=1):
+        """
+            Creates new track list. 
+                path_to_removable_media: string              #path to folder with manageble tracks
+                track_list_filename: string                  #file where track list will be saved
+                progress_callback: function                  #if passed, called before scanning of every folder with
+                                                             #(index_of_folder, count_of_folders, path_to_folder),
+                                                             #can be called not in main thread
+                rescan: boolean                              #if true, only folders which fingerprint differs from
+                                                             #stored one will be scanned again
+                cancel_event: threading.Event                #if set while scanning, scan stops and nothing is saved
+                scan_threads: int                            #count of folders listed at the same time, on media
+                                                             #with high latency several threads wait for I/O together
+            Returns True if track list was scanned and saved
+        """
+
+        path_to_removable_media = unicode(path_to_removable_media)
+
+        if self.profiles_path_exists(path_to_profiles):
+            if os.path.exists(path_to_removable_media):
+
+                #Earlier scanned folders: {folder_name: {'folder_name', 'tracks', 'fingerprint'}}
+                old_folders = {}
+                if rescan:
+                    old_folders = dict(self.folder_index)
+
+                #new track list is collected aside, so self.track_list stays usable until scan is finished
+                track_list = []
+                self.scanner.reset_counters()
+
+                #Collecting folders for progress bar:
+                for folder in self.scanner.list_folders(path_to_removable_media):
+                    track_list.append(FolderRecord(folder, []))
+
+                scan_threads = max(1, min(scan_threads, self.max_scan_threads, len(track_list)))
+
+                if scan_threads == 1:
+                    scanned_folders = self.scan_folders(path_to_removable_media, track_list, old_folders,
+                                                        self.scanner, queue_of_folders(track_list),
+                                                        progress_callback, cancel_event)
+                else:
+                    scanned_folders = self.scan_folders_parallel(path_to_removable_media, track_list, old_folders,
+                                                                 scan_threads, progress_callback, cancel_event)
+
+                if cancel_event != None and cancel_event.is_set():
+                    Logger.info('TrackListManager: scan cancelled')
+
+                    #track list of other profile shouldn't stay after cancelled scan
+                    if not rescan:
+                        self.set_track_list([])
+                    return False
+
+                Logger.info('TrackListManager: scanned %d of %d folders' % (scanned_folders, len(track_list)))
+                Logger.info('MediaScanner: %d stat calls made, %d stat calls saved' % \
+                    (self.scanner.stat_calls, self.scanner.stat_calls_saved))
+
+                instrumentation.count('scan.stat_calls', self.scanner.stat_calls)
+                instrumentation.count('scan.stat_calls_saved', self.scanner.stat_calls_saved)
+                instrumentation.report_counters()
+
+                self.set_track_list(track_list)
+
+                #save tracks structure
+                self.save_track_list(track_list_filename, path_to_profiles)
+
+                #return True will stop bubbling on_release event 
+                return True
+
+        return False
+
+    def scan_folders(self, path_to_removable_media, track_list, old_folders, scanner, folders_queue,
+                     progress_callback=None, cancel_event=None, progress=None):
+        """
+            Scans folders which indexes in track_list are taken from folders_queue until it is empty.
+            Tracks are written into elements of track_list, so order of folders doesn't depend on
+            order of scanning.
+                old_folders: dict           #earlier scanned folders by folder name (for rescan)
+                scanner: MediaScanner       #every thread uses own scanner
+                progress: list              #[count_of_scanned_folders, threading.Lock] shared between threads
+            Returns count of folders which were scanned again
+        """
+
+        scanned_folders = 0
+
+        while True:
+
+            if cancel_event != None and cancel_event.is_set():
+                break
+
+            try:
+                index = folders_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            element = track_list[index]
+            current_path = os.path.join(path_to_removable_media, element['folder_name'])
+
+            if progress_callback != None:
+                if progress == None:
+                    progress_callback(index, len(track_list), current_path)
+                else:
+                    with progress[1]:
+                        progress_callback(progress[0], len(track_list), current_path)
+                        progress[0] += 1
+
+            old_folder = old_folders.get(element['folder_name'])
+
+            #Unchanged folder keeps its tracks and delete marks
+            if old_folder != None and \
+            scanner.fingerprint_matches(current_path, old_folder.get('fingerprint')):
+
+                track_list[index] = old_folder
+                instrumentation.count('scan.folders_unchanged')
+                continue
+
+            old_tracks = None
+            if old_folder != None:
+                old_tracks = self.folder_tracks(old_folder)
+
+                #cached headers of unchanged files stay valid
+                element.metadata = old_folder.metadata
+
+            #Adding list of tracks to FolderRecord
+            element['tracks'], element['fingerprint'], element.track_bytes = scanner.scan_folder(current_path, old_tracks)
+            scanned_folders += 1
+            instrumentation.count('scan.folders_scanned')
+
+        return scanned_folders
+
+    def scan_folders_parallel(self, path_to_removable_media, track_list, old_folders, scan_threads,
+                              progress_callback=None, cancel_event=None):
+        """
+            Scans folders of track_list with scan_threads worker threads
+            Returns count of folders which were scanned again
+        """
+
+        folders_queue = queue_of_folders(track_list)
+        progress = [0, threading.Lock()]
+
+        #results[i] is count of scanned folders or exception of i-th thread
+        results = [0] * scan_threads
+        scanners = [MediaScanner() for i in range(scan_threads)]
+
+        def worker(thread_index):
+            try:
+                results[thread_index] = self.scan_folders(path_to_removable_media, track_list, old_folders,
+                                                          scanners[thread_index], folders_queue,
+                                                          progress_callback, cancel_event, progress)
+            except Exception as exception:
+                results[thread_index] = exception
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(scan_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for scanner in scanners:
+            self.scanner.stat_calls += scanner.stat_calls
+            self.scanner.stat_calls_saved += scanner.stat_calls_saved
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        return sum(results)
+
+    def rescan_track_list(self, path_to_removable_media, track_list_filename,
+                          progress_callback=None, path_to_profiles='./.profiles', cancel_event=None,
+                          scan_threads=1):
+        """
+            Scans again only changed folders of removable media, delete marks of unchanged tracks are kept.
+        """
+
+        return self.create_new_track_list(path_to_removable_media, track_list_filename,
+                                          progress_callback, path_to_profiles, rescan=True,
+                                          cancel_event=cancel_event, scan_threads=scan_threads)
+
+    @instrumented('TrackListManager.apply_folder_changes')
+    def apply_folder_changes(self, path_to_removable_media, track_list_filename, folder_names, list_root=False,
+                             path_to_profiles='./.profiles'):
+        """
+            Updates track list with changes of top level folders found by MediaWatcher without rescan:
+            new folders are scanned and added, deleted ones are removed, changed ones are scanned again
+            with their delete marks kept. Track list is saved if something was changed.
+                folder_names: set      #names of created, deleted, renamed or changed folders
+                list_root: boolean     #if true, every folder of removable media is checked
+            Returns True if track list was changed
+        """
+
+        path_to_removable_media = unicode(path_to_removable_media)
+
+        if not os.path.isdir(path_to_removable_media):
+            return False
+
+        folder_names = set(folder_names)
+        if list_root:
+            folder_names.update(self.folder_index)
+            folder_names.update(self.scanner.list_folders(path_to_removable_media))
+
+        track_list = list(self.track_list)
+        changed = False
+
+        for folder_name in sorted(folder_names):
+
+            current_path = os.path.join(path_to_removable_media, folder_name)
+            tr_rec = self.folder_index.get(folder_name)
+
+            if folder_name == DeletionJob.trash_folder_name or not os.path.isdir(current_path):
+                if tr_rec != None:
+                    track_list.remove(tr_rec)
+                    changed = True
+                continue
+
+            if tr_rec != None and self.scanner.fingerprint_matches(current_path, tr_rec.get('fingerprint')):
+                continue
+
+            old_tracks = None
+            if tr_rec != None:
+                old_tracks = self.folder_tracks(tr_rec)
+
+            tracks, fingerprint, track_bytes = self.scanner.scan_folder(current_path, old_tracks)
+
+            if tr_rec == None:
+                track_list.append(FolderRecord(folder_name, tracks, fingerprint, stats=(None, None, track_bytes)))
+            else:
+                tr_rec['tracks'], tr_rec['fingerprint'], tr_rec.track_bytes = tracks, fingerprint, track_bytes
+            changed = True
+
+        if changed:
+            search_index = self.search_index
+            self.set_track_list(track_list)
+
+            #only changed folders are indexed again
+            if search_index != None:
+                self.search_index = search_index
+                for folder_name in folder_names:
+                    self.update_search_index(folder_name)
+
+            #several changes of removable media in short time are saved once
+            self.schedule_save_track_list(track_list_filename, path_to_profiles)
+
+        return changed
+
+    def folder_fingerprints(self):
+        """
+            Returns {folder_name: fingerprint} of track list
+        """
+        return dict((tr_rec['folder_name'], tr_rec.get('fingerprint')) for tr_rec in list(self.track_list))
+
+    @instrumented('TrackListManager.save_track_list')
+    def save_track_list(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Saves track list structure to track_list_filename.
+            Saved snapshot contains every journaled mark, so journal is removed.
+        """
+
+        if self.save_scheduler != None:
+            self.save_scheduler.cancel(('track_list', path_to_profiles, track_list_filename))
+
+        if not self.profiles_path_exists(path_to_profiles):
+            return
+
+        #marks aren't journaled between snapshot and removing of journal
+        with self.save_lock:
+
+            if self.is_sqlite_database(track_list_filename) or self.is_mapped_database(track_list_filename):
+                self.open_store(track_list_filename, path_to_profiles)
+                self.store.save_track_list(self.track_list)
+                return
+
+            if self.is_sharded_database(track_list_filename):
+                self.open_store(track_list_filename, path_to_profiles)
+                self.store.save_track_list(self.track_list)
+
+            else:
+                #pickled format stays list of dictionaries
+                write_pickle_atomically([tr_rec.to_dict() for tr_rec in self.track_list],
+                                        os.path.join(path_to_profiles,track_list_filename))
+
+            #journal is removed only after snapshot is written, replaying it again is harmless
+            path_to_journal = os.path.join(path_to_profiles, self.journal_filename(track_list_filename))
+            if os.path.exists(path_to_journal):
+                os.remove(path_to_journal)
+            self.journal_entries = 0
+            self.metadata_changed = False
+
+    def schedule_save_track_list(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Saves track list by self.save_scheduler, so several changes in short time are saved once
+        """
+
+        if self.save_scheduler == None:
+            self.save_track_list(track_list_filename, path_to_profiles)
+            return
+
+        self.save_scheduler.request(('track_list', path_to_profiles, track_list_filename), self.save_track_list,
+                                    track_list_filename, path_to_profiles)
+
+    @instrumented('TrackListManager.load_track_list')
+    def load_track_list(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Loads track list structure from track_list_filename and replays journal of marks.
+            From sharded, sqlite and mapped database only folders are loaded, tracks are loaded when folder is opened.
+        """
+        
+        if self.profiles_path_exists(path_to_profiles):
+
+            if self.is_sqlite_database(track_list_filename) or self.is_mapped_database(track_list_filename):
+                self.open_store(track_list_filename, path_to_profiles)
+                self.set_track_list(self.store.load_folders())
+
+            elif self.is_sharded_database(track_list_filename):
+                self.open_store(track_list_filename, path_to_profiles)
+                self.set_track_list(self.store.load_folders())
+                self.replay_journal(track_list_filename, path_to_profiles)
+
+            elif os.path.exists(os.path.join(path_to_profiles,track_list_filename)):
+                f = open(os.path.join(path_to_profiles,track_list_filename),'rb')
+                with instrumentation.span('TrackListManager.unpickle'):
+                    pickled_track_list = pickle.load(f)
+                f.close()
+
+                with instrumentation.span('TrackListManager.build_folder_records'):
+                    self.set_track_list([FolderRecord.from_dict(tr_rec) for tr_rec in pickled_track_list])
+
+                self.replay_journal(track_list_filename, path_to_profiles)
+
+    def is_sqlite_database(self, track_list_filename):
+        """
+            Profiles created with sqlite database have db_name ending with .sqlite
+        """
+        return track_list_filename.endswith('.sqlite')
+
+    def is_sharded_database(self, track_list_filename):
+        """
+            Profiles with sharded database have db_name ending with .tdbs, it's folder with manifest and shards
+        """
+        return track_list_filename.endswith('.tdbs')
+
+    def is_mapped_database(self, track_list_filename):
+        """
+            Profiles with memory mapped database have db_name ending with .tdbm
+        """
+        return track_list_filename.endswith('.tdbm')
+
+    def has_store(self, track_list_filename):
+        """
+            Checks track list is kept in store (self.store) instead of pickled track list
+        """
+        return self.is_sqlite_database(track_list_filename) or self.is_sharded_database(track_list_filename) or \
+            self.is_mapped_database(track_list_filename)
+
+    def pickle_filename(self, track_list_filename):
+        """
+            Returns filename of pickled track list which database track_list_filename is migrated from
+        """
+        return os.path.splitext(track_list_filename)[0] + '.tdb'
+
+    def database_exists(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Checks track list file (manifest of sharded database) exists
+        """
+
+        path_to_db = os.path.join(path_to_profiles, track_list_filename)
+        if self.is_sharded_database(track_list_filename):
+            path_to_db = os.path.join(path_to_db, ShardedTrackStore.manifest_filename)
+        return os.path.exists(path_to_db)
+
+    def track_list_exists(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Checks track list was saved earlier (or can be migrated to database)
+        """
+
+        if self.database_exists(track_list_filename, path_to_profiles):
+            return True
+
+        return self.has_store(track_list_filename) and \
+            os.path.exists(os.path.join(path_to_profiles, self.pickle_filename(track_list_filename)))
+
+    def open_store(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Opens sharded, sqlite or mapped database of track list. If database doesn't exist yet, but pickled track list
+            with same name does, it is migrated to database once.
+        """
+
+        path_to_db = os.path.join(path_to_profiles, track_list_filename)
+
+        if self.store != None:
+            if self.store.path_to_db == path_to_db:
+                return
+            self.store.close()
+
+        migrate = not self.database_exists(track_list_filename, path_to_profiles) and \
+            os.path.exists(os.path.join(path_to_profiles, self.pickle_filename(track_list_filename)))
+
+        self.store = self.create_store(track_list_filename, path_to_profiles)
+
+        if migrate:
+            #pickled track list with its journal of marks
+            self.load_track_list(self.pickle_filename(track_list_filename), path_to_profiles)
+            self.store.save_track_list(self.track_list)
+            Logger.info('TrackListManager: %s migrated to %s' % (self.pickle_filename(track_list_filename),
+                                                                 track_list_filename))
+
+    def create_store(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Returns store of database track_list_filename by its extension
+        """
+
+        path_to_db = os.path.join(path_to_profiles, track_list_filename)
+
+        if self.is_sharded_database(track_list_filename):
+            return ShardedTrackStore(path_to_db)
+        if self.is_mapped_database(track_list_filename):
+            return MappedTrackStore(path_to_db)
+        return SqliteTrackStore(path_to_db)
+
+    def convert_database(self, track_list_filename, new_track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Copies track list with delete marks from database track_list_filename into database
+            new_track_list_filename, format of each is given by its extension (e.g. pickled .tdb to
+            memory mapped .tdbm and back). Returns count of copied folders.
+        """
+
+        self.load_track_list(track_list_filename, path_to_profiles)
+        for tr_rec in self.track_list:
+            self.folder_tracks(tr_rec)
+
+        converted = TrackListManager()
+        converted.set_track_list(self.track_list)
+
+        #store is created directly, so old pickled track list with the same name isn't migrated into it
+        if converted.has_store(new_track_list_filename):
+            converted.store = converted.create_store(new_track_list_filename, path_to_profiles)
+
+        try:
+            converted.save_track_list(new_track_list_filename, path_to_profiles)
+        finally:
+            if converted.store != None:
+                converted.store.close()
+
+        Logger.info('TrackListManager: %s converted to %s' % (track_list_filename, new_track_list_filename))
+        return len(self.track_list)
+
+    def folder_tracks(self, tr_rec):
+        """
+            Returns tracks of folder record of track list, loads them from database if they
+            weren't loaded yet
+        """
+
+        if not tr_rec.loaded:
+            tr_rec['tracks'] = self.store.load_tracks(tr_rec['folder_name'])
+            tr_rec.dirty = False
+
+            #marks are read from loaded record now, cached ones would be stale after next mark
+            self.mark_cache.pop(tr_rec['folder_name'], None)
+
+        if isinstance(self.store, ShardedTrackStore):
+            self.store.touch(tr_rec)
+
+        return tr_rec['tracks']
+
+    def marked_folder_names(self):
+        """
+            Returns set of names of folders which have tracks marked to delete
+        """
+
+        folder_names = set()
+
+        for tr_rec in self.track_list:
+            if tr_rec.loaded and tr_rec.marked_count() > 0:
+                folder_names.add(tr_rec['folder_name'])
+
+        #not loaded folders are found by index of delete marks
+        if self.store != None and any(not tr_rec.loaded for tr_rec in self.track_list):
+            folder_names.update(self.store.marked_folder_names())
+
+        return folder_names
+
+    def marked_tracks(self):
+        """
+            Returns list of tuples (folder_name, index_of_track_in_folder, trackname) of tracks marked to delete
+        """
+
+        marked_tracks = []
+        marked_folder_names = self.marked_folder_names()
+
+        for tr_rec in self.track_list:
+            if tr_rec['folder_name'] in marked_folder_names:
+                for track_index, tr in enumerate(self.folder_tracks(tr_rec)):
+                    if tr[1]:
+                        marked_tracks.append((tr_rec['folder_name'], track_index, tr[0]))
+
+        return marked_tracks
+
+    def remove_tracks(self, track_list_filename, tracks, path_to_profiles='./.profiles', removed_bytes=None):
+        """
+            Removes tracks from track list and saves it once.
+                tracks: list            #tuples (folder_name, index_of_track_in_folder, trackname)
+                removed_bytes: dict     #{folder_name: size_of_removed_tracks}, see DeletionJob.bytes_by_folder
+        """
+
+        self.change_track_bytes(removed_bytes, -1)
+
+        #{folder_name: set of indexes of removed tracks}
+        removed = {}
+        for folder_name, track_index, track_name in tracks:
+            removed.setdefault(folder_name, set()).add(track_index)
+
+        for folder_name, track_indexes in removed.items():
+            tr_rec = self.folder_index.get(folder_name)
+            if tr_rec != None:
+                folder_tracks = self.folder_tracks(tr_rec)
+                folder_tracks[:] = [tr for index, tr in enumerate(folder_tracks) if index not in track_indexes]
+                self.update_search_index(folder_name)
+
+        self.save_track_list(track_list_filename, path_to_profiles)
+
+    def restore_tracks(self, track_list_filename, tracks, path_to_profiles='./.profiles', restored_bytes=None):
+        """
+            Returns removed tracks back to their places in track list, they stay marked to delete.
+                tracks: list            #tuples (folder_name, index_of_track_in_folder, trackname) given to remove_tracks
+                restored_bytes: dict    #{folder_name: size_of_restored_tracks}
+        """
+
+        self.change_track_bytes(restored_bytes, 1)
+
+        #{folder_name: {index_of_track_in_folder: trackname}} of restored tracks
+        restored = {}
+        for folder_name, track_index, track_name in tracks:
+            restored.setdefault(folder_name, {})[track_index] = track_name
+
+        #tracks of folder are merged in one pass, so folder is rebuilt once whatever count of tracks is restored
+        for folder_name, restored_tracks in restored.items():
+            tr_rec = self.folder_index.get(folder_name)
+            if tr_rec == None:
+                continue
+
+            folder_tracks = self.folder_tracks(tr_rec)
+            merged_tracks = []
+            for tr in folder_tracks:
+                while len(merged_tracks) in restored_tracks:
+                    merged_tracks.append([restored_tracks.pop(len(merged_tracks)), True])
+                merged_tracks.append(tr)
+
+            #tracks which were at the end of folder
+            for track_index in sorted(restored_tracks):
+                merged_tracks.append([restored_tracks[track_index], True])
+
+            folder_tracks[:] = merged_tracks
+            self.update_search_index(folder_name)
+
+        self.save_track_list(track_list_filename, path_to_profiles)
+
+    def change_track_bytes(self, folder_bytes, sign):
+        """
+            Adds (sign 1) or subtracts (sign -1) {folder_name: bytes} from size of tracks of folders
+        """
+
+        for folder_name, size in (folder_bytes or {}).items():
+            tr_rec = self.folder_index.get(folder_name)
+            if tr_rec != None and tr_rec.track_bytes != None:
+                tr_rec.track_bytes = max(tr_rec.track_bytes + sign * size, 0)
+
+    def folder_stats(self, tr_rec):
+        """
+            Returns (track_count, marked_count, track_bytes) of folder record without loading its tracks,
+            only folders of database saved before counters appeared are loaded once.
+            track_bytes is None if folder wasn't scanned since then.
+        """
+
+        if tr_rec.track_count == None or tr_rec.marked == None:
+            self.folder_tracks(tr_rec)
+        return tr_rec.stats()
+
+    def profile_stats(self):
+        """
+            Returns (track_count, marked_count, track_bytes) of whole track list, sum of counters of folders
+        """
+
+        track_count = marked_count = track_bytes = 0
+        for tr_rec in self.track_list:
+            folder_track_count, folder_marked_count, folder_track_bytes = self.folder_stats(tr_rec)
+            track_count += folder_track_count
+            marked_count += folder_marked_count
+            track_bytes += folder_track_bytes or 0
+        return track_count, marked_count, track_bytes
+
+    def folder_track_names(self, tr_rec):
+        """
+            Returns names of tracks of folder record, not loaded tracks are read from database
+            without loading them into record
+        """
+
+        if tr_rec.loaded:
+            return [tr_rec.track_name(index) for index in range(len(tr_rec))]
+        return [tr[0] for tr in self.store.load_tracks(tr_rec['folder_name'])]
+
+    @instrumented('TrackListManager.build_search_index')
+    def build_search_index(self):
+
+        self.search_index = TrackSearchIndex()
+        for tr_rec in self.track_list:
+            self.search_index.update_folder(tr_rec['folder_name'], self.folder_track_names(tr_rec))
+
+    def update_search_index(self, folder_name):
+        """
+            Indexes again tracks of folder after they were changed (or removes folder from index)
+        """
+
+        if self.search_index == None:
+            return
+
+        tr_rec = self.folder_index.get(folder_name)
+        track_names = None
+        if tr_rec != None:
+            track_names = self.folder_track_names(tr_rec)
+        self.search_index.update_folder(folder_name, track_names)
+
+    @instrumented('TrackListManager.search_tracks')
+    def search_tracks(self, query, limit=100):
+        """
+            Returns list of (folder_name, index_of_track_in_folder, trackname) of tracks of every folder
+            which names contain every word of query
+        """
+
+        if self.search_index == None:
+            self.build_search_index()
+        return self.search_index.search(query, limit)
+
+    def folder_metadata(self, path_to_removable_media, tr_rec, reader=None):
+        """
+            Returns list of (title, artist, duration) of tracks of folder in order of tracks, None for
+            track which file isn't found. Headers are read only from files which aren't cached yet or
+            were changed since (by size or mtime), changed cache is saved with track database.
+        """
+
+        if reader == None:
+            reader = AudioMetadataReader()
+
+        if tr_rec.metadata == None:
+            tr_rec.metadata = {}
+            if self.store != None:
+                tr_rec.metadata = self.store.load_metadata(tr_rec['folder_name'])
+
+        path_to_folder = os.path.join(unicode(path_to_removable_media), tr_rec['folder_name'])
+        track_names = self.folder_track_names(tr_rec)
+
+        cached = tr_rec.metadata
+        metadata = {}
+        result = []
+
+        for track_name in track_names:
+
+            try:
+                stat = os.stat(os.path.join(path_to_folder, track_name))
+            except OSError:
+                result.append(None)
+                continue
+
+            entry = cached.get(track_name)
+            if entry == None or entry[0] != stat.st_size or entry[1] != stat.st_mtime:
+                try:
+                    entry = (stat.st_size, stat.st_mtime) + reader.read(os.path.join(path_to_folder, track_name))
+                except (IOError, OSError) as exception:
+                    Logger.warning('TrackListManager: header of %s not read: %s' % (track_name, exception))
+                    result.append(None)
+                    continue
+
+            metadata[track_name] = entry
+            result.append(entry[2:])
+
+        #entries of deleted and renamed tracks are dropped
+        if metadata != cached:
+            tr_rec.metadata = metadata
+            if self.store != None:
+                self.store.save_metadata(tr_rec['folder_name'], metadata)
+            else:
+                #pickled track list isn't rewritten for every opened folder, cache is saved with next snapshot
+                self.metadata_changed = True
+
+        return result
+
+    def hash_cache_filename(self, track_list_filename):
+        """
+            Returns filename of HashCache of profile, it's stored next to track_list_filename
+        """
+        return track_list_filename + '.hashes'
+
+    def all_tracks(self):
+        """
+            Returns list of tuples (folder_name, index_of_track_in_folder, trackname) of every track
+        """
+
+        tracks = []
+        for tr_rec in self.track_list:
+            for track_index, track_name in enumerate(self.folder_track_names(tr_rec)):
+                tracks.append((tr_rec['folder_name'], track_index, track_name))
+        return tracks
+
+    def find_duplicates(self, path_to_removable_media, track_list_filename, progress_callback=None,
+                        cancel_event=None, path_to_profiles='./.profiles', hash_threads=None):
+        """
+            Returns DuplicateFinder with groups of tracks which have the same content.
+            Hashes are cached in profile, so only new and changed files are read by next search.
+        """
+
+        hash_cache = HashCache(os.path.join(path_to_profiles, self.hash_cache_filename(track_list_filename)))
+        finder = DuplicateFinder(path_to_removable_media, hash_cache, hash_threads)
+        finder.find(self.all_tracks(), progress_callback, cancel_event)
+
+        if self.profiles_path_exists(path_to_profiles):
+            hash_cache.save()
+        return finder
+
+    def mark_duplicates(self, track_list_filename, groups, path_to_profiles='./.profiles'):
+        """
+            Marks to delete every track of every group except one, marks are written as by mark_track().
+            Kept track is the first one which isn't marked already, group which copies are all marked
+            already is left as user marked it. Returns count of newly marked tracks.
+                groups: list    #lists of tuples (folder_name, index_of_track_in_folder, trackname)
+        """
+
+        marked = 0
+
+        for group in groups:
+
+            #(folder_name, track) of copies which are still in track list
+            tracks = []
+            for folder_name, track_index, track_name in group:
+                tr_rec = self.folder_index.get(folder_name)
+                if tr_rec == None:
+                    continue
+                folder_tracks = self.folder_tracks(tr_rec)
+                #track list could be changed since search
+                if track_index < len(folder_tracks) and folder_tracks[track_index][0] == track_name:
+                    tracks.append((folder_name, folder_tracks[track_index]))
+
+            if len(tracks) < 2 or all(tr[1] for folder_name, tr in tracks):
+                continue
+
+            kept = next(tr for folder_name, tr in tracks if not tr[1])
+
+            for folder_name, tr in tracks:
+                if tr is not kept and not tr[1]:
+                    self.mark_track(track_list_filename, folder_name, tr, True, path_to_profiles)
+                    marked += 1
+
+        return marked
+
+    def sync_library(self, path_to_source_library, path_to_removable_media, track_list_filename,
+                     progress_callback=None, cancel_event=None, path_to_profiles='./.profiles', copy_threads=None,
+                     compare_hashes=False, prune=False):
+        """
+            Mirrors source library onto removable media (see LibrarySync) and applies copied tracks to
+            track list without rescan. Returns LibrarySync with results.
+        """
+
+        hash_cache = HashCache(os.path.join(path_to_profiles, self.hash_cache_filename(track_list_filename)))
+        source_hash_cache = HashCache(os.path.join(path_to_profiles, track_list_filename + '.source-hashes'))
+
+        sync = LibrarySync(path_to_source_library, path_to_removable_media, hash_cache, source_hash_cache,
+                           copy_threads, compare_hashes, prune)
+        sync.run(progress_callback, cancel_event)
+
+        if self.profiles_path_exists(path_to_profiles):
+            hash_cache.save()
+            source_hash_cache.save()
+
+        self.apply_sync(path_to_removable_media, track_list_filename, sync, path_to_profiles)
+        return sync
+
+    def apply_sync(self, path_to_removable_media, track_list_filename, sync, path_to_profiles='./.profiles'):
+        """
+            Updates folders of track list which were changed by sync. Tracks which were in folder keep
+            their places and delete marks, copied tracks are added in order of library. Folder is listed
+            once to take its fingerprint, names of tracks are known from sync, so they aren't cleared again.
+            Returns names of updated folders.
+        """
+
+        path_to_removable_media = unicode(path_to_removable_media)
+        changed_folders = set(folder_name for folder_name, track_name in sync.copied + sync.pruned)
+
+        track_list = list(self.track_list)
+        updated = []
+
+        for folder_name, synced_names in sync.folders.items():
+
+            tr_rec = self.folder_index.get(folder_name)
+            path_to_folder = os.path.join(path_to_removable_media, folder_name)
+
+            if (tr_rec != None and folder_name not in changed_folders) or not os.path.isdir(path_to_folder):
+                continue
+
+            entries, file_entries = self.scanner.list_folder(path_to_folder)
+            sizes = self.scanner.file_sizes(file_entries)
+            on_media = set(name for name in sizes if name.endswith(self.scanner.track_extensions))
+
+            tracks = []
+            if tr_rec != None:
+                tracks = [[tr[0], tr[1]] for tr in self.folder_tracks(tr_rec) if tr[0] in on_media]
+
+            known = set(tr[0] for tr in tracks)
+            tracks.extend([track_name, False] for track_name in synced_names
+                          if track_name in on_media and track_name not in known)
+
+            self.scanner.stat_calls += 1
+            fingerprint = (os.stat(path_to_folder).st_mtime, len(entries), sum(sizes.values()))
+
+            #tracks put into folder not by sync weren't cleared yet, next scan of folder takes them
+            if len(tracks) != len(on_media):
+                fingerprint = None
+
+            track_bytes = sum(sizes[tr[0]] for tr in tracks)
+
+            if tr_rec == None:
+                track_list.append(FolderRecord(folder_name, tracks, fingerprint, stats=(None, None, track_bytes)))
+            else:
+                tr_rec['tracks'], tr_rec['fingerprint'], tr_rec.track_bytes = tracks, fingerprint, track_bytes
+            updated.append(folder_name)
+
+        if updated != []:
+            search_index = self.search_index
+            self.set_track_list(track_list)
+
+            if search_index != None:
+                self.search_index = search_index
+                for folder_name in updated:
+                    self.update_search_index(folder_name)
+
+            self.save_track_list(track_list_filename, path_to_profiles)
+
+        return updated
+
+    def renumber_tracks(self, path_to_removable_media, track_list_filename, folder_names=None,
+                        path_to_profiles='./.profiles', dry_run=False):
+        """
+            Writes numbers of tracks in order of track list into prefixes of their filenames (see RenumberPlan)
+            and renames tracks in track list without rescan. Delete marks and cached headers follow tracks.
+                folder_names: list    #folders to renumber, every folder of track list by default
+            Returns list of RenumberPlan of folders which have tracks to rename
+        """
+
+        plans = self.plan_renumbering(path_to_removable_media, folder_names)
+
+        if not dry_run:
+            for plan in plans:
+                plan.apply()
+            self.apply_renumbering(track_list_filename, plans, path_to_profiles)
+
+        return plans
+
+    def plan_renumbering(self, path_to_removable_media, folder_names=None):
+        """
+            Returns list of RenumberPlan of folders which have tracks to rename, plans can be applied
+            in worker thread, track list isn't changed by them
+                folder_names: list    #folders to renumber, every folder of track list by default
+        """
+
+        path_to_removable_media = unicode(path_to_removable_media)
+        if folder_names == None:
+            folder_names = [tr_rec['folder_name'] for tr_rec in self.track_list]
+
+        plans = []
+
+        for folder_name in folder_names:
+
+            tr_rec = self.folder_index.get(folder_name)
+            if tr_rec == None:
+                continue
+
+            path_to_folder = os.path.join(path_to_removable_media, folder_name)
+
+            #tracks of interrupted renumbering have names of track list again
+            if not RenumberPlan.recover(path_to_folder):
+                continue
+
+            plan = RenumberPlan(path_to_folder, self.folder_track_names(tr_rec))
+            if plan.renames != []:
+                plans.append(plan)
+
+        return plans
+
+    def apply_renumbering(self, track_list_filename, plans, path_to_profiles='./.profiles'):
+        """
+            Renames tracks of applied plans in track list and saves it once, plans which weren't applied
+            (or were rolled back) are skipped
+        """
+
+        applied = [plan for plan in plans if plan.rollback_log]
+
+        for plan in applied:
+
+            path_to_folder = plan.path_to_folder
+            folder_name = os.path.basename(path_to_folder)
+            tr_rec = self.folder_index.get(folder_name)
+            if tr_rec == None:
+                continue
+
+            tracks = self.folder_tracks(tr_rec)
+            tr_rec['tracks'] = [[new_name, tr[1]] for new_name, tr in zip(plan.new_names, tracks)]
+
+            #renaming changes only mtime of folder, count and size of entries stay the same
+            fingerprint = tr_rec.get('fingerprint')
+            if fingerprint != None:
+                self.scanner.stat_calls += 1
+                tr_rec['fingerprint'] = (os.stat(path_to_folder).st_mtime,) + tuple(fingerprint[1:])
+
+            self.rename_metadata(tr_rec, dict(plan.renames))
+            self.update_search_index(folder_name)
+
+        if applied != []:
+            self.save_track_list(track_list_filename, path_to_profiles)
+
+    def rename_metadata(self, tr_rec, renames):
+        """
+            Moves cached headers of renamed tracks to their new names: renames is {old_name: new_name}
+        """
+
+        if tr_rec.metadata == None and self.store != None:
+            tr_rec.metadata = self.store.load_metadata(tr_rec['folder_name'])
+
+        if not tr_rec.metadata:
+            return
+
+        tr_rec.metadata = dict((renames.get(track_name, track_name), entry)
+                               for track_name, entry in tr_rec.metadata.items())
+        if self.store != None:
+            self.store.save_metadata(tr_rec['folder_name'], tr_rec.metadata)
+        else:
+            self.metadata_changed = True
+
+    def journal_filename(self, track_list_filename):
+        """
+            Returns filename of journal of marks, it's stored next to track_list_filename
+        """
+        return track_list_filename + '.jnl'
+
+    def mark_track(self, track_list_filename, folder_name, track, mark, path_to_profiles='./.profiles'):
+        """
+            Sets delete mark of track and appends it to journal instead of saving whole track list.
+            Journal is compacted into track_list_filename after journal_compact_threshold marks.
+                folder_name: string     #folder containing track
+                track: list             #[trackname, mark_to_delete] from track_list
+                mark: boolean           #new mark_to_delete
+        """
+
+        track[1] = mark
+
+        instrumentation.count('marks.changed')
+
+        #sqlite database updates only row of this track, mapped database only its bit
+        if self.is_sqlite_database(track_list_filename) or self.is_mapped_database(track_list_filename):
+            self.open_store(track_list_filename, path_to_profiles)
+            self.store.set_mark(folder_name, track[0], mark)
+            return
+
+        if self.profiles_path_exists(path_to_profiles):
+
+            with self.save_lock:
+
+                #one json list [folder_name, trackname, mark_to_delete] per line
+                f = open(os.path.join(path_to_profiles, self.journal_filename(track_list_filename)),'ab')
+                f.write(json.dumps([folder_name, track[0], mark]).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+
+                self.journal_entries += 1
+
+            #journal is compacted in background, marks are safe in journal until then
+            if self.journal_entries >= self.journal_compact_threshold:
+                self.schedule_save_track_list(track_list_filename, path_to_profiles)
+
+    @instrumented('TrackListManager.replay_journal')
+    def replay_journal(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Applies marks from journal to loaded track list
+        """
+
+        self.journal_entries = 0
+
+        path_to_journal = os.path.join(path_to_profiles, self.journal_filename(track_list_filename))
+        if not os.path.exists(path_to_journal):
+            return
+
+        #{folder_name: {trackname: [trackname, mark_to_delete]}}, only for folders found in journal
+        tracks_by_folder = {}
+
+        f = open(path_to_journal,'rb')
+        for line in f:
+            try:
+                folder_name, track_name, mark = json.loads(line.decode('utf-8'))
+            except ValueError:
+                #last line can be written partly if application was killed
+                continue
+
+            if folder_name not in tracks_by_folder:
+                tr_rec = self.folder_index.get(folder_name)
+                tracks_by_folder[folder_name] = {}
+                if tr_rec != None:
+                    tracks_by_folder[folder_name] = dict((tr[0], tr) for tr in self.folder_tracks(tr_rec))
+
+            track = tracks_by_folder[folder_name].get(track_name)
+            if track != None:
+                track[1] = mark
+            self.journal_entries += 1
+        f.close()
+
+        Logger.info('TrackListManager: %d marks replayed from journal' % self.journal_entries)
+
+    def compact_journal(self, track_list_filename, path_to_profiles='./.profiles'):
+        """
+            Saves track list if journal has marks (or pickled track list has new cached headers),
+            called on pause and exit of application
+        """
+
+        if self.journal_entries > 0 or self.metadata_changed:
+            self.save_track_list(track_list_filename, path_to_profiles)
+
+    @instrumented('TrackListManager.choose_tracklist')
+    def choose_tracklist(self, track_list_filename, path_to_removable_media, path_to_profiles='./.profiles'):
+        """
+            If tracks structure earlier was scanned and save - loads it and returns True, else returns False
+            and track list should be created by create_new_track_list (TrackScanScreen.start_scan does it
+            not blocking user interface).
+            Handler for button_profile_ok on ProfileScreen
+        """
+        if self.profiles_path_exists(path_to_profiles):
+            
+            if self.track_list_exists(track_list_filename, path_to_profiles):
+                self.load_track_list(track_list_filename, path_to_profiles)
+                return True
+
+        #track list of other profile shouldn't be shown until scan is finished
+        self.set_track_list([])
+        return False
+
+    def get_current_tracklist_in_folder_name(self, folder_name):
+        """
+            Returns tracks structure ([track_filename:String, mark_to_delete:Boolean]) for folder_name
+        """
+        
+        tr_rec = self.folder_index.get(folder_name)
+        if tr_rec != None:
+            return self.folder_tracks(tr_rec)
+        return []
+
+    def is_track_marked(self, folder_name, index_of_track):
+        """
+            Returns delete mark of track without loading its folder into track list, so marks of
+            search results don't load folders of every result. Marks of folders which aren't loaded
+            are read from database once and cached until folder is loaded.
+        """
+
+        tr_rec = self.folder_index.get(folder_name)
+        if tr_rec == None:
+            return False
+
+        if tr_rec.loaded:
+            return tr_rec.is_marked(index_of_track)
+
+        #counter of folder is known without reading its tracks
+        if tr_rec.marked == 0:
+            return False
+
+        marks = self.mark_cache.get(folder_name)
+        if marks == None:
+            marks = [mark for track_name, mark in self.store.load_tracks(folder_name)]
+            self.mark_cache[folder_name] = marks
+
+        return index_of_track < len(marks) and marks[index_of_track]
+
+    def trim_loaded_folders(self):
+        """
+            Unloads least recently used folders of sharded track database above its cache size.
+            It's called after folder is opened, not by getters which are called for every track.
+        """
+
+        if isinstance(self.store, ShardedTrackStore):
+            self.store.trim()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Tests of track list management, run from root of repository:
+        python -m unittest discover
+"""
+
+import os, shutil, tempfile, unittest
+
+def make_media(path_to_removable_media, folders):
+    """
+        Creates removable media with folders {folder_name: [filename]}, content of file is its name
+    """
+
+    for folder_name, names in folders.items():
+        path_to_folder = os.path.join(path_to_removable_media, folder_name)
+        os.makedirs(path_to_folder)
+        for name in names:
+            f = open(os.path.join(path_to_folder, name), 'wb')
+            f.write(name.encode('utf-8'))
+            f.close()
+
+def folder_names(path_to_folder):
+    """
+        Returns sorted names of files in folder
+    """
+    return sorted(os.listdir(path_to_folder))
+
+class MediaTestCase(unittest.TestCase):
+    """
+        Test with removable media self.folders and profiles in temporary folder, which is current folder
+        while test runs, so nothing is written into ./.profiles of repository
+    """
+
+    folders = {}
+
+    def setUp(self):
+
+        self.cwd = os.getcwd()
+        self.path_to_temp = tempfile.mkdtemp()
+        os.chdir(self.path_to_temp)
+
+        self.path_to_removable_media = os.path.join(self.path_to_temp, u'media')
+        self.path_to_profiles = os.path.join(self.path_to_temp, '.profiles')
+        make_media(self.path_to_removable_media, self.folders)
+
+    def tearDown(self):
+
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path_to_temp)
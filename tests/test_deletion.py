@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest
+
+from managers import TrackListManager, DeletionJob
+from tests import MediaTestCase, folder_names
+
+class DeletionJobTest(MediaTestCase):
+
+    track_list_filename = '.t.tdb'
+
+    folders = {u'A': [u'a.mp3', u'b.mp3', u'c.mp3', u'd.mp3'], u'B': [u'e.mp3']}
+
+    def setUp(self):
+
+        MediaTestCase.setUp(self)
+
+        self.manager = TrackListManager()
+        self.manager.create_new_track_list(self.path_to_removable_media, self.track_list_filename,
+                                           path_to_profiles=self.path_to_profiles)
+
+        #tracks are kept in order of listing, first, third and last track of A are marked
+        self.names = [tr[0] for tr in self.manager.get_current_tracklist_in_folder_name(u'A')]
+        for index in (0, 2, 3):
+            self.manager.mark_track(self.track_list_filename, u'A',
+                                    self.manager.get_current_tracklist_in_folder_name(u'A')[index], True,
+                                    self.path_to_profiles)
+
+    def stage(self):
+
+        job = DeletionJob(self.path_to_removable_media, self.manager.marked_tracks())
+        job.stage()
+        self.manager.remove_tracks(self.track_list_filename, job.staged, self.path_to_profiles,
+                                   job.bytes_by_folder(job.staged))
+        return job
+
+    def tracks(self, manager=None):
+        return [list(tr) for tr in (manager or self.manager).get_current_tracklist_in_folder_name(u'A')]
+
+    def test_staged_tracks_are_moved_to_trash(self):
+
+        job = self.stage()
+
+        self.assertEqual(len(job.staged), 3)
+        self.assertEqual(folder_names(os.path.join(self.path_to_removable_media, u'A')), [self.names[1]])
+        self.assertEqual(folder_names(os.path.join(job.path_to_trash, u'A')),
+                         sorted(self.names[index] for index in (0, 2, 3)))
+        self.assertEqual(self.tracks(), [[self.names[1], False]])
+
+        loaded = TrackListManager()
+        loaded.load_track_list(self.track_list_filename, self.path_to_profiles)
+        self.assertEqual(self.tracks(loaded), [[self.names[1], False]])
+
+    def test_purge_deletes_trash(self):
+
+        job = self.stage()
+        job.purge()
+
+        self.assertEqual(job.purged, 3)
+        self.assertEqual(job.failures, [])
+        self.assertFalse(os.path.exists(job.path_to_trash))
+        self.assertEqual(folder_names(os.path.join(self.path_to_removable_media, u'A')), [self.names[1]])
+
+    def test_undo_restores_tracks_on_their_places(self):
+
+        job = self.stage()
+        restored = job.undo()
+        self.manager.restore_tracks(self.track_list_filename, restored, self.path_to_profiles,
+                                    job.bytes_by_folder(restored))
+
+        expected = [[name, index != 1] for index, name in enumerate(self.names)]
+        self.assertEqual(self.tracks(), expected)
+        self.assertEqual(folder_names(os.path.join(self.path_to_removable_media, u'A')), sorted(self.names))
+        self.assertFalse(os.path.exists(job.path_to_trash))
+
+        loaded = TrackListManager()
+        loaded.load_track_list(self.track_list_filename, self.path_to_profiles)
+        self.assertEqual(self.tracks(loaded), expected)
+
+    def test_track_which_can_not_be_moved_stays_marked(self):
+
+        os.remove(os.path.join(self.path_to_removable_media, u'A', self.names[0]))
+        job = self.stage()
+
+        self.assertEqual(len(job.failures), 1)
+        self.assertEqual(self.tracks(), [[self.names[0], True], [self.names[1], False]])
+
+if __name__ == '__main__':
+    unittest.main()
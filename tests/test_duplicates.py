@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os, threading, unittest
+
+from managers import TrackListManager, DuplicateFinder, HashCache
+from tests import MediaTestCase
+
+class DuplicatesTest(MediaTestCase):
+
+    track_list_filename = '.t.tdb'
+
+    #content of file is its name, copies are written by setUp
+    folders = {u'A': [u'a.mp3', u'b.mp3'], u'B': [u'a.mp3', u'c.mp3']}
+
+    def setUp(self):
+
+        MediaTestCase.setUp(self)
+
+        self.manager = TrackListManager()
+        self.manager.create_new_track_list(self.path_to_removable_media, self.track_list_filename,
+                                           path_to_profiles=self.path_to_profiles)
+
+    def find(self, cancel_event=None):
+        return self.manager.find_duplicates(self.path_to_removable_media, self.track_list_filename,
+                                            cancel_event=cancel_event, path_to_profiles=self.path_to_profiles)
+
+    def marks(self, manager):
+        return dict(((tr_rec['folder_name'], tr[0]), tr[1]) for tr_rec in manager.track_list
+                    for tr in manager.folder_tracks(tr_rec))
+
+    def test_copies_are_found(self):
+
+        finder = self.find()
+
+        #groups are in order of track list, which is order of listing of removable media
+        order = [tr_rec['folder_name'] for tr_rec in self.manager.track_list]
+        self.assertEqual([[track[0] for track in group] for group in finder.groups], [order])
+        self.assertEqual(finder.duplicate_bytes, len(u'a.mp3'))
+
+    def test_cancelled_search_keeps_cached_hashes(self):
+
+        self.find()
+        path_to_cache = os.path.join(self.path_to_profiles, self.manager.hash_cache_filename(self.track_list_filename))
+        cached = self.cache_entries(path_to_cache)
+        self.assertEqual(len(cached), 4)
+
+        cancel_event = threading.Event()
+        cancel_event.set()
+        finder = self.find(cancel_event)
+
+        self.assertEqual(finder.groups, [])
+        self.assertEqual(self.cache_entries(path_to_cache), cached)
+
+    def cache_entries(self, path_to_cache):
+
+        hash_cache = HashCache(path_to_cache)
+        return dict(hash_cache.entries)
+
+    def test_copies_are_marked_through_journal(self):
+
+        finder = self.find()
+        self.assertEqual(self.manager.mark_duplicates(self.track_list_filename, finder.groups, self.path_to_profiles), 1)
+
+        loaded = TrackListManager()
+        loaded.load_track_list(self.track_list_filename, self.path_to_profiles)
+        marks = self.marks(loaded)
+
+        #the first copy in order of track list is kept
+        kept_folder, marked_folder = [track[0] for track in finder.groups[0]]
+        self.assertEqual(sorted(key for key, mark in marks.items() if mark), [(marked_folder, u'a.mp3')])
+
+    def test_group_marked_by_user_is_left_as_it_is(self):
+
+        finder = self.find()
+        for folder_name in (u'A', u'B'):
+            for tr in self.manager.get_current_tracklist_in_folder_name(folder_name):
+                if tr[0] == u'a.mp3':
+                    self.manager.mark_track(self.track_list_filename, folder_name, tr, True, self.path_to_profiles)
+
+        self.assertEqual(self.manager.mark_duplicates(self.track_list_filename, finder.groups, self.path_to_profiles), 0)
+        self.assertTrue(self.marks(self.manager)[(u'A', u'a.mp3')])
+        self.assertTrue(self.marks(self.manager)[(u'B', u'a.mp3')])
+
+if __name__ == '__main__':
+    unittest.main()
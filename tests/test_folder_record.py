@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from managers import FolderRecord
+
+class FolderRecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.record = FolderRecord(u'A', [[u'a.mp3', False], [u'Жук.mp3', True], [u'c.mp3', False]], (1.0, 3, 30))
+
+    def test_tracks_behave_as_lists(self):
+
+        tracks = self.record['tracks']
+
+        self.assertEqual([list(tr) for tr in tracks], [[u'a.mp3', False], [u'Жук.mp3', True], [u'c.mp3', False]])
+        self.assertEqual(tracks[-1][0], u'c.mp3')
+        self.assertRaises(IndexError, lambda: tracks[3])
+
+    def test_marks_keep_counter(self):
+
+        tracks = self.record['tracks']
+        tracks[0][1] = True
+        tracks[1][1] = False
+        tracks[2][1] = True
+
+        self.assertEqual(self.record.marked_count(), 2)
+        self.assertEqual([tr[1] for tr in tracks], [True, False, True])
+        self.assertTrue(self.record.dirty)
+
+    def test_insert_and_replace(self):
+
+        tracks = self.record['tracks']
+        tracks.insert(1, [u'b.mp3', True])
+        self.assertEqual([tr[0] for tr in tracks], [u'a.mp3', u'b.mp3', u'Жук.mp3', u'c.mp3'])
+        self.assertEqual(self.record.marked_count(), 2)
+
+        tracks[:] = [tr for tr in tracks if not tr[1]]
+        self.assertEqual([list(tr) for tr in self.record['tracks']], [[u'a.mp3', False], [u'c.mp3', False]])
+
+    def test_dictionary_round_trip(self):
+
+        record = FolderRecord.from_dict(self.record.to_dict())
+
+        self.assertEqual(record.to_dict(), self.record.to_dict())
+        self.assertEqual(record['fingerprint'], (1.0, 3, 30))
+
+    def test_unloaded_record(self):
+
+        record = FolderRecord(u'A')
+
+        self.assertFalse(record.loaded)
+        self.assertEqual(record['tracks'], None)
+        self.assertEqual(record.to_dict()['tracks'], None)
+
+if __name__ == '__main__':
+    unittest.main()
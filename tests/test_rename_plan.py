@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest
+
+from managers import MediaScanner
+from tests import MediaTestCase, folder_names
+
+class RenamePlanTest(MediaTestCase):
+
+    folders = {u'A': [u'a!.mp3', u'a.mp3', u'b#.mp3', u'c.mp3']}
+
+    def setUp(self):
+
+        MediaTestCase.setUp(self)
+        self.path_to_folder = os.path.join(self.path_to_removable_media, u'A')
+        self.names = [u'a!.mp3', u'a.mp3', u'b#.mp3', u'c.mp3']
+
+    def test_collision_gets_other_name(self):
+
+        plan = MediaScanner().plan_renames(self.path_to_folder, self.names)
+
+        self.assertEqual(plan.renames, [(u'a!.mp3', u'a-RENAMED.mp3'), (u'b#.mp3', u'b.mp3')])
+        self.assertTrue(plan.apply())
+        self.assertEqual(folder_names(self.path_to_folder), [u'a-RENAMED.mp3', u'a.mp3', u'b.mp3', u'c.mp3'])
+
+    def test_failed_rename_is_rolled_back(self):
+
+        plan = MediaScanner().plan_renames(self.path_to_folder, self.names)
+        os.remove(os.path.join(self.path_to_folder, u'b#.mp3'))
+
+        self.assertFalse(plan.apply())
+        self.assertEqual(len(plan.failures), 1)
+        self.assertEqual(folder_names(self.path_to_folder), [u'a!.mp3', u'a.mp3', u'c.mp3'])
+
+    def test_scan_collects_cleared_names(self):
+
+        tracks, fingerprint, track_bytes = MediaScanner().scan_folder(self.path_to_folder)
+
+        self.assertEqual(sorted(tr[0] for tr in tracks), [u'a-RENAMED.mp3', u'a.mp3', u'b.mp3', u'c.mp3'])
+        self.assertEqual(fingerprint[1], 4)
+
+if __name__ == '__main__':
+    unittest.main()
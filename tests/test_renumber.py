@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import os, json, unittest
+
+from managers import RenumberPlan, MediaScanner, TrackListManager
+from tests import MediaTestCase, make_media, folder_names
+
+class RenumberPlanTest(MediaTestCase):
+
+    def setUp(self):
+
+        MediaTestCase.setUp(self)
+        self.path_to_folder = os.path.join(self.path_to_removable_media, u'A')
+
+    def plan(self, names, listed=None):
+        make_media(self.path_to_removable_media, {u'A': listed or names})
+        return RenumberPlan(self.path_to_folder, names)
+
+    def test_prefix_of_title_is_kept(self):
+
+        plan = self.plan([u'50 Cent - In Da Club.mp3', u'1999 - Prince.mp3', u'3.14 Pi.mp3'])
+
+        self.assertEqual(plan.new_names, [u'01 - 50 Cent - In Da Club.mp3', u'02 - 1999 - Prince.mp3',
+                                          u'03 - 3.14 Pi.mp3'])
+
+    def test_numbered_tracks_are_not_renamed(self):
+
+        plan = self.plan([u'01 - a.mp3', u'02 - b.mp3'])
+
+        self.assertEqual(plan.renames, [])
+
+    def test_shrunk_folder_keeps_wider_prefixes_once(self):
+
+        #folder was numbered when it had more than 99 tracks, some of them were purged since
+        names = [u'%03d - T%d.mp3' % (index * 2 + 1, index) for index in range(50)]
+        plan = self.plan(names)
+
+        self.assertEqual(plan.new_names[0], u'01 - T0.mp3')
+        self.assertEqual(plan.new_names[49], u'50 - T49.mp3')
+        self.assertTrue(plan.apply())
+        self.assertEqual(folder_names(self.path_to_folder), sorted(plan.new_names))
+
+    def test_swapped_tracks(self):
+
+        plan = self.plan([u'02 - b.mp3', u'01 - a.mp3'])
+
+        self.assertTrue(plan.apply())
+        self.assertEqual(folder_names(self.path_to_folder), [u'01 - b.mp3', u'02 - a.mp3'])
+        self.assertFalse(os.path.exists(os.path.join(self.path_to_folder, RenumberPlan.log_filename)))
+
+    def test_file_outside_plan_is_not_overwritten(self):
+
+        plan = self.plan([u'b.mp3'], [u'b.mp3', u'01 - b.mp3'])
+
+        self.assertFalse(plan.apply())
+        self.assertEqual(folder_names(self.path_to_folder), [u'01 - b.mp3', u'b.mp3'])
+        self.assertEqual(open(os.path.join(self.path_to_folder, u'01 - b.mp3'), 'rb').read(), b'01 - b.mp3')
+
+    def test_failed_rename_is_rolled_back(self):
+
+        plan = self.plan([u'02 - b.mp3', u'01 - a.mp3', u'c.mp3'])
+        os.remove(os.path.join(self.path_to_folder, u'c.mp3'))
+
+        self.assertFalse(plan.apply())
+        self.assertEqual(folder_names(self.path_to_folder), [u'01 - a.mp3', u'02 - b.mp3'])
+        self.assertFalse(os.path.exists(os.path.join(self.path_to_folder, RenumberPlan.log_filename)))
+
+    def test_interrupted_renumbering_is_recovered(self):
+
+        plan = self.plan([u'02 - b.mp3', u'01 - a.mp3'])
+
+        #application was killed after first phase: both tracks have temporary names, last rename is logged only
+        log = open(os.path.join(self.path_to_folder, RenumberPlan.log_filename), 'wb')
+        for old_name, new_name in ((u'02 - b.mp3', u'.renumber-0.mp3'), (u'01 - a.mp3', u'.renumber-1.mp3'),
+                                   (u'.renumber-0.mp3', u'01 - b.mp3')):
+            log.write(json.dumps([old_name, new_name]).encode('utf-8') + b'\n')
+        log.write(b'[".renumber-1.mp3", "02')
+        log.close()
+        os.rename(os.path.join(self.path_to_folder, u'02 - b.mp3'), os.path.join(self.path_to_folder, u'.renumber-0.mp3'))
+        os.rename(os.path.join(self.path_to_folder, u'01 - a.mp3'), os.path.join(self.path_to_folder, u'.renumber-1.mp3'))
+
+        tracks, fingerprint, track_bytes = MediaScanner().scan_folder(self.path_to_folder)
+
+        self.assertEqual(sorted(tr[0] for tr in tracks), [u'01 - a.mp3', u'02 - b.mp3'])
+        self.assertEqual(folder_names(self.path_to_folder), [u'01 - a.mp3', u'02 - b.mp3'])
+        self.assertTrue(plan.apply())
+        self.assertEqual(folder_names(self.path_to_folder), [u'01 - b.mp3', u'02 - a.mp3'])
+
+class RenumberTracksTest(MediaTestCase):
+
+    folders = {u'A': [u'b.mp3', u'a.mp3', u'cover.jpg']}
+
+    def test_track_list_follows_renamed_tracks(self):
+
+        manager = TrackListManager()
+        manager.create_new_track_list(self.path_to_removable_media, '.t.tdbs', path_to_profiles=self.path_to_profiles)
+        tracks = manager.get_current_tracklist_in_folder_name(u'A')
+        manager.mark_track('.t.tdbs', u'A', tracks[1], True, self.path_to_profiles)
+
+        names = [tr[0] for tr in tracks]
+        plans = manager.renumber_tracks(self.path_to_removable_media, '.t.tdbs', path_to_profiles=self.path_to_profiles)
+
+        self.assertEqual(len(plans), 1)
+        expected = [[u'01 - ' + names[0], False], [u'02 - ' + names[1], True]]
+
+        loaded = TrackListManager()
+        loaded.load_track_list('.t.tdbs', self.path_to_profiles)
+        self.assertEqual([list(tr) for tr in loaded.get_current_tracklist_in_folder_name(u'A')], expected)
+        self.assertEqual(folder_names(os.path.join(self.path_to_removable_media, u'A')),
+                         sorted([tr[0] for tr in expected] + [u'cover.jpg']))
+
+if __name__ == '__main__':
+    unittest.main()
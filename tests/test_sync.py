@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest
+
+from managers import TrackListManager, DeletionJob
+from tests import MediaTestCase, make_media, folder_names
+
+class LibrarySyncTest(MediaTestCase):
+
+    track_list_filename = '.t.tdb'
+
+    #track staged for deleting, it's in trash of removable media
+    folders = {DeletionJob.trash_folder_name: [u'staged.mp3'], u'Old': [u'old.mp3']}
+
+    def setUp(self):
+
+        MediaTestCase.setUp(self)
+
+        self.path_to_source_library = os.path.join(self.path_to_temp, u'library')
+        make_media(self.path_to_source_library, {os.path.join(u'Artist', u'Album'): [u'a#.mp3', u'b.mp3'],
+                                                 DeletionJob.trash_folder_name: [u'c.mp3']})
+
+        self.manager = TrackListManager()
+        self.manager.create_new_track_list(self.path_to_removable_media, self.track_list_filename,
+                                           path_to_profiles=self.path_to_profiles)
+
+    def sync(self):
+        return self.manager.sync_library(self.path_to_source_library, self.path_to_removable_media,
+                                         self.track_list_filename, path_to_profiles=self.path_to_profiles, prune=True)
+
+    def test_library_is_copied_into_top_level_folders(self):
+
+        sync = self.sync()
+
+        self.assertEqual(sync.failures, [])
+        path_to_album = os.path.join(self.path_to_removable_media, u'Artist - Album')
+        self.assertEqual(folder_names(path_to_album), [u'a.mp3', u'b.mp3'])
+        self.assertEqual(open(os.path.join(path_to_album, u'a.mp3'), 'rb').read(), b'a#.mp3')
+        self.assertEqual([tr[0] for tr in self.manager.get_current_tracklist_in_folder_name(u'Artist - Album')],
+                         [u'a.mp3', u'b.mp3'])
+
+        #nothing changed, nothing is copied again
+        self.assertEqual(self.sync().copied, [])
+
+    def test_trash_of_removable_media_is_not_synced(self):
+
+        sync = self.sync()
+
+        #folder of library with name of trash gets other name
+        self.assertNotIn(DeletionJob.trash_folder_name, sync.folders)
+        self.assertEqual(folder_names(os.path.join(self.path_to_removable_media,
+                                                   DeletionJob.trash_folder_name + u'-RENAMED')), [u'c.mp3'])
+        self.assertEqual(folder_names(os.path.join(self.path_to_removable_media, DeletionJob.trash_folder_name)),
+                         [u'staged.mp3'])
+        self.assertNotIn(DeletionJob.trash_folder_name, self.manager.folder_index)
+
+if __name__ == '__main__':
+    unittest.main()
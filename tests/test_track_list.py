@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import os, unittest
+
+from managers import TrackListManager, ProfileManager
+from tests import MediaTestCase
+
+class TrackListRoundTrip(object):
+    """
+        Save, load, mark and reload of track list in format of self.track_list_filename
+    """
+
+    track_list_filename = None
+
+    folders = {u'A': [u'a.mp3', u'b.mp3', u'cover.jpg'], u'B': [u'c.mp3']}
+
+    def scan(self):
+
+        manager = TrackListManager()
+        self.assertTrue(manager.create_new_track_list(self.path_to_removable_media, self.track_list_filename,
+                                                      path_to_profiles=self.path_to_profiles))
+        return manager
+
+    def load(self, track_list_filename=None):
+
+        manager = TrackListManager()
+        manager.load_track_list(track_list_filename or self.track_list_filename, self.path_to_profiles)
+        return manager
+
+    def marks(self, manager):
+        """
+            Returns {(folder_name, trackname): mark_to_delete} of every track
+        """
+
+        marks = {}
+        for tr_rec in manager.track_list:
+            for tr in manager.folder_tracks(tr_rec):
+                marks[(tr_rec['folder_name'], tr[0])] = tr[1]
+        return marks
+
+    def mark(self, manager, folder_name, track_name, mark=True):
+
+        for tr in manager.get_current_tracklist_in_folder_name(folder_name):
+            if tr[0] == track_name:
+                manager.mark_track(self.track_list_filename, folder_name, tr, mark, self.path_to_profiles)
+                return
+        self.fail('%s not found in %s' % (track_name, folder_name))
+
+    def test_scanned_tracks_are_loaded(self):
+
+        self.scan()
+
+        self.assertEqual(self.marks(self.load()), {(u'A', u'a.mp3'): False, (u'A', u'b.mp3'): False,
+                                                   (u'B', u'c.mp3'): False})
+
+    def test_mark_survives_reload_without_save(self):
+
+        manager = self.scan()
+        self.mark(manager, u'A', u'b.mp3')
+
+        self.assertTrue(self.marks(self.load())[(u'A', u'b.mp3')])
+
+    def test_saved_marks_are_reloaded(self):
+
+        manager = self.scan()
+        self.mark(manager, u'A', u'b.mp3')
+        self.mark(manager, u'B', u'c.mp3')
+        self.mark(manager, u'B', u'c.mp3', False)
+        manager.compact_journal(self.track_list_filename, self.path_to_profiles)
+        manager.save_track_list(self.track_list_filename, self.path_to_profiles)
+
+        manager = self.load()
+        self.assertEqual(self.marks(manager), {(u'A', u'a.mp3'): False, (u'A', u'b.mp3'): True,
+                                               (u'B', u'c.mp3'): False})
+
+        self.mark(manager, u'A', u'b.mp3', False)
+        self.assertFalse(any(self.marks(self.load()).values()))
+
+class PickledTrackListTest(TrackListRoundTrip, MediaTestCase):
+
+    track_list_filename = '.t.tdb'
+
+    def journal(self):
+        return os.path.join(self.path_to_profiles, '.t.tdb.jnl')
+
+    def test_journal_is_compacted_into_track_list(self):
+
+        manager = self.scan()
+        self.mark(manager, u'A', u'a.mp3')
+        self.assertTrue(os.path.exists(self.journal()))
+
+        manager.compact_journal(self.track_list_filename, self.path_to_profiles)
+
+        self.assertFalse(os.path.exists(self.journal()))
+        self.assertTrue(self.marks(self.load())[(u'A', u'a.mp3')])
+
+    def test_partly_written_mark_is_skipped(self):
+
+        manager = self.scan()
+        self.mark(manager, u'A', u'a.mp3')
+        f = open(self.journal(), 'ab')
+        f.write(b'["A", "b.m')
+        f.close()
+
+        marks = self.marks(self.load())
+        self.assertTrue(marks[(u'A', u'a.mp3')])
+        self.assertFalse(marks[(u'A', u'b.mp3')])
+
+class SqliteTrackListTest(TrackListRoundTrip, MediaTestCase):
+
+    track_list_filename = '.t.sqlite'
+
+    def test_pickled_track_list_is_migrated_when_user_asks(self):
+
+        profile_manager = ProfileManager(self.path_to_profiles)
+        profile_manager.create_new_profile('t', self.path_to_removable_media, self.path_to_profiles)
+        profile = profile_manager.get_profile('t')
+        profile['db_name'] = '.t.tdb'
+
+        pickled = TrackListManager()
+        pickled.create_new_track_list(self.path_to_removable_media, '.t.tdb', path_to_profiles=self.path_to_profiles)
+        for tr in pickled.get_current_tracklist_in_folder_name(u'A'):
+            if tr[0] == u'a.mp3':
+                pickled.mark_track('.t.tdb', u'A', tr, True, self.path_to_profiles)
+
+        profile_manager.use_sqlite_database('t')
+        self.assertEqual(profile['db_name'], self.track_list_filename)
+
+        manager = TrackListManager()
+        self.assertTrue(manager.choose_tracklist(profile['db_name'], self.path_to_removable_media,
+                                                 self.path_to_profiles))
+        self.assertTrue(self.marks(manager)[(u'A', u'a.mp3')])
+        self.assertTrue(self.marks(self.load())[(u'A', u'a.mp3')])
+
+class ShardedTrackListTest(TrackListRoundTrip, MediaTestCase):
+
+    track_list_filename = '.t.tdbs'
+
+    def test_unloaded_folder_keeps_its_marks(self):
+
+        manager = self.scan()
+        manager = self.load()
+        manager.store.cache_size = 1
+
+        self.mark(manager, u'A', u'a.mp3')
+        manager.get_current_tracklist_in_folder_name(u'B')
+        manager.trim_loaded_folders()
+
+        self.assertFalse(manager.folder_index[u'A'].loaded)
+        self.assertTrue(self.marks(manager)[(u'A', u'a.mp3')])
+
+    def test_marks_are_read_without_loading_folder(self):
+
+        manager = self.scan()
+        self.mark(manager, u'A', u'b.mp3')
+        manager.save_track_list(self.track_list_filename, self.path_to_profiles)
+
+        manager = self.load()
+        names = [tr[0] for tr in self.load().get_current_tracklist_in_folder_name(u'A')]
+
+        self.assertEqual([manager.is_track_marked(u'A', index) for index in range(len(names))],
+                         [name == u'b.mp3' for name in names])
+        self.assertFalse(manager.folder_index[u'A'].loaded)
+
+    def test_pickled_profile_keeps_its_format(self):
+
+        profile_manager = ProfileManager(self.path_to_profiles)
+        profile_manager.create_new_profile('t', self.path_to_removable_media, self.path_to_profiles)
+        profile_manager.get_profile('t')['db_name'] = '.t.tdb'
+        profile_manager.save_profiles()
+
+        self.assertEqual(ProfileManager(self.path_to_profiles).get_profile('t')['db_name'], '.t.tdb')
+
+class MappedTrackListTest(TrackListRoundTrip, MediaTestCase):
+
+    track_list_filename = '.t.tdbm'
+
+class ConversionTest(TrackListRoundTrip, MediaTestCase):
+
+    track_list_filename = '.t.tdb'
+
+    def test_marks_are_kept_by_conversion_between_formats(self):
+
+        manager = self.scan()
+        self.mark(manager, u'A', u'b.mp3')
+        expected = self.marks(manager)
+
+        track_list_filename = self.track_list_filename
+        for extension in ('.tdbm', '.sqlite', '.tdbs', '.tdbm', '.tdb'):
+            new_track_list_filename = '.converted%s' % extension
+            TrackListManager().convert_database(track_list_filename, new_track_list_filename, self.path_to_profiles)
+            self.assertEqual(self.marks(self.load(new_track_list_filename)), expected)
+            track_list_filename = new_track_list_filename
+
+if __name__ == '__main__':
+    unittest.main()